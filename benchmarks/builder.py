@@ -0,0 +1,119 @@
+"""
+Time the builder against page count on a synthetic feed, with PyYAML's pure
+python SafeDumper, libyaml's CSafeDumper, and CSafeDumper on a process pool.
+
+    poetry run python benchmarks/builder.py [--pages 50000] [--rows 20] [--jobs N]
+
+Builds are timed at a few page counts up to --pages, each into an empty
+output directory, and the output of every mode is checked to be identical.
+"""
+
+from mfma import builder
+from tempfile import TemporaryDirectory
+import argparse
+import filecmp
+import json
+import os
+import sys
+import time
+import yaml
+
+
+def synthetic_feed(path, pages, rows):
+    """A menu item and pages in a tree of folders, like a crawl's feed"""
+    with open(path, "w") as f:
+        menu = {"type": "menu", "menu_items": [{"url": "/Documents/", "text": "Documents"}]}
+        f.write(json.dumps(menu) + "\n")
+        for n in range(pages):
+            folder = "/Documents/%d/%d" % (n % 100, n)
+            table_rows = []
+            for r in range(rows):
+                if r % 4:
+                    row_path = "%s/Report %d.pdf" % (folder, r)
+                else:
+                    row_path = "%s/Folder%d" % (folder, r)
+                table_rows.append({
+                    "type": "table_form_item",
+                    "label": os.path.basename(row_path),
+                    "path": row_path,
+                    "modified_date": "2020/01/%02d 10:00" % (r % 28 + 1),
+                    "user": "MFMA Admin",
+                })
+            page = {
+                "type": "page",
+                "original_url": "http://mfma.treasury.gov.za" + folder + "/Forms/AllItems.aspx",
+                "path": folder,
+                "title": "Folder %d" % n,
+                "breadcrumbs": '<a href="/Documents/">Documents</a> &gt; Folder %d' % n,
+                "form_table_rows": table_rows,
+            }
+            f.write(json.dumps(page) + "\n")
+
+
+def build(feed, output_dir, jobs, dumper):
+    builder.SafeDumper = dumper
+    builder_ = builder.Builder(output_dir)
+    start = time.perf_counter()
+    if jobs > 1:
+        builder_.write_pages(builder.read_feed(feed), jobs)
+    else:
+        for item in builder.read_feed(feed):
+            builder_.handle_item(item)
+    builder_.finish()
+    return time.perf_counter() - start
+
+
+def same_tree(a, b):
+    comparison = filecmp.dircmp(a, b)
+    if comparison.left_only or comparison.right_only or comparison.funny_files:
+        return False
+    _, mismatch, errors = filecmp.cmpfiles(
+        a, b, comparison.common_files, shallow=False
+    )
+    if mismatch or errors:
+        return False
+    return all(
+        same_tree(os.path.join(a, d), os.path.join(b, d))
+        for d in comparison.common_dirs
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--pages", type=int, default=50000)
+    parser.add_argument("--rows", type=int, default=20)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    modes = [("SafeDumper", 1, yaml.SafeDumper)]
+    if hasattr(yaml, "CSafeDumper"):
+        modes.append(("CSafeDumper", 1, yaml.CSafeDumper))
+        modes.append((f"CSafeDumper -j {args.jobs}", args.jobs, yaml.CSafeDumper))
+    else:
+        print("PyYAML was built without libyaml, CSafeDumper unavailable")
+
+    counts = sorted({max(args.pages // 10, 1), max(args.pages // 2, 1), args.pages})
+    identical = True
+    with TemporaryDirectory() as tmp:
+        for pages in counts:
+            feed = os.path.join(tmp, f"feed-{pages}.jsonlines")
+            synthetic_feed(feed, pages, args.rows)
+            outputs = []
+            for name, jobs, dumper in modes:
+                output_dir = os.path.join(tmp, f"site-{pages}-{len(outputs)}")
+                os.makedirs(output_dir)
+                seconds = build(feed, output_dir, jobs, dumper)
+                print(
+                    f"{pages:7} pages  {name:18} {seconds:8.2f} s"
+                    f"  {pages / seconds:8.0f} pages/s"
+                )
+                outputs.append(output_dir)
+            for output_dir in outputs[1:]:
+                if not same_tree(outputs[0], output_dir):
+                    print(f"{pages:7} pages  OUTPUT DIFFERS: {output_dir}")
+                    identical = False
+    sys.exit(0 if identical else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Compare MfmaSpider's single pass HtmlTransform with the BeautifulSoup
+pipeline it replaced, on saved SharePoint pages.
+
+    poetry run python benchmarks/html_transform.py [page.html ...]
+
+Defaults to the simple content test fixture. Each page is transformed both
+ways, the output is checked to be identical, and the time per page is
+reported.
+"""
+
+from bs4 import BeautifulSoup
+from mfma.spiders.mfma_spider import MfmaSpider
+from mfma.items import FileItem, PageItem
+from scrapy.http import HtmlResponse
+from timeit import timeit
+import os
+import re
+import scrapy
+import sys
+import urllib
+
+
+FIXTURE = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "tests/mfma/spiders/test_mfma_spider/SimpleContentTestCase_page_source.html",
+)
+
+
+class BeautifulSoupSpider(MfmaSpider):
+    """
+    The BeautifulSoup fix_body, fix_links and clean_html MfmaSpider used to
+    have
+    """
+
+    def set_simple_content(self, page_item, response):
+        url = urllib.parse.urlparse(response.url)
+        page_item["original_url"] = response.url
+        page_item["path"] = self.dedotnet(url.path)
+        body = response.selector.css(self.simple_content_css)[0].extract()
+        for x in self.fix_body(page_item, body):
+            yield x
+
+        breadcrumbs_css = "#ctl00_PlaceHolderTitleBreadcrumb_siteMapPath"
+        css_match = response.selector.css(breadcrumbs_css)
+        if css_match:
+            page_item["breadcrumbs"] = self.breadcrumbs_html(css_match)
+
+    def breadcrumbs_html(self, match):
+        breadcrumbs_html = match[0].extract()
+        breadcrumbs_html = self.fix_links(breadcrumbs_html)
+        soup = BeautifulSoup(breadcrumbs_html, "html.parser")
+        for a in soup.find_all("a"):
+            a["href"] = self.dedotnet(a["href"], indexhtml=False)
+        return str(soup)
+
+    def fix_body(self, page_item, html):
+        soup = BeautifulSoup(html, "html.parser")
+        for a in soup.find_all("a"):
+            if not "href" in a:
+                continue
+            url = a["href"]
+            if self.is_forms_url(url):
+                url = self.fix_forms_url(url)
+            purl = urllib.parse.urlparse(url)
+            if purl.scheme == "mailto":
+                continue
+            if purl.hostname:
+                abs_url = url
+            else:
+                abs_url = self.base + url
+
+            if (
+                self.has_file_extension(purl.path)
+                and not purl.path.endswith("aspx")
+                and not purl.hostname
+            ):
+                a["href"] = abs_url
+                file_item = FileItem()
+                file_item["original_url"] = abs_url
+                file_item["path"] = urllib.parse.unquote(purl.path)
+                file_item["type"] = "file"
+                yield file_item
+            elif "Authenticate" in url:
+                continue
+            elif purl.hostname == "mfma.treasury.gov.za" or not purl.hostname:
+                a["href"] = self.dedotnet(purl.path)
+                yield scrapy.Request(abs_url)
+            else:
+                pass
+
+        body = self.clean_html(str(soup))
+        page_item["body"] = body
+
+    def fix_links(self, html):
+        soup = BeautifulSoup(html, "html.parser")
+        for a in soup.find_all("a"):
+            url = a["href"]
+            purl = urllib.parse.urlparse(url)
+            if not purl.hostname:
+                url = self.base + url
+            if self.is_forms_url(url):
+                url = self.fix_forms_url(url)
+            a["href"] = url
+
+        return str(soup)
+
+    def clean_html(self, html):
+        soup = BeautifulSoup(html, "html.parser")
+        whitelist = {"src", "href", "target", "alt"}
+        cleanups = list()
+
+        for tag in soup.find_all(True):
+            for attr in tag.attrs.keys():
+                if attr not in whitelist:
+                    cleanups.append((tag, attr))
+
+        for tag, attr in cleanups:
+            del tag.attrs[attr]
+
+        html = str(soup)
+        html = re.sub(r"</?br>\s*</?br>(\s*</?br>)*", "<br><br>", html)
+        return html
+
+
+def page(spider, response):
+    page_item = PageItem()
+    items = list(spider.set_simple_content(page_item, response))
+    return page_item, items
+
+
+def compare(path, number):
+    with open(path, "rb") as f:
+        body = f.read()
+    url = "http://mfma.treasury.gov.za/Pages/" + os.path.basename(path)
+    spiders = [
+        ("BeautifulSoup", BeautifulSoupSpider()),
+        ("HtmlTransform", MfmaSpider()),
+    ]
+    if not HtmlResponse(url, body=body).css(spiders[1][1].simple_content_css):
+        print(f"{path}: no simple content, skipping")
+        return True
+
+    outputs = []
+    for name, spider in spiders:
+        response = HtmlResponse(url, body=body, encoding="utf-8")
+        page_item, items = page(spider, response)
+        outputs.append(
+            (
+                page_item.get("body"),
+                page_item.get("breadcrumbs"),
+                [getattr(i, "url", None) or i.get("original_url") for i in items],
+            )
+        )
+    if outputs[0] != outputs[1]:
+        print(f"{path}: OUTPUT DIFFERS")
+        return False
+
+    times = []
+    for name, spider in spiders:
+        # A fresh response each time so parsel's parse is counted, as it is
+        # for every page in a crawl.
+        seconds = timeit(
+            lambda: page(spider, HtmlResponse(url, body=body, encoding="utf-8")),
+            number=number,
+        )
+        times.append(seconds / number)
+        print(f"{path}: {name:14} {seconds / number * 1000:8.2f} ms/page")
+    print(f"{path}: {times[0] / times[1]:.1f}x faster, output identical")
+    return True
+
+
+def main():
+    paths = sys.argv[1:] or [FIXTURE]
+    results = [compare(path, number=200) for path in paths]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Compare mfma's SqliteCacheStorage with Scrapy's FilesystemCacheStorage
+(gzipped, as this project had it) on synthetic SharePoint listing pages:
+time to store them, lookup latency, and the disk space and files used.
+
+    poetry run python benchmarks/httpcache.py [--responses 5000] [--lookups 2000]
+
+Lookups are of cached responses in random order. The page cache isn't
+dropped first, so they measure what a crawl that revisits pages sees, not
+a cold SD card.
+"""
+
+from mfma.httpcache import SqliteCacheStorage, import_filesystem_cache
+from scrapy.extensions.httpcache import FilesystemCacheStorage
+from scrapy.http import HtmlResponse, Request
+from scrapy.settings import Settings
+from scrapy.spiders import Spider
+from tempfile import TemporaryDirectory
+import argparse
+import os
+import random
+import statistics
+import time
+
+
+URL = "http://mfma.treasury.gov.za/Documents/%d/Forms/AllItems.aspx"
+
+
+def synthetic_page(n, rows=30):
+    """A document library listing page, mostly repeated SharePoint chrome"""
+    rows_html = "".join(
+        f'<tr class="ms-itmhover"><td class="ms-vb2"><a href="/Documents/{n}/'
+        f'Report%20{r}.pdf" onclick="DispEx(this,event,\'TRUE\',\'FALSE\')">'
+        f"Report {r} of folder {n}</a></td><td class=\"ms-vb2\">"
+        f"{2000 + r % 20}/{r % 12 + 1:02}/{r % 28 + 1:02} 10:{r % 60:02}</td>"
+        f'<td class="ms-vb-user">MFMA Admin</td></tr>'
+        for r in range(rows)
+    )
+    chrome = "<script>var _spPageContextInfo = {};</script>" * 200
+    return (
+        f"<html><head><title>Folder {n}</title>{chrome}</head><body>"
+        f"<table class=\"ms-listviewtable\">{rows_html}</table></body></html>"
+    ).encode()
+
+
+def footprint(directory):
+    """Bytes allocated on disk and number of files and directories"""
+    allocated = 0
+    inodes = 0
+    for root, dirs, files in os.walk(directory):
+        for name in dirs + files:
+            inodes += 1
+            allocated += os.lstat(os.path.join(root, name)).st_blocks * 512
+    return allocated, inodes
+
+
+def benchmark(name, storage, spider, responses, lookups, cachedir):
+    storage.open_spider(spider)
+    start = time.perf_counter()
+    for request, response in responses:
+        storage.store_response(spider, request, response)
+    store_seconds = time.perf_counter() - start
+
+    latencies = []
+    for request, response in random.sample(responses, lookups):
+        start = time.perf_counter()
+        cached = storage.retrieve_response(spider, request)
+        latencies.append(time.perf_counter() - start)
+        assert cached.body == response.body
+    storage.close_spider(spider)
+
+    allocated, inodes = footprint(cachedir)
+    latencies.sort()
+    print(
+        f"{name:12} store {len(responses) / store_seconds:7.0f}/s"
+        f"  lookup median {statistics.median(latencies) * 1000:6.2f} ms"
+        f"  p95 {latencies[int(len(latencies) * 0.95)] * 1000:6.2f} ms"
+        f"  disk {allocated / 1024 / 1024:7.1f} MiB  files {inodes:6}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--responses", type=int, default=5000)
+    parser.add_argument("--lookups", type=int, default=2000)
+    args = parser.parse_args()
+
+    spider = Spider("mfma")
+    responses = []
+    for n in range(args.responses):
+        url = URL % n
+        body = synthetic_page(n)
+        headers = {"Content-Type": "text/html; charset=utf-8", "Etag": f'"{n}"'}
+        responses.append((Request(url), HtmlResponse(url, body=body, headers=headers)))
+    lookups = min(args.lookups, args.responses)
+    print(f"{args.responses} responses of {len(responses[0][1].body) // 1024}KiB")
+
+    with TemporaryDirectory() as tmp:
+        for name, cls in [("filesystem", FilesystemCacheStorage), ("sqlite", SqliteCacheStorage)]:
+            cachedir = os.path.join(tmp, name)
+            settings = Settings({
+                "HTTPCACHE_DIR": cachedir,
+                "HTTPCACHE_EXPIRATION_SECS": 0,
+                "HTTPCACHE_GZIP": True,
+            })
+            benchmark(name, cls(settings), spider, responses, lookups, cachedir)
+
+        start = time.perf_counter()
+        imported = import_filesystem_cache(os.path.join(tmp, "filesystem"), settings)
+        print(f"imported {imported} filesystem responses in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
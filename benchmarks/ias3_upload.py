@@ -0,0 +1,146 @@
+"""
+Compare uploading to a mock ias3 endpoint the way the Internet Archive sink
+used to, with legacy boto, against mfma.pipelines.ias3: files/s and MB/s.
+
+    poetry run python benchmarks/ias3_upload.py [--files 200] [--size 256]
+        [--threads 2] [--latency 0.05] [--slow-down 0.05]
+
+The mock endpoint answers each request after --latency seconds, and asks
+for a --slow-down fraction of them to be retried with 503 SlowDown and a
+Retry-After of a tenth of a second. Each file goes to an item of its own,
+as the sink's do. boto creates each item with a request of its own before
+uploading, over a connection per thread; ias3 creates it with the upload,
+over a shared pool of kept-alive connections.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mfma.pipelines.ias3 import IAS3Client, Section
+import argparse
+import hashlib
+import random
+import threading
+import time
+
+try:
+    from boto.s3.connection import OrdinaryCallingFormat
+    import boto
+except ImportError:
+    boto = None
+
+
+class MockIAS3(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.connections.add(self.client_address)
+        if random.random() < self.server.slow_down:
+            body = b"<Error><Code>SlowDown</Code><Message>Slow down</Message></Error>"
+            self.send_response(503)
+            self.send_header("Retry-After", "0.1")
+        else:
+            body = b""
+            self.send_response(200)
+            # boto checks it against what it sent
+            self.send_header("ETag", '"%s"' % hashlib.md5(data).hexdigest())
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_HEAD = do_GET = do_PUT = do_POST = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+def boto_uploads(server, data, files, threads):
+    local = threading.local()
+    host, port = server.server_address
+
+    def upload(n):
+        conn = getattr(local, "conn", None)
+        if conn is None:
+            conn = local.conn = boto.connect_s3(
+                "key", "secret", host=host, port=port, is_secure=False,
+                calling_format=OrdinaryCallingFormat(),
+            )
+        bucket = conn.create_bucket(f"item{n}", headers={"x-archive-meta-mediatype": "text"})
+        key = bucket.new_key(f"/Documents/{n}.pdf")
+        key.set_contents_from_string(data, headers={"x-archive-keep-old-version": "1"})
+
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(upload, range(files)))
+
+
+def ias3_uploads(server, data, files, threads):
+    client = IAS3Client(
+        "key", "secret", "http://%s:%d" % server.server_address, pool_size=threads
+    )
+
+    def upload(n):
+        headers = {
+            "x-archive-auto-make-bucket": "1",
+            "x-archive-meta-mediatype": "text",
+            "x-archive-keep-old-version": "1",
+        }
+        client.put(f"item{n}", f"/Documents/{n}.pdf", Section.of_bytes(data), headers)
+
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(upload, range(files)))
+
+
+def benchmark(name, uploads, args, data):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockIAS3)
+    server.daemon_threads = True
+    server.latency = args.latency
+    server.slow_down = args.slow_down
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.connections = set()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        start = time.perf_counter()
+        uploads(server, data, args.files, args.threads)
+        seconds = time.perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+    print(
+        f"{name:6} {args.files / seconds:7.1f} files/s"
+        f"  {args.files * len(data) / seconds / 1e6:6.2f} MB/s"
+        f"  requests {server.requests:5}  connections {len(server.connections):4}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size", type=int, default=256, help="KiB per file")
+    parser.add_argument("--threads", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--slow-down", type=float, default=0.05)
+    args = parser.parse_args()
+
+    data = random.randbytes(args.size * 1024)
+    print(
+        f"{args.files} files of {args.size}KiB, {args.threads} threads, "
+        f"{args.latency * 1000:.0f}ms latency, {args.slow_down:.0%} slowed down"
+    )
+    if boto is not None:
+        benchmark("boto", boto_uploads, args, data)
+    else:
+        print("boto isn't installed, skipping it")
+    benchmark("ias3", ias3_uploads, args, data)
+    args.threads *= 4
+    print(f"{args.threads} threads")
+    benchmark("ias3", ias3_uploads, args, data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Compare extracting document library rows with mfma.listing's single walk
+per row against the per-row XPath and CSS queries the spider used to run,
+on a synthetic listing built from the form table test fixture's rows.
+
+    poetry run python benchmarks/listing_rows.py [--rows 10000] [--repeat 3]
+
+The rows of both are checked to be identical. Reports rows/sec of each, and
+the memory held by the rows kept as Row records and as dicts.
+"""
+
+from mfma.listing import extract_rows, get_row_link_path
+from scrapy.http import HtmlResponse
+import argparse
+import os
+import re
+import time
+import tracemalloc
+
+
+FIXTURE = os.path.join(
+    os.path.dirname(__file__),
+    "..",
+    "tests/mfma/spiders/test_mfma_spider/FormTableContentTestCase_page_source.html",
+)
+URL = "http://mfma.treasury.gov.za/Documents/Forms/AllItems.aspx"
+
+
+def synthetic_listing(rows):
+    """The fixture with its rows repeated, with different names, to rows rows"""
+    with open(FIXTURE) as f:
+        source = f.read()
+    start = source.index('<tr class="">')
+    # The last row ends after the table in its last user cell
+    end = source.index("</table>", source.rindex("ms-vb-user"))
+    end = source.index("</tr>", end) + len("</tr>")
+    template = source[start:end]
+    fixture_rows = template.count('class="ms-vb-title"')
+    copies = []
+    for n in range(-(-rows // fixture_rows)):
+        copies.append(re.sub(r"(Documents%2F|Documents/)(\d\d)", r"\g<1>%d-\2" % n, template))
+    return source[:start] + "".join(copies) + source[end:]
+
+
+def get_rows(response):
+    """The row elements, as the spider used to select them"""
+    return response.css(".ms-vb-title .ms-unselectedtitle").xpath("../..")
+
+
+def queried_rows(response):
+    """The rows as set_form_table_content used to query them"""
+    for row in get_rows(response):
+        yield {
+            "type": "table_form_item",
+            "label": row.xpath(".//tr/td/a/text()")[0].extract(),
+            "path": get_row_link_path(row.xpath(".//tr/td/a/@href")[0].extract()),
+            "modified_date": row.xpath('.//td[@class="ms-vb2"]/nobr/text()')[0].extract(),
+            "user": " ".join(row.css(".ms-vb-user *::text").extract()).strip(),
+        }
+
+
+def timed(extract, body, repeat):
+    """The best time of repeat runs, each on a freshly parsed response"""
+    best = None
+    for _ in range(repeat):
+        response = HtmlResponse(URL, body=body, encoding="utf-8")
+        response.selector.root
+        start = time.perf_counter()
+        rows = list(extract(response))
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return rows, best
+
+
+def held(make):
+    """Bytes allocated by make() and still held by what it returns"""
+    tracemalloc.start()
+    result = make()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    body = synthetic_listing(args.rows).encode("utf-8")
+    queried, queried_seconds = timed(queried_rows, body, args.repeat)
+    walked, walked_seconds = timed(
+        lambda response: extract_rows(response.selector.root), body, args.repeat
+    )
+    assert [row.as_dict() for row in walked] == queried
+    print(f"{len(walked)} rows, {len(body) / 1024 / 1024:.1f}MiB of HTML")
+    print(f"queries  {len(queried) / queried_seconds:9.0f} rows/s")
+    print(f"walk     {len(walked) / walked_seconds:9.0f} rows/s")
+
+    response = HtmlResponse(URL, body=body, encoding="utf-8")
+    root = response.selector.root
+    print(f"held as Row records {held(lambda: list(extract_rows(root))) / 1024:7.0f} KiB")
+    print(f"held as dicts       {held(lambda: list(queried_rows(response))) / 1024:7.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,17 +3,24 @@
 set -euf -o pipefail
 
 TIMESTAMP=$(date +%Y-%m-%dT%H%M%S)
+JOB_DIR=/var/lib/mfmacrawl/job
 
-trickle -s \
-        -d 200 \
-        -u 200 \
-        scrapy crawl mfma \
-            --set S3_BUCKET_NAME=$S3_BUCKET_NAME \
-            --set AWS_KEY_ID=$AWS_KEY_ID \
-            --set AWS_KEY_SECRET=$AWS_KEY_SECRET \
-            --set INTERNET_ARCHIVE_KEY_ID=$INTERNET_ARCHIVE_KEY_ID \
-            --set INTERNET_ARCHIVE_KEY_SECRET=$INTERNET_ARCHIVE_KEY_SECRET \
-            --loglevel=INFO \
-            --logfile=/var/log/mfmacrawl/mfmacrawl-${TIMESTAMP}.log \
-            --output file:///var/lib/mfmacrawl/mfmacrawl-${TIMESTAMP}.jsonlines:jsonlines \
-            $@
+# Resume the last crawl, appending to its feed, if it didn't finish
+FEED=$(python3 -m mfma.jobs prepare $JOB_DIR /var/lib/mfmacrawl/mfmacrawl-${TIMESTAMP}.jsonlines.gz)
+# A crawl started before feeds were compressed carries on uncompressed
+case $FEED in
+    *.jsonlines.gz) FORMAT=jsonlines.gz ;;
+    *) FORMAT=jsonlines ;;
+esac
+
+scrapy crawl mfma \
+    --set CRAWL_JOB_DIR=$JOB_DIR \
+    --set S3_BUCKET_NAME=$S3_BUCKET_NAME \
+    --set AWS_KEY_ID=$AWS_KEY_ID \
+    --set AWS_KEY_SECRET=$AWS_KEY_SECRET \
+    --set INTERNET_ARCHIVE_KEY_ID=$INTERNET_ARCHIVE_KEY_ID \
+    --set INTERNET_ARCHIVE_KEY_SECRET=$INTERNET_ARCHIVE_KEY_SECRET \
+    --loglevel=INFO \
+    --logfile=/var/log/mfmacrawl/mfmacrawl-${TIMESTAMP}.log \
+    --output file://${FEED}:${FORMAT} \
+    $@
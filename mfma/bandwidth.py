@@ -0,0 +1,118 @@
+"""
+Bandwidth budgets.
+
+Each kind of traffic has its own token bucket of BANDWIDTH_LIMITS bytes per
+second, so a slow upstream doesn't hold back uploads, nor a backlog of
+uploads the crawl:
+
+- pages: HTML pages fetched by the crawl
+- files: files downloaded to archive, in memory or spooled to disk
+- s3_uploads and internet_archive_uploads: what each archive sink sends
+
+Bytes are taken from a bucket as they're sent or received, which may put
+it in debt; whoever sends or receives next waits until the debt is paid
+off at the bucket's rate. Threads wait with consume, the reactor with
+mfma.middlewares.BandwidthMiddleware, which delays requests while their
+budget is in debt.
+
+The bytes and the time spent waiting on each budget are counted in the
+crawl stats under bandwidth/<budget>/.
+"""
+
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+PAGES = "pages"
+FILES = "files"
+S3_UPLOADS = "s3_uploads"
+INTERNET_ARCHIVE_UPLOADS = "internet_archive_uploads"
+BUDGETS = [PAGES, FILES, S3_UPLOADS, INTERNET_ARCHIVE_UPLOADS]
+
+# How many seconds' worth of bytes an idle bucket saves up
+BURST_SECONDS = 1
+
+
+class TokenBucket(object):
+    """
+    rate bytes per second, or unlimited if it's 0 or None. Safe to share
+    between threads.
+    """
+
+    def __init__(self, name, rate=None, stats=None, burst_seconds=BURST_SECONDS,
+                 clock=time.monotonic):
+        self.name = name
+        self.rate = rate or None
+        self.stats = stats
+        self.clock = clock
+        self.burst = self.rate * burst_seconds if self.rate else 0
+        self.tokens = self.burst
+        self.updated = clock()
+        self.lock = threading.Lock()
+        if stats is not None:
+            stats.set_value(f"bandwidth/{name}/limit", rate or 0)
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, size):
+        """Take size bytes, returning how long to wait before taking more"""
+        with self.lock:
+            self.inc_stat("bytes", size)
+            if self.rate is None:
+                return 0
+            self.refill()
+            self.tokens -= size
+            return max(0, -self.tokens / self.rate)
+
+    def delay(self):
+        """How long until the bucket is out of debt"""
+        if self.rate is None:
+            return 0
+        with self.lock:
+            self.refill()
+            return max(0, -self.tokens / self.rate)
+
+    def waited(self, seconds):
+        with self.lock:
+            self.inc_stat("throttled_seconds", seconds)
+
+    def consume(self, size):
+        """Take size bytes, blocking the thread until the bucket is out of debt"""
+        delay = self.take(size)
+        if delay:
+            self.waited(delay)
+            time.sleep(delay)
+
+    def inc_stat(self, key, count):
+        if self.stats is not None and count:
+            self.stats.inc_value(f"bandwidth/{self.name}/{key}", count)
+
+
+class Bandwidth(object):
+    """The crawler's budgets, one shared by everything in it, see from_crawler"""
+
+    def __init__(self, limits, stats=None):
+        self.buckets = {
+            name: TokenBucket(name, limits.get(name), stats) for name in BUDGETS
+        }
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        bandwidth = getattr(crawler, "bandwidth", None)
+        if bandwidth is None:
+            limits = crawler.settings.getdict("BANDWIDTH_LIMITS")
+            bandwidth = crawler.bandwidth = cls(limits, crawler.stats)
+            for name, bucket in bandwidth.buckets.items():
+                if bucket.rate:
+                    logger.info("Bandwidth for %s: %d bytes/s", name, bucket.rate)
+        return bandwidth
+
+    def __getitem__(self, name):
+        return self.buckets[name]
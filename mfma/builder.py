@@ -1,22 +1,61 @@
 """
 MFMA Mirror builder
+
+    python -m mfma.builder [--keep-removed] [--jobs N] feed.jsonlines output_dir
+
+Streams the feed, decompressing it as it's read if it's compressed (see
+mfma.feeds), and writes a jekyll page per page item and the menu data.
+A manifest of the sha256 of every file it wrote is kept in output_dir, so
+files whose content hasn't changed aren't rewritten, and pages it wrote
+before that are no longer in the site are deleted.
+
+With --jobs, pages are rendered and written by a pool of that many worker
+processes.
 """
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import argparse
 import codecs
+import hashlib
 import json
 import os
 import pdb
 import re
 import sys
 import traceback
-import urllib
+import urllib.parse
 import yaml
-import archiveorg
+from mfma.feeds import open_feed
+from mfma.pipelines.internet_archive import path_identifier
+
+
+MANIFEST = ".mfma-builder-manifest.json"
+
+# libyaml's emitter is many times faster than PyYAML's pure python one for
+# the same output, but PyYAML can be installed without it.
+SafeDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
 
 
 class Builder:
     def __init__(self, path):
         self.path = path
+        self.manifest_path = os.path.join(path, MANIFEST)
+        # filename: {"sha256": ..., "type": "page" or "menu"} as of the last build
+        self.manifest = {}
+        # The same as of this build
+        self.written = {}
+        # Folders listed in pages in this build, which might not have been
+        # crawled because they hadn't changed, so their pages are kept
+        self.listed_folders = set()
+
+    def load_manifest(self):
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def save_manifest(self):
+        with open(self.manifest_path, "w") as f:
+            json.dump(self.written, f, indent=0, sort_keys=True)
 
     def handle_item(self, item):
         if item["type"] == "page":
@@ -28,65 +67,254 @@ class Builder:
 
     def write_menu(self, menu):
         jsonstr = json.dumps(menu["menu_items"])
-        self.write_file("_data/menu.json", jsonstr)
+        self.write_file("_data/menu.json", jsonstr, "menu")
 
     def write_page(self, page):
-        table_items = page["form_table_rows"]
-
-        for item in table_items:
-            if "%20" in item["path"]:
-                item["path"] = urllib.unquote(item["path"])
-            if self.has_file_extension(item["path"]):
-                item["path"] = (
-                    "https://archive.org/details/"
-                    + archiveorg.path_identifier(item["path"])
+        filename, pagestr, folders = render_page(page)
+        self.write_file(filename, pagestr, "page")
+        self.listed_folders.update(folders)
+
+    def write_pages(self, items, jobs):
+        """
+        Handle items, writing pages from a pool of jobs processes. A page
+        that's in the feed more than once, like a paged listing, waits for
+        the one before it so the last one still wins.
+        """
+        with ProcessPoolExecutor(jobs) as executor:
+            pending = {}
+            for item in items:
+                if item["type"] != "page":
+                    self.handle_item(item)
+                    continue
+                filename = page_filename(item)
+                if filename in pending:
+                    self.page_written(pending.pop(filename).result())
+                pending[filename] = executor.submit(
+                    write_page, self.path, item, self.current_sha256(filename)
                 )
+                if len(pending) >= jobs * 16:
+                    # Don't read ahead of the workers without bound
+                    done, _ = wait(pending.values(), return_when=FIRST_COMPLETED)
+                    for written in [f for f, future in pending.items() if future in done]:
+                        self.page_written(pending.pop(written).result())
+            for future in pending.values():
+                self.page_written(future.result())
+
+    def page_written(self, result):
+        filename, sha256, folders = result
+        self.written[filename] = {"sha256": sha256, "type": "page"}
+        self.listed_folders.update(folders)
 
-        # Hack flip-flopping case causing noise in diffs
-        breadcrumbs = page.get("breadcrumbs", "")
-        breadcrumbs = breadcrumbs.replace("MEDIA_RELEASES", "Media_Releases")
+    def current_sha256(self, filename):
+        current = self.written.get(filename) or self.manifest.get(filename)
+        return current["sha256"] if current else None
 
-        frontmatter = {
-            "title": page.get("title" ""),
-            "breadcrumbs": breadcrumbs,
-            "layout": "default",
-            "original_url": page["original_url"],
-            "table_items": page["form_table_rows"],
+    def write_file(self, filename, data, type):
+        """Write data to filename unless it's already there"""
+        current = self.current_sha256(filename)
+        sha256 = write_output(self.path, filename, data, current)
+        self.written[filename] = {"sha256": sha256, "type": type}
+
+    def removed_pages(self):
+        """
+        Pages written by the last build that this one didn't write, unless
+        the nearest folder listed by this one that they're in was skipped:
+        listed, but its own page not written as it wasn't crawled again
+        """
+        written_folders = {
+            page_folder(filename)
+            for filename, entry in self.written.items()
+            if entry["type"] == "page"
         }
+        skipped = self.listed_folders - written_folders
+        removed = []
+        for filename, entry in self.manifest.items():
+            if entry["type"] != "page" or filename in self.written:
+                continue
+            listed = next(
+                (
+                    folder for folder in folders_of(page_folder(filename))
+                    if folder in self.listed_folders
+                ),
+                None,
+            )
+            if listed in skipped:
+                # Kept, not crawled again
+                self.written[filename] = entry
+                continue
+            removed.append(filename)
+        return sorted(removed)
+
+    def remove_file(self, filename):
+        filename = output_path(self.path, filename)
+        if os.path.exists(filename):
+            os.remove(filename)
+        # Remove the directories it leaves empty, up to the output dir
+        root = os.path.abspath(self.path)
+        directory = os.path.dirname(filename)
+        while directory != root and not os.listdir(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
 
-        frontmatter_yaml = yaml.safe_dump(frontmatter)
-        content = page.get("body", "")
-        pagestr = "---\n%s\n---\n%s" % (frontmatter_yaml, content)
-        if "%20" in page["path"]:
-            page["path"] = urllib.unquote(page["path"])
-        if "/index.html" in page["path"]:
-            filename = page["path"]
+    def finish(self, keep_removed=False):
+        """Delete removed pages, save the manifest, and summarise the changes"""
+        removed = self.removed_pages()
+        if keep_removed:
+            for filename in removed:
+                self.written[filename] = self.manifest[filename]
+            removed = []
         else:
-            filename = page["path"] + "/index.html"
-        self.write_file(filename, pagestr)
+            for filename in removed:
+                self.remove_file(filename)
+        self.save_manifest()
 
-    def write_file(self, filename, data):
-        filename = self.path + filename
-        directory = os.path.dirname(filename)
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        with codecs.open(filename, "w", encoding="utf8") as file:
-            file.write(data)
+        summary = {"added": [], "changed": [], "unchanged": [], "removed": removed}
+        for filename, entry in sorted(self.written.items()):
+            previous = self.manifest.get(filename)
+            if previous is None:
+                summary["added"].append(filename)
+            elif previous["sha256"] != entry["sha256"]:
+                summary["changed"].append(filename)
+            else:
+                summary["unchanged"].append(filename)
+        return summary
 
     @staticmethod
     def has_file_extension(path):
-        regex = "^.+(\..{1,4})$"
-        return re.match(regex, path)
+        return has_file_extension(path)
+
+
+def has_file_extension(path):
+    regex = "^.+(\..{1,4})$"
+    return re.match(regex, path)
+
+
+def page_filename(page):
+    path = page["path"]
+    if "%20" in path:
+        path = urllib.parse.unquote(path)
+    if "/index.html" in path:
+        return path
+    else:
+        return path + "/index.html"
+
+
+def page_folder(filename):
+    """The folder a page's filename is the index of"""
+    if filename.endswith("/index.html"):
+        return filename[:-len("/index.html")]
+    return filename
+
+
+def folders_of(folder):
+    """The folder and the folders it's in, innermost first"""
+    while folder:
+        yield folder
+        folder = folder.rsplit("/", 1)[0]
+
+
+def render_page(page):
+    """Return a page's filename, content and the folders it lists"""
+    table_items = page["form_table_rows"]
+    folders = []
+
+    for item in table_items:
+        if "%20" in item["path"]:
+            item["path"] = urllib.parse.unquote(item["path"])
+        if has_file_extension(item["path"]):
+            item["path"] = (
+                "https://archive.org/details/"
+                + path_identifier(item["path"])
+            )
+        else:
+            folders.append(item["path"].rstrip("/"))
+
+    # Hack flip-flopping case causing noise in diffs
+    breadcrumbs = page.get("breadcrumbs", "")
+    breadcrumbs = breadcrumbs.replace("MEDIA_RELEASES", "Media_Releases")
+
+    frontmatter = {
+        "title": page.get("title" ""),
+        "breadcrumbs": breadcrumbs,
+        "layout": "default",
+        "original_url": page["original_url"],
+        "table_items": page["form_table_rows"],
+    }
+
+    frontmatter_yaml = yaml.dump(frontmatter, Dumper=SafeDumper)
+    content = page.get("body", "")
+    pagestr = "---\n%s\n---\n%s" % (frontmatter_yaml, content)
+    return page_filename(page), pagestr, folders
+
+
+def write_page(root, page, current_sha256):
+    """Render and write a page in a worker process"""
+    filename, pagestr, folders = render_page(page)
+    return filename, write_output(root, filename, pagestr, current_sha256), folders
+
+
+def write_output(root, filename, data, current_sha256):
+    """
+    Write data to filename under root unless it's already there with the
+    current content, and return its sha256
+    """
+    sha256 = hashlib.sha256(data.encode("utf8")).hexdigest()
+    path = output_path(root, filename)
+    if sha256 == current_sha256 and os.path.exists(path):
+        return sha256
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    with codecs.open(path, "w", encoding="utf8") as file:
+        file.write(data)
+    return sha256
+
+
+def output_path(root, filename):
+    return os.path.join(os.path.abspath(root), filename.lstrip("/"))
+
+
+def read_feed(jsonpath):
+    with open_feed(jsonpath) as jsonlines:
+        for itemjson in jsonlines:
+            yield json.loads(itemjson)
+
+
+def print_summary(summary):
+    for status, letter in [("added", "A"), ("changed", "M"), ("removed", "D")]:
+        for filename in summary[status]:
+            print(f"{letter} {filename}")
+    print(
+        ", ".join(f"{len(summary[status])} {status}" for status in summary)
+    )
 
 
 def main():
-    [jsonpath, output_dir] = sys.argv[1:]
-    builder_ = Builder(output_dir)
+    parser = argparse.ArgumentParser(description="Build the mirror from a crawl feed")
+    parser.add_argument("jsonpath")
+    parser.add_argument("output_dir")
+    parser.add_argument(
+        "--keep-removed",
+        action="store_true",
+        help="don't delete pages missing from the feed, e.g. for a partial crawl",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="worker processes to render and write pages with",
+    )
+    args = parser.parse_args()
+    builder_ = Builder(args.output_dir)
+    builder_.load_manifest()
     try:
-        with open(jsonpath, "r") as jsonlines:
-            for itemjson in jsonlines.readlines():
-                item = json.loads(itemjson)
+        if args.jobs > 1:
+            builder_.write_pages(read_feed(args.jsonpath), args.jobs)
+        else:
+            for item in read_feed(args.jsonpath):
                 builder_.handle_item(item)
+        print_summary(builder_.finish(keep_removed=args.keep_removed))
     except:
         type, value, tb = sys.exc_info()
         traceback.print_exc()
@@ -0,0 +1,278 @@
+"""
+Replay the responses in the HTTP cache through a spider and its item
+pipelines without touching the network, and report how fast that went.
+
+    scrapy replay [mfma] [--limit N] [-a NAME=VALUE]
+
+Pipelines that download and archive files (MediaPipelines) are swapped for
+a stub that only counts the FileItems they would have archived.
+"""
+
+from collections import defaultdict
+from mfma.httpcache import SqliteCacheStorage
+from mfma.items import FileItem
+from scrapy.commands import ScrapyCommand
+from scrapy.exceptions import DropItem, UsageError
+from scrapy.http import Headers, HtmlResponse, Request
+from scrapy.pipelines.media import MediaPipeline
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.conf import arglist_to_dict, build_component_list
+from scrapy.utils.misc import create_instance, load_object
+from scrapy.utils.project import data_path
+from w3lib.http import headers_raw_to_dict
+import gzip
+import logging
+import os
+import pickle
+import resource
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+STUB_PIPELINE = "mfma.commands.replay.StubFileArchivePipeline"
+
+
+class StubFileArchivePipeline(object):
+    """Stands in for an archive pipeline, counting what it would archive"""
+
+    def __init__(self):
+        self.files = 0
+
+    def process_item(self, item, spider):
+        if isinstance(item, FileItem):
+            self.files += 1
+        return item
+
+
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_LEVEL": "WARNING"}
+
+    def syntax(self):
+        return "[options] [spider]"
+
+    def short_desc(self):
+        return "Replay the HTTP cache through a spider and its item pipelines"
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option("-a", dest="spargs", action="append", default=[],
+                          metavar="NAME=VALUE",
+                          help="set spider argument (may be repeated)")
+        parser.add_option("--limit", dest="limit", type="int", default=None,
+                          help="stop after this many cached responses")
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+        try:
+            opts.spargs = arglist_to_dict(opts.spargs)
+        except ValueError:
+            raise UsageError("Invalid -a value, use -a NAME=VALUE", print_help=False)
+        # Parse every cached listing row rather than what the crawl state
+        # says changed since the last crawl
+        opts.spargs.setdefault("full_recrawl", "true")
+        pipelines = stub_archive_pipelines(self.settings.getwithbase("ITEM_PIPELINES"))
+        self.settings.set("ITEM_PIPELINES", pipelines, priority="cmdline")
+
+    def run(self, args, opts):
+        if len(args) > 1:
+            raise UsageError()
+        spidername = args[0] if args else "mfma"
+        crawler = self.crawler_process.create_crawler(spidername)
+        crawler.spider = crawler._create_spider(**opts.spargs)
+
+        replay = Replay(crawler)
+        replay.run(cached_responses(crawler.settings, crawler.spider, opts.limit))
+        print(replay.report())
+
+
+class Replay(object):
+    """
+    Feed responses to spider.parse and each item through the pipelines,
+    timing every spider callback and pipeline on the way.
+    """
+
+    callbacks = ["parse", "scrape_menu", "page_item"]
+
+    def __init__(self, crawler):
+        self.spider = crawler.spider
+        self.pipelines = [
+            create_instance(load_object(path), crawler.settings, crawler)
+            for path in build_component_list(
+                crawler.settings.getwithbase("ITEM_PIPELINES")
+            )
+        ]
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counts = defaultdict(int)
+        self.elapsed = 0
+
+        for name in self.callbacks:
+            if hasattr(self.spider, name):
+                setattr(self.spider, name, self.timed_callback(name))
+
+    def timed_callback(self, name):
+        callback = getattr(self.spider, name)
+
+        def timed(*args, **kwargs):
+            self.calls[name] += 1
+            started = time.perf_counter()
+            results = iter(callback(*args, **kwargs) or [])
+            self.seconds[name] += time.perf_counter() - started
+            while True:
+                started = time.perf_counter()
+                try:
+                    result = next(results)
+                except StopIteration:
+                    return
+                finally:
+                    self.seconds[name] += time.perf_counter() - started
+                yield result
+
+        return timed
+
+    def run(self, responses):
+        started = time.perf_counter()
+        for pipeline in self.pipelines:
+            if hasattr(pipeline, "open_spider"):
+                pipeline.open_spider(self.spider)
+
+        for response in responses:
+            self.counts["pages"] += 1
+            try:
+                for result in self.spider.parse(response):
+                    if isinstance(result, Request):
+                        self.counts["requests"] += 1
+                    else:
+                        self.counts["items"] += 1
+                        self.counts[type(result).__name__] += 1
+                        self.process_item(result)
+            except Exception:
+                self.counts["errors"] += 1
+                logger.exception("Spider error processing %s", response)
+
+        for pipeline in self.pipelines:
+            if hasattr(pipeline, "close_spider"):
+                pipeline.close_spider(self.spider)
+        self.elapsed = time.perf_counter() - started
+
+    def process_item(self, item):
+        for pipeline in self.pipelines:
+            name = type(pipeline).__name__
+            self.calls[name] += 1
+            started = time.perf_counter()
+            try:
+                item = pipeline.process_item(item, self.spider)
+            except DropItem:
+                self.counts["dropped"] += 1
+                return
+            except Exception:
+                self.counts["errors"] += 1
+                logger.exception("Error processing %s", item)
+                return
+            finally:
+                self.seconds[name] += time.perf_counter() - started
+
+    def report(self):
+        elapsed = self.elapsed or float("nan")
+        pages = self.counts["pages"]
+        items = self.counts["items"]
+        lines = [
+            f"pages:      {pages:>10} {pages / elapsed:10.1f}/s",
+            f"items:      {items:>10} {items / elapsed:10.1f}/s",
+            f"requests:   {self.counts['requests']:>10}",
+            f"errors:     {self.counts['errors']:>10}",
+            f"elapsed:    {self.elapsed:10.2f}s",
+            f"peak RSS:   {peak_rss() / 1024:10.1f}MiB",
+            "",
+            "parse includes the scrape_menu and page_item time below it",
+            f"{'':30} {'calls':>8} {'total s':>10} {'ms/call':>10}",
+        ]
+        names = [name for name in self.callbacks if name in self.calls]
+        names += [type(pipeline).__name__ for pipeline in self.pipelines]
+        for name in names:
+            if not self.calls[name]:
+                continue
+            calls = self.calls[name]
+            seconds = self.seconds[name]
+            lines.append(
+                f"{name:30} {calls:8} {seconds:10.3f} {seconds / calls * 1000:10.3f}"
+            )
+        return "\n".join(lines)
+
+
+def stub_archive_pipelines(pipelines):
+    """Replace MediaPipelines, which would hit the network, with the stub"""
+    stubbed = {}
+    for path, order in pipelines.items():
+        if order is not None and issubclass(load_object(path), MediaPipeline):
+            stubbed[path] = None
+            stubbed[STUB_PIPELINE] = order
+        else:
+            stubbed[path] = order
+    return stubbed
+
+
+def cached_responses(settings, spider, limit=None):
+    """
+    Yield the HTML responses the HTTP cache storage stored for spider,
+    oldest first, ignoring expiry.
+    """
+    if issubclass(load_object(settings["HTTPCACHE_STORAGE"]), SqliteCacheStorage):
+        responses = sqlite_cached_responses(settings, spider)
+    else:
+        responses = filesystem_cached_responses(settings, spider)
+    count = 0
+    for response in responses:
+        if limit is not None and count >= limit:
+            return
+        if response.status != 200 or not isinstance(response, HtmlResponse):
+            continue
+        count += 1
+        yield response
+
+
+def sqlite_cached_responses(settings, spider):
+    storage = SqliteCacheStorage(settings)
+    # Not open_spider, which would evict expired responses
+    storage.open(os.path.join(storage.cachedir, f"{spider.name}.sqlite"))
+    try:
+        yield from storage.responses()
+    finally:
+        storage.db.close()
+
+
+def filesystem_cached_responses(settings, spider):
+    cachedir = os.path.join(data_path(settings["HTTPCACHE_DIR"]), spider.name)
+    _open = gzip.open if settings.getbool("HTTPCACHE_GZIP") else open
+
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(cachedir):
+        if "pickled_meta" in filenames:
+            with _open(os.path.join(dirpath, "pickled_meta"), "rb") as f:
+                metadata = pickle.load(f)
+            entries.append((metadata["timestamp"], dirpath, metadata))
+    entries.sort(key=lambda entry: entry[0])
+
+    for timestamp, rpath, metadata in entries:
+        with _open(os.path.join(rpath, "response_body"), "rb") as f:
+            body = f.read()
+        with _open(os.path.join(rpath, "response_headers"), "rb") as f:
+            rawheaders = f.read()
+        url = metadata.get("response_url") or metadata["url"]
+        headers = Headers(headers_raw_to_dict(rawheaders))
+        respcls = responsetypes.from_args(headers=headers, url=url)
+        yield respcls(
+            url=url,
+            headers=headers,
+            status=metadata["status"],
+            body=body,
+            request=Request(metadata["url"]),
+        )
+
+
+def peak_rss():
+    """Peak resident set size of this process in KiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
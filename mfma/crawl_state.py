@@ -0,0 +1,70 @@
+from mfma.disk_cache import DiskCache
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlState(object):
+    """
+    The SharePoint "Modified" date of each document library row, folder or
+    file, as of the last successful crawl, keyed by the row's path.
+
+    Rows seen during a crawl are staged and only written by commit(), once
+    the crawl has finished, so an interrupted crawl leaves the state as it
+    was. A folder is left out of the commit if anything under it failed, so
+    an unchanged folder isn't skipped before its failed subtree is retried.
+
+    With a job (see mfma.jobs), what's staged is kept in it too, so a
+    resumed crawl commits what the crawl it resumed saw.
+    """
+
+    def __init__(self, name="crawl-state", job=None):
+        self.cache = DiskCache(name)
+        self.job = job
+        self.staged = {}
+        self.failures = set()
+
+    def load(self):
+        self.cache.load()
+        if self.job is not None and self.job.resuming:
+            self.staged, self.failures = self.job.staged_rows()
+            logger.info(
+                "Crawl state resumed with %d rows seen, %d failures",
+                len(self.staged), len(self.failures),
+            )
+
+    def unchanged(self, path, modified):
+        return self.cache.get(path) == modified
+
+    def seen(self, path, modified):
+        self.staged[path] = modified
+        if self.job is not None:
+            self.job.stage_row(path, modified)
+
+    def failed(self, path):
+        self.failures.add(path)
+        if self.job is not None:
+            self.job.stage_failure(path)
+
+    def commit(self):
+        committed = 0
+        for path, modified in self.staged.items():
+            if any(is_within(failure, path) for failure in self.failures):
+                continue
+            self.cache.put(path, modified)
+            committed += 1
+        self.cache.flush()
+        logger.info(
+            "Crawl state committed %d of %d rows seen, %d failures",
+            committed, len(self.staged), len(self.failures),
+        )
+        self.staged = {}
+        self.failures = set()
+
+    def close(self):
+        self.cache.close()
+
+
+def is_within(path, folder):
+    return path == folder or path.startswith(folder.rstrip("/") + "/")
@@ -0,0 +1,286 @@
+"""
+A feed of what changed since the last successful crawl.
+
+DeltaFeed keeps a fingerprint of each page, menu and file item of the last
+successful crawl, keyed by type and path: a short hash of each of the
+item's fields. Each item scraped is compared with it, and the items added
+or changed are written to the delta feed as they're scraped, a line each:
+
+    {"change": "added", "type": "page", "path": ..., "item": {...}}
+    {"change": "changed", "type": "page", "path": ..., "fields": {...}}
+
+where fields are the changed fields' new values, null for a field the item
+no longer has. When the crawl finishes, the items it didn't see and that
+are gone from the site follow as
+
+    {"change": "removed", "type": "file", "path": ...}
+
+and the index is updated. The crawl doesn't request unchanged folders (see
+mfma.crawl_state), so an item it didn't see is only removed if neither it
+nor a folder it's in was listed by a page the crawl did see. A partial
+crawl (see MfmaSpider.partial) removes nothing, nor does an incomplete
+listing (see DepaginatingPipeline) remove what's in its folder.
+
+The delta feed is DELTA_FEED, by default <feed>.delta.jsonlines next to the
+first local feed, or in the project data dir without one. What's scraped is
+staged in the index until the crawl finishes, so an interrupted crawl
+leaves it as it was, and a resumed one (see mfma.jobs) carries on
+appending to its delta feed. The delta feed is flushed to disk before
+what's staged is committed, so a resumed crawl doesn't skip changes that
+were staged but not written.
+"""
+
+from mfma.extensions import local_feed_path
+from mfma.jobs import Job
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.project import project_data_dir
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import urllib.parse
+
+
+logger = logging.getLogger(__name__)
+
+
+COMMIT_EVERY = 200
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS items "
+    "(key TEXT PRIMARY KEY, type TEXT NOT NULL, path TEXT, fields TEXT NOT NULL)",
+    # What the crawl in progress has scraped and the rows its pages listed
+    "CREATE TABLE IF NOT EXISTS staged "
+    "(key TEXT PRIMARY KEY, type TEXT NOT NULL, path TEXT, fields TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS listed (path TEXT PRIMARY KEY)",
+]
+
+
+class FingerprintIndex(object):
+    def __init__(self, name="delta-index", commit_every=COMMIT_EVERY, before_commit=None):
+        self.path = os.path.join(project_data_dir(), name + ".sqlite")
+        self.commit_every = commit_every
+        # Called before what's staged is committed
+        self.before_commit = before_commit
+        self.db = None
+        self.uncommitted = 0
+
+    def open(self, resuming=False):
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        if not resuming:
+            self.db.execute("DELETE FROM staged")
+            self.db.execute("DELETE FROM listed")
+        self.db.commit()
+
+    def close(self):
+        self.commit_staged()
+        self.db.close()
+
+    def commit_staged(self):
+        if self.before_commit is not None:
+            self.before_commit()
+        self.db.commit()
+        self.uncommitted = 0
+
+    def fields(self, key, table="items"):
+        """The item's field hashes, or None if it isn't in the table"""
+        row = self.db.execute(
+            f"SELECT fields FROM {table} WHERE key = ?", (key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def stage(self, key, type, path, fields, listed):
+        self.db.execute(
+            "INSERT OR REPLACE INTO staged (key, type, path, fields) VALUES (?, ?, ?, ?)",
+            (key, type, path, json.dumps(fields, sort_keys=True)),
+        )
+        self.db.executemany(
+            "INSERT OR IGNORE INTO listed (path) VALUES (?)", [(p,) for p in listed]
+        )
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit_staged()
+
+    def unseen(self):
+        """(type, path) of the items in the index the crawl hasn't scraped"""
+        return self.db.execute(
+            "SELECT type, path FROM items WHERE key NOT IN (SELECT key FROM staged)"
+        ).fetchall()
+
+    def listed(self):
+        return {path for (path,) in self.db.execute("SELECT path FROM listed")}
+
+    def staged_paths(self):
+        return {
+            path for (path,) in self.db.execute(
+                "SELECT path FROM staged WHERE type = 'page'"
+            )
+        }
+
+    def commit(self, removed):
+        """Replace the index with what was staged, less the removed items"""
+        self.db.execute(
+            "INSERT OR REPLACE INTO items (key, type, path, fields) "
+            "SELECT key, type, path, fields FROM staged"
+        )
+        self.db.executemany(
+            "DELETE FROM items WHERE key = ?",
+            [(item_key(type, path),) for type, path in removed],
+        )
+        self.db.execute("DELETE FROM staged")
+        self.db.execute("DELETE FROM listed")
+        self.commit_staged()
+
+
+class DeltaFeed(object):
+    def __init__(self, crawler, path=None, job=None):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.path = path
+        self.job = job
+        self.index = FingerprintIndex(before_commit=self.flush)
+        self.file = None
+        # Folders of listings that are missing pages
+        self.incomplete = set()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool("DELTA_FEED_ENABLED"):
+            raise NotConfigured
+        extension = cls(
+            crawler,
+            path=crawler.settings.get("DELTA_FEED"),
+            job=Job.from_crawler(crawler),
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        resuming = self.job is not None and self.job.resuming
+        self.index.open(resuming)
+        path = self.delta_feed_path(spider)
+        self.file = open(path, "a" if resuming else "w", encoding="utf-8")
+        logger.info("Writing changes since the last crawl to %s", path)
+
+    def delta_feed_path(self, spider):
+        if self.path:
+            return self.path
+        feed = local_feed_path(self.crawler.settings)
+        if feed:
+            return feed + ".delta.jsonlines"
+        directory = os.path.join(project_data_dir(), "deltas")
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, spider.name + ".delta.jsonlines")
+
+    def item_scraped(self, item, response, spider):
+        item = dict(item)
+        type = item.get("type")
+        path = item.get("path")
+        key = item_key(type, path)
+        if item.get("incomplete") and path:
+            self.incomplete.add(normalise(path))
+        fields = fingerprint(item)
+        if self.index.fields(key, "staged") == fields:
+            # Already written by the crawl this one resumed
+            return
+        previous = self.index.fields(key)
+        if previous is None:
+            self.write({"change": "added", "type": type, "path": path, "item": item})
+            self.stats.inc_value("delta/added")
+        elif previous != fields:
+            changed = {
+                name: item.get(name)
+                for name in set(previous) | set(fields)
+                if previous.get(name) != fields.get(name)
+            }
+            self.write({"change": "changed", "type": type, "path": path, "fields": changed})
+            self.stats.inc_value("delta/changed")
+        else:
+            self.stats.inc_value("delta/unchanged")
+        # After writing the change, which a resumed crawl would skip once
+        # it's staged
+        self.index.stage(key, type, path, fields, listed_paths(item))
+
+    def spider_closed(self, spider, reason):
+        if reason == "finished":
+            removed = [] if getattr(spider, "partial", False) else self.removed()
+            for type, path in removed:
+                self.write({"change": "removed", "type": type, "path": path})
+            self.stats.set_value("delta/removed", len(removed))
+            self.index.commit(removed)
+            logger.info("Fingerprint index updated, %d items removed", len(removed))
+        else:
+            logger.info("Fingerprint index not updated, crawl %s", reason)
+        self.index.close()
+        self.file.close()
+
+    def removed(self):
+        """
+        The pages and files in the index that the crawl didn't see, nor a
+        page list them or a folder they're in
+        """
+        listed = self.index.listed()
+        # Folders listed but not crawled because they hadn't changed
+        skipped = listed - {normalise(path) for path in self.index.staged_paths()}
+        removed = []
+        for type, path in self.index.unseen():
+            if type not in ("page", "file") or path is None:
+                continue
+            normalised = normalise(path)
+            if normalised in listed or any(
+                folder in skipped or folder in self.incomplete
+                for folder in ancestors(normalised)
+            ):
+                continue
+            removed.append((type, path))
+        return sorted(removed)
+
+    def write(self, change):
+        self.file.write(json.dumps(change, sort_keys=True) + "\n")
+
+    def flush(self):
+        """Flush the delta feed to disk"""
+        if self.file is None or self.file.closed:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+
+def item_key(type, path):
+    return f"{type}:{path or ''}"
+
+
+def fingerprint(item):
+    """A short hash of each of the item's fields"""
+    return {
+        name: hashlib.sha1(
+            json.dumps(value, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:16]
+        for name, value in item.items()
+    }
+
+
+def normalise(path):
+    return urllib.parse.unquote(path).rstrip("/")
+
+
+def listed_paths(item):
+    return {
+        normalise(row["path"]) for row in item.get("form_table_rows") or []
+        if row.get("path")
+    }
+
+
+def ancestors(path):
+    """The folders path is in, innermost first"""
+    while "/" in path:
+        path = path.rsplit("/", 1)[0]
+        if path:
+            yield path
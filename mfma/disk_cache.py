@@ -1,7 +1,10 @@
+from collections import OrderedDict
+from mfma import metrics
 from scrapy.utils.project import project_data_dir
 import hashlib
 import logging
 import os
+import sqlite3
 from os.path import exists
 
 
@@ -9,33 +12,143 @@ logger = logging.getLogger(__name__)
 
 
 class DiskCache(object):
-    def __init__(self, name):
+    """
+    A string to string cache in a single SQLite file in the project data dir.
+
+    Reads go through an in-memory LRU, which load() fills in one query.
+    Writes go to memory straight away and to disk in batches of commit_every,
+    and whatever is left on flush() or close().
+
+    Keys are stored by their sha256 so that the one-file-per-key directory
+    this replaced can be migrated without knowing its keys.
+    """
+
+    def __init__(self, name, commit_every=200, lru_size=100000):
         self.name = name
-        self.cachedir = os.path.join(project_data_dir(), name)
-        if not exists(self.cachedir):
-            os.makedirs(self.cachedir)
+        self.commit_every = commit_every
+        self.lru_size = lru_size
+        self.lru = OrderedDict()
+        self.pending = {}
+        # True once every row on disk is in the LRU, so a miss is a miss
+        self.complete = False
+
+        datadir = project_data_dir()
+        self.path = os.path.join(datadir, name + ".sqlite")
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(hash TEXT PRIMARY KEY, value TEXT NOT NULL) WITHOUT ROWID"
+        )
+        self.db.commit()
+
+        legacy_dir = os.path.join(datadir, name)
+        if exists(legacy_dir):
+            self.migrate(legacy_dir)
+
+    def load(self):
+        """Read the whole cache into memory, as much as fits in the LRU"""
+        rows = self.db.execute(
+            "SELECT hash, value FROM cache LIMIT ?", (self.lru_size + 1,)
+        ).fetchall()
+        self.complete = len(rows) <= self.lru_size
+        for hash, value in rows[:self.lru_size]:
+            self.lru[hash] = value
+        logger.info("Cache %s loaded %d entries", self.name, len(self.lru))
 
     def get(self, key):
-        path = self.prepare_path(key)
-        if not exists(path):
-            logger.info("Cache %s miss %s", self.name, key)
-            return None
+        hash = key_hash(key)
+        if hash in self.lru:
+            self.lru.move_to_end(hash)
+            value = self.lru[hash]
+        elif hash in self.pending:
+            # Pushed out of the LRU before it was written, or deleted
+            value = self.pending[hash]
+            if value is not None:
+                self.remember(hash, value)
+        elif self.complete:
+            value = None
+        else:
+            row = self.db.execute(
+                "SELECT value FROM cache WHERE hash = ?", (hash,)
+            ).fetchone()
+            value = row[0] if row else None
+            if value is not None:
+                self.remember(hash, value)
+
+        if value is None:
+            logger.debug("Cache %s miss %s", self.name, key)
+            metrics.inc("disk_cache_lookups_total", cache=self.name, result="miss")
         else:
-            with open(path) as f:
-                value = f.read()
-                logger.info("Cache %s hit %s %r", self.name, key, value)
-                return value
+            logger.debug("Cache %s hit %s", self.name, key)
+            metrics.inc("disk_cache_lookups_total", cache=self.name, result="hit")
+        return value
 
     def put(self, key, value):
-        logger.info("Cache %s update %s %r", self.name, key, value)
-        path = self.prepare_path(key)
-        with open(path, 'w') as f:
-            f.write(value)
-
-    def prepare_path(self, key):
-        filename = hashlib.sha256(key.encode('utf8')).hexdigest()
-        pathdir = os.path.join(self.cachedir, filename[:2])
-        if not exists(pathdir):
-            os.makedirs(pathdir)
-        path = os.path.join(pathdir, filename)
-        return path
+        hash = key_hash(key)
+        if self.lru.get(hash) == value:
+            return
+        logger.debug("Cache %s update %s", self.name, key)
+        self.remember(hash, value)
+        self.pending[hash] = value
+        if len(self.pending) >= self.commit_every:
+            self.flush()
+
+    def delete(self, key):
+        hash = key_hash(key)
+        logger.debug("Cache %s delete %s", self.name, key)
+        self.lru.pop(hash, None)
+        self.pending[hash] = None
+        if len(self.pending) >= self.commit_every:
+            self.flush()
+
+    def remember(self, hash, value):
+        self.lru[hash] = value
+        self.lru.move_to_end(hash)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+            self.complete = False
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO cache (hash, value) VALUES (?, ?)",
+                [(hash, value) for hash, value in self.pending.items() if value is not None],
+            )
+            self.db.executemany(
+                "DELETE FROM cache WHERE hash = ?",
+                [(hash,) for hash, value in self.pending.items() if value is None],
+            )
+        self.pending = {}
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def migrate(self, legacy_dir):
+        """
+        Import the old layout of one file per key named by the key's sha256
+        under two-character shard directories, then move it out of the way.
+        """
+        logger.info("Cache %s migrating %s", self.name, legacy_dir)
+        rows = []
+        for shard in os.listdir(legacy_dir):
+            shard_dir = os.path.join(legacy_dir, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for hash in os.listdir(shard_dir):
+                with open(os.path.join(shard_dir, hash)) as f:
+                    rows.append((hash, f.read()))
+        with self.db:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO cache (hash, value) VALUES (?, ?)", rows
+            )
+        os.rename(legacy_dir, legacy_dir + ".migrated")
+        logger.info("Cache %s migrated %d entries", self.name, len(rows))
+
+
+def key_hash(key):
+    return hashlib.sha256(key.encode('utf8')).hexdigest()
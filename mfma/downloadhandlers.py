@@ -0,0 +1,42 @@
+"""
+Scrapy's HTTP download handler, writing the body of a response to the file
+in its request's 'spool' meta, if any, instead of holding it in memory.
+FileArchivePipeline sets it once the headers of a big file arrive, so the
+file is still downloaded by Scrapy, through its middlewares and download
+slots, without being read into memory.
+"""
+
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler, ScrapyAgent
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class SpoolingHTTPDownloadHandler(HTTP11DownloadHandler):
+    def download_request(self, request, spider):
+        agent = SpoolingAgent(
+            contextFactory=self._contextFactory,
+            pool=self._pool,
+            maxsize=getattr(spider, 'download_maxsize', self._default_maxsize),
+            warnsize=getattr(spider, 'download_warnsize', self._default_warnsize),
+            fail_on_dataloss=self._fail_on_dataloss,
+            crawler=self._crawler,
+        )
+        return agent.download_request(request)
+
+
+class SpoolingAgent(ScrapyAgent):
+    def _cb_bodyready(self, txresponse, request):
+        deliver_body = txresponse.deliverBody
+
+        def deliver_to_spool(reader):
+            # After headers_received, which sets the spool
+            spool = request.meta.get('spool')
+            if spool is not None:
+                # In place of the reader's BytesIO
+                reader._bodybuf = spool
+            deliver_body(reader)
+
+        txresponse.deliverBody = deliver_to_spool
+        return super()._cb_bodyready(txresponse, request)
@@ -0,0 +1,98 @@
+"""
+SharePoint serves the same page at many URLs: /Pages/Default.aspx and
+/pages/DEFAULT.aspx (its paths aren't case sensitive), a document library's
+Forms/AllItems.aspx?RootFolder=... and its folder path, with or without
+FolderCTID, a View or the ribbon's InitialTabId and VisibilityContext.
+CanonicalDupeFilter fingerprints requests by their canonical URL, worked
+out the way the spider maps URLs to mirror paths, so each page is only
+fetched once.
+"""
+
+from functools import lru_cache
+from mfma.spiders.mfma_spider import dedotnet, fix_forms_url, is_forms_url
+from scrapy.dupefilters import RFPDupeFilter
+from scrapy.utils.job import job_dir
+from scrapy.utils.request import request_fingerprint
+import logging
+import urllib.parse
+
+
+logger = logging.getLogger(__name__)
+
+# Query parameters that don't change the page served
+IGNORED_PARAMETERS = {"RootFolder", "FolderCTID", "View", "InitialTabId", "VisibilityContext"}
+# Index pages, as dedotnet leaves them in lower case
+INDEX_PAGES = ("/pages/default", "/forms/allitems")
+
+
+class CanonicalDupeFilter(RFPDupeFilter):
+    def __init__(self, path=None, debug=False, stats=None):
+        super().__init__(path, debug)
+        self.stats = stats
+        # canonical fingerprint: the URL first requested with it this run
+        self.first_urls = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        return cls(job_dir(settings), settings.getbool("DUPEFILTER_DEBUG"), crawler.stats)
+
+    def request_fingerprint(self, request):
+        return canonical_fingerprint(request)
+
+    def request_seen(self, request):
+        fp = self.request_fingerprint(request)
+        if fp not in self.fingerprints:
+            self.first_urls[fp] = request.url
+        elif self.redirected_from(request, fp):
+            # A redirect to another spelling of the page requested
+            return False
+        elif request.url != self.first_urls.get(fp, request.url):
+            self.stats.inc_value("dupefilter/canonical_duplicates")
+            if self.debug:
+                logger.debug(
+                    "%s is %s spelt differently", request.url, self.first_urls[fp]
+                )
+        return super().request_seen(request)
+
+    def redirected_from(self, request, fp):
+        return any(
+            self.request_fingerprint(request.replace(url=url)) == fp
+            for url in request.meta.get("redirect_urls", [])
+        )
+
+    def close(self, reason):
+        super().close(reason)
+        info = canonical_url.cache_info()
+        self.stats.set_value("dupefilter/canonical_url_cache_hits", info.hits)
+        self.stats.set_value("dupefilter/canonical_url_cache_misses", info.misses)
+
+
+def canonical_fingerprint(request):
+    return request_fingerprint(request.replace(url=canonical_url(request.url)))
+
+
+@lru_cache(maxsize=65536)
+def canonical_url(url):
+    """The same URL for every spelling of a page's URL"""
+    parsed = urllib.parse.urlsplit(url)
+    path = parsed.path
+    if is_forms_url(url):
+        path = urllib.parse.urlsplit(fix_forms_url(url)).path
+    path = urllib.parse.unquote(path).lower()
+    path = dedotnet(path, indexhtml=False, trailing_slash=False)
+    for index in INDEX_PAGES:
+        if path.endswith(index):
+            path = path[:-len(index)]
+    query = [
+        (name, value)
+        for name, value in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+        if name not in IGNORED_PARAMETERS
+    ]
+    return urllib.parse.urlunsplit((
+        parsed.scheme.lower(),
+        parsed.netloc.lower(),
+        urllib.parse.quote(path.rstrip("/") or "/"),
+        urllib.parse.urlencode(sorted(query)),
+        "",
+    ))
@@ -0,0 +1,172 @@
+"""
+MetricsExporter times the spider's callbacks, and writes those with
+mfma.metrics (items through the item pipelines, see mfma.pipelines.timing,
+archive sink calls, DiskCache hits and misses) and the crawl stats (bytes
+downloaded and uploaded per sink, among others) every METRICS_INTERVAL
+seconds and when the spider closes, as
+
+- <feed>.metrics.prom, in the Prometheus text format, e.g. for
+  node_exporter's textfile collector, and
+- <feed>.metrics.json, a summary,
+
+next to the first local feed, or under METRICS_DIR if that's set or there's
+no local feed.
+"""
+
+from mfma import metrics
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.extensions.throttle import AutoThrottle
+from scrapy.utils.project import project_data_dir
+from twisted.internet import task
+import datetime
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsExporter(object):
+    callbacks = ["parse", "scrape_menu", "page_item"]
+
+    def __init__(self, crawler, directory=None, interval=60.0):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.directory = directory
+        self.interval = interval
+        self.task = None
+        self.path_prefix = None
+        self.started = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured
+        extension = cls(
+            crawler,
+            directory=crawler.settings.get('METRICS_DIR'),
+            interval=crawler.settings.getfloat('METRICS_INTERVAL', 60.0),
+        )
+        crawler.signals.connect(extension.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(extension.spider_closed, signal=signals.spider_closed)
+        return extension
+
+    def spider_opened(self, spider):
+        metrics.REGISTRY.clear()
+        self.started = datetime.datetime.utcnow()
+        self.path_prefix = self.metrics_path_prefix(spider)
+        for name in self.callbacks:
+            if hasattr(spider, name):
+                setattr(spider, name, self.timed_callback(name, getattr(spider, name)))
+        if self.interval:
+            self.task = task.LoopingCall(self.write, spider)
+            self.task.start(self.interval, now=False)
+
+    def spider_closed(self, spider, reason):
+        if self.task and self.task.running:
+            self.task.stop()
+        self.write(spider, reason)
+
+    def metrics_path_prefix(self, spider):
+        """The first local feed's path, or one in METRICS_DIR"""
+        if not self.directory:
+            feed = local_feed_path(self.crawler.settings)
+            if feed:
+                return feed
+        directory = self.directory or os.path.join(project_data_dir(), 'metrics')
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, spider.name)
+
+    def timed_callback(self, name, callback):
+        """
+        Time each step of a callback's generator, so wall and CPU time spent
+        by the rest of the crawl in between isn't counted. A callback that
+        calls another includes its time.
+        """
+
+        def timed(*args, **kwargs):
+            metrics.inc('callback_calls_total', callback=name)
+            results = self.timed_step(name, lambda: iter(callback(*args, **kwargs) or []))
+            while True:
+                try:
+                    result = self.timed_step(name, lambda: next(results))
+                except StopIteration:
+                    return
+                yield result
+
+        return timed
+
+    def timed_step(self, name, step):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            return step()
+        finally:
+            metrics.inc('callback_seconds_total', time.perf_counter() - wall,
+                        callback=name, clock='wall')
+            metrics.inc('callback_seconds_total', time.thread_time() - cpu,
+                        callback=name, clock='cpu')
+
+    def write(self, spider, reason=None):
+        now = datetime.datetime.utcnow()
+        stats = {
+            name: value
+            for name, value in self.stats.get_stats().items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)
+        }
+        prom = metrics.REGISTRY.prometheus()
+        prom += "# TYPE mfma_crawl_stat gauge\n"
+        for name, value in sorted(stats.items()):
+            prom += 'mfma_crawl_stat{stat="%s"} %s\n' % (metrics.escape(name), value)
+        summary = {
+            "spider": spider.name,
+            "started": self.started.isoformat() + "Z",
+            "updated": now.isoformat() + "Z",
+            "elapsed_seconds": (now - self.started).total_seconds(),
+            "finish_reason": reason,
+            "crawl_stats": stats,
+        }
+        summary.update(metrics.REGISTRY.summary())
+        write_atomically(self.path_prefix + '.metrics.prom', prom)
+        write_atomically(
+            self.path_prefix + '.metrics.json', json.dumps(summary, indent=1, sort_keys=True)
+        )
+        logger.debug("Wrote metrics to %s.metrics.{prom,json}", self.path_prefix)
+
+
+class SlotAutoThrottle(AutoThrottle):
+    """
+    AutoThrottle that lets each download slot come down to the delay it was
+    set up with by DownloadSlotsMiddleware rather than DOWNLOAD_DELAY, so
+    slots configured to go faster than the rest still can.
+    """
+
+    def _adjust_delay(self, slot, latency, response):
+        mindelay = self.mindelay
+        self.mindelay = getattr(slot, 'mindelay', mindelay)
+        try:
+            super()._adjust_delay(slot, latency, response)
+        finally:
+            self.mindelay = mindelay
+
+
+def local_feed_path(settings):
+    """The path of the first feed written to a local file, or None"""
+    for uri in settings.getdict('FEEDS'):
+        uri = str(uri)
+        parsed = urllib.parse.urlparse(uri)
+        if parsed.scheme in ('', 'file') and '%(' not in uri:
+            return parsed.path if parsed.scheme else uri
+    return None
+
+
+def write_atomically(path, data):
+    """Replace path with data so a reader never sees a partial file"""
+    partial = path + '.partial'
+    with open(partial, 'w') as f:
+        f.write(data)
+    os.replace(partial, path)
@@ -0,0 +1,231 @@
+"""
+Compressed jsonlines feeds.
+
+Page items carry their whole body and table rows, so a crawl's feed is
+large, and every month's is kept. The jsonlines.gz and jsonlines.zst feed
+formats compress it as it's written, with gzip or, if the zstandard package
+is installed, zstd:
+
+    scrapy crawl mfma --output file://mfmacrawl.jsonlines.gz:jsonlines.gz
+
+The compressed stream is flushed every FEED_FLUSH_INTERVAL seconds, so an
+interrupted crawl loses at most that much of its feed. A resumed crawl
+appends another gzip member or zstd frame, which readers take as one
+stream.
+
+With a crawl job (see mfma.jobs), these and the jsonlines feed format are
+also flushed and synced to disk before each job commit, so the job doesn't
+record a page as done whose items an interruption kept from the feed.
+
+open_feed reads a feed as text whether it's compressed or not, going by its
+first bytes. truncate_partial_line removes what an interruption cut short
+from a compressed feed, before mfma.jobs resumes the crawl appending to it.
+"""
+
+from scrapy.exporters import JsonLinesItemExporter
+import abc
+import gzip
+import io
+import logging
+import os
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+
+FLUSH_INTERVAL = 30
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+READ_SIZE = 64 * 1024
+
+
+class SyncedJsonLinesItemExporter(JsonLinesItemExporter):
+    """Writes jsonlines, synced to disk before each commit of the crawl's job"""
+
+    def __init__(self, file, **kwargs):
+        super().__init__(file, **kwargs)
+        self.raw = file
+        self.exporting = False
+
+    @classmethod
+    def from_crawler(cls, crawler, file, **kwargs):
+        return cls(file, **kwargs).synced_with_job(crawler)
+
+    def synced_with_job(self, crawler):
+        # Imported here as mfma.jobs imports this module to resume feeds
+        from mfma.jobs import Job
+
+        job = Job.from_crawler(crawler)
+        if job is not None:
+            job.flush_before_commit(self.sync)
+        return self
+
+    def start_exporting(self):
+        self.exporting = True
+
+    def flush(self):
+        self.file.flush()
+
+    def sync(self):
+        """Flush what's been exported to disk, if the feed is still open"""
+        if not self.exporting:
+            return
+        self.flush()
+        try:
+            os.fsync(self.raw.fileno())
+        except (AttributeError, io.UnsupportedOperation):
+            pass
+
+    def finish_exporting(self):
+        self.exporting = False
+
+
+class CompressedJsonLinesItemExporter(SyncedJsonLinesItemExporter, metaclass=abc.ABCMeta):
+    """
+    Writes jsonlines through a compressor wrapping the feed's file, which
+    is left open for the feed storage to close.
+    """
+
+    def __init__(self, file, flush_interval=FLUSH_INTERVAL, **kwargs):
+        super().__init__(file, **kwargs)
+        self.flush_interval = flush_interval
+        self.last_flush = None
+
+    @classmethod
+    def from_crawler(cls, crawler, file, **kwargs):
+        exporter = cls(
+            file,
+            flush_interval=crawler.settings.getfloat("FEED_FLUSH_INTERVAL", FLUSH_INTERVAL),
+            **kwargs,
+        )
+        return exporter.synced_with_job(crawler)
+
+    @abc.abstractmethod
+    def compressor(self, file):
+        """A writable file object compressing into file, which it leaves open"""
+
+    def start_exporting(self):
+        super().start_exporting()
+        self.file = self.compressor(self.raw)
+        self.last_flush = time.monotonic()
+
+    def export_item(self, item):
+        super().export_item(item)
+        now = time.monotonic()
+        if now - self.last_flush >= self.flush_interval:
+            self.flush()
+            self.last_flush = now
+
+    def flush(self):
+        self.file.flush()
+        self.raw.flush()
+
+    def finish_exporting(self):
+        super().finish_exporting()
+        self.file.close()
+        self.file = self.raw
+
+
+class GzipJsonLinesItemExporter(CompressedJsonLinesItemExporter):
+    def compressor(self, file):
+        return gzip.GzipFile(fileobj=file, mode="wb", mtime=0)
+
+
+class ZstdJsonLinesItemExporter(CompressedJsonLinesItemExporter):
+    def __init__(self, file, **kwargs):
+        if zstandard is None:
+            raise ImportError("the jsonlines.zst feed format needs the zstandard package")
+        super().__init__(file, **kwargs)
+
+    def compressor(self, file):
+        return zstandard.ZstdCompressor(level=10).stream_writer(file, closefd=False)
+
+    def flush(self):
+        self.file.flush(zstandard.FLUSH_BLOCK)
+        self.raw.flush()
+
+
+def compression(path):
+    """"gzip", "zstd" or None, going by the file's first bytes"""
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic == ZSTD_MAGIC:
+        return "zstd"
+    return None
+
+
+def open_feed(path):
+    """The feed as a text file, decompressed as it's read"""
+    codec = compression(path)
+    if codec == "gzip":
+        return gzip.open(path, "rt", encoding="utf-8")
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError(f"reading {path} needs the zstandard package")
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(path, "rb"), read_across_frames=True, closefd=True
+        )
+        return io.TextIOWrapper(reader, encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def decompressed_chunks(path, codec):
+    """
+    The decompressed content of a feed that may have been cut short, up to
+    where it was cut
+    """
+    if codec == "gzip":
+        decompressor_for = lambda: zlib.decompressobj(wbits=31)
+        errors = zlib.error
+    else:
+        decompressor_for = zstandard.ZstdDecompressor().decompressobj
+        errors = zstandard.ZstdError
+    decompressor = decompressor_for()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(READ_SIZE), b""):
+            while data:
+                try:
+                    yield decompressor.decompress(data)
+                except errors:
+                    return
+                if not decompressor.eof:
+                    break
+                # The next gzip member or zstd frame
+                data = decompressor.unused_data
+                decompressor = decompressor_for()
+
+
+def truncate_partial_line(path, codec):
+    """
+    Rewrite a compressed feed with whatever follows its last whole line,
+    and whatever of the compressed stream was cut short, removed
+    """
+    tmp_path = path + ".tmp"
+    kept = 0
+    pending = b""
+    with open(tmp_path, "wb") as raw:
+        if codec == "gzip":
+            out = gzip.GzipFile(fileobj=raw, mode="wb", mtime=0)
+        else:
+            out = zstandard.ZstdCompressor(level=10).stream_writer(raw, closefd=False)
+        for chunk in decompressed_chunks(path, codec):
+            pending += chunk
+            newline = pending.rfind(b"\n")
+            if newline != -1:
+                out.write(pending[:newline + 1])
+                kept += newline + 1
+                pending = pending[newline + 1:]
+        out.close()
+    if pending:
+        logger.warning("Removing %d bytes of a partial line from %s", len(pending), path)
+    os.replace(tmp_path, path)
+    return kept
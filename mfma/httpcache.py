@@ -0,0 +1,296 @@
+"""
+An HTTP cache storage kept in one SQLite file per spider, in place of
+Scrapy's FilesystemCacheStorage, which writes six small files in a
+directory of their own for every response: slow on an SD card, and a lot
+of inodes.
+
+Response headers and bodies are compressed with zstd if the zstandard
+package is installed, else gzip. Entries older than HTTPCACHE_EXPIRATION_SECS
+and, past HTTPCACHE_MAX_SIZE bytes in total, the oldest entries are evicted
+when the spider opens and closes and as responses are stored.
+
+RevalidatingPolicy revalidates cached pages that have an ETag or
+Last-Modified with a conditional request each time they're requested, so an
+unchanged page costs only its headers, and reuses pages without either for
+HTTPCACHE_FRESHNESS_SECS. HTTPCACHE_EXPIRATION_SECS is then how long pages
+are kept to revalidate.
+
+Responses cached by FilesystemCacheStorage can be imported with
+
+    python -m mfma.httpcache import HTTPCACHE_DIR
+
+which adds each spider's directory under HTTPCACHE_DIR to its database
+there, keeping when each response was cached.
+"""
+
+from scrapy.extensions.httpcache import DummyPolicy, rfc1123_to_epoch
+from scrapy.http import Headers, Request
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path, get_project_settings
+from scrapy.utils.request import request_fingerprint
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+import gzip
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS responses ("
+    "fingerprint TEXT PRIMARY KEY, request_url TEXT NOT NULL, url TEXT NOT NULL, "
+    "status INTEGER NOT NULL, "
+    "codec TEXT NOT NULL, headers BLOB NOT NULL, body BLOB NOT NULL, "
+    "size INTEGER NOT NULL, timestamp REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS responses_timestamp ON responses (timestamp)",
+]
+# Evict down to this fraction of HTTPCACHE_MAX_SIZE, so it isn't done for
+# every response stored once the cache is full
+EVICT_TO = 0.9
+
+GZIP = "gzip"
+ZSTD = "zstd"
+
+
+def compress(data, codec):
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, mtime=0)
+
+
+def decompress(data, codec):
+    if codec == ZSTD:
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class SqliteCacheStorage(object):
+    def __init__(self, settings):
+        self.cachedir = data_path(settings["HTTPCACHE_DIR"])
+        self.expiration_secs = settings.getint("HTTPCACHE_EXPIRATION_SECS")
+        self.max_size = settings.getint("HTTPCACHE_MAX_SIZE")
+        self.codec = ZSTD if zstandard is not None else GZIP
+        self.db = None
+        # Compressed bytes in the cache
+        self.size = 0
+
+    def open_spider(self, spider):
+        os.makedirs(self.cachedir, exist_ok=True)
+        path = os.path.join(self.cachedir, f"{spider.name}.sqlite")
+        self.open(path)
+        self.evict()
+        logger.debug(
+            "Using SQLite cache storage in %(path)s, %(size)d bytes",
+            {"path": path, "size": self.size}, extra={"spider": spider},
+        )
+
+    def close_spider(self, spider):
+        self.evict()
+        self.db.commit()
+        self.db.execute("PRAGMA incremental_vacuum")
+        self.db.close()
+
+    def open(self, path):
+        self.db = sqlite3.connect(path)
+        # Set before the tables are created, so space freed by eviction can
+        # be given back to the file system
+        self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+        self.size = self.db.execute("SELECT coalesce(sum(size), 0) FROM responses").fetchone()[0]
+
+    def retrieve_response(self, spider, request):
+        """Return response if present in cache, or None otherwise."""
+        row = self.db.execute(
+            "SELECT url, status, codec, headers, body, timestamp FROM responses "
+            "WHERE fingerprint = ?",
+            (request_fingerprint(request),),
+        ).fetchone()
+        if row is None:
+            return None  # not cached
+        url, status, codec, headers, body, timestamp = row
+        if 0 < self.expiration_secs < time.time() - timestamp:
+            return None  # expired
+        return make_response(url, status, codec, headers, body)
+
+    def responses(self):
+        """Every cached response and its request, oldest first, expired or not"""
+        rows = self.db.execute(
+            "SELECT request_url, url, status, codec, headers, body FROM responses "
+            "ORDER BY timestamp"
+        )
+        for request_url, url, status, codec, headers, body in rows:
+            response = make_response(url, status, codec, headers, body)
+            yield response.replace(request=Request(request_url))
+
+    def store_response(self, spider, request, response):
+        """Store the given response in the cache."""
+        self.put(
+            request_fingerprint(request),
+            request.url,
+            response.url,
+            response.status,
+            headers_dict_to_raw(response.headers),
+            response.body,
+            time.time(),
+        )
+        self.db.commit()
+        if self.max_size and self.size > self.max_size:
+            self.evict()
+
+    def touch(self, spider, request):
+        """Restart the expiry of a response that's been revalidated"""
+        self.db.execute(
+            "UPDATE responses SET timestamp = ? WHERE fingerprint = ?",
+            (time.time(), request_fingerprint(request)),
+        )
+        self.db.commit()
+
+    def put(self, fingerprint, request_url, url, status, headers, body, timestamp):
+        headers = compress(headers or b"", self.codec)
+        body = compress(body, self.codec)
+        size = len(headers) + len(body)
+        old = self.db.execute(
+            "SELECT size FROM responses WHERE fingerprint = ?", (fingerprint,)
+        ).fetchone()
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses "
+            "(fingerprint, request_url, url, status, codec, headers, body, size, timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (fingerprint, request_url, url, status, self.codec, headers, body, size, timestamp),
+        )
+        self.size += size - (old[0] if old else 0)
+
+    def evict(self):
+        """Delete expired entries, then the oldest while it's over max_size"""
+        evicted = 0
+        if self.expiration_secs > 0:
+            evicted += self.delete(
+                "timestamp < ?", (time.time() - self.expiration_secs,)
+            )
+        if self.max_size and self.size > self.max_size:
+            # The newest entries that fit in EVICT_TO of max_size are kept
+            evicted += self.delete(
+                "timestamp <= (SELECT timestamp FROM ("
+                "SELECT timestamp, sum(size) OVER (ORDER BY timestamp DESC) AS kept "
+                "FROM responses) WHERE kept > ? ORDER BY timestamp DESC LIMIT 1)",
+                (self.max_size * EVICT_TO,),
+            )
+        if evicted:
+            self.db.commit()
+            logger.info("Evicted %d responses from the HTTP cache, %d bytes left", evicted, self.size)
+
+    def delete(self, where, args):
+        deleted, size = self.db.execute(
+            f"SELECT count(*), coalesce(sum(size), 0) FROM responses WHERE {where}", args
+        ).fetchone()
+        self.db.execute(f"DELETE FROM responses WHERE {where}", args)
+        self.size -= size
+        return deleted
+
+
+class RevalidatingPolicy(DummyPolicy):
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.freshness_secs = settings.getint("HTTPCACHE_FRESHNESS_SECS")
+
+    def should_cache_response(self, response, request):
+        return response.status != 304 and super().should_cache_response(response, request)
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        headers = cachedresponse.headers
+        if b"ETag" in headers or b"Last-Modified" in headers:
+            if b"ETag" in headers:
+                request.headers[b"If-None-Match"] = headers[b"ETag"]
+            if b"Last-Modified" in headers:
+                request.headers[b"If-Modified-Since"] = headers[b"Last-Modified"]
+            return False
+        # HttpCacheMiddleware dates responses the server didn't
+        date = rfc1123_to_epoch(headers.get(b"Date"))
+        return date is not None and time.time() - date < self.freshness_secs
+
+    def is_cached_response_valid(self, cachedresponse, response, request):
+        # The cached page will do if the server's having trouble
+        return response.status == 304 or response.status >= 500
+
+
+def make_response(url, status, codec, headers, body):
+    headers = Headers(headers_raw_to_dict(decompress(headers, codec)))
+    respcls = responsetypes.from_args(headers=headers, url=url)
+    return respcls(url=url, headers=headers, status=status, body=decompress(body, codec))
+
+
+def import_filesystem_cache(cachedir, settings):
+    """
+    Add the responses FilesystemCacheStorage cached under each spider's
+    directory in cachedir to that spider's database, returning how many
+    """
+    imported = 0
+    for spider_name in sorted(os.listdir(cachedir)):
+        spider_dir = os.path.join(cachedir, spider_name)
+        if not os.path.isdir(spider_dir):
+            continue
+        storage = SqliteCacheStorage(settings)
+        storage.open(os.path.join(cachedir, f"{spider_name}.sqlite"))
+        count = 0
+        for prefix in sorted(os.listdir(spider_dir)):
+            for fingerprint in sorted(os.listdir(os.path.join(spider_dir, prefix))):
+                rpath = os.path.join(spider_dir, prefix, fingerprint)
+                if import_response(storage, fingerprint, rpath):
+                    count += 1
+        storage.db.commit()
+        logger.info("Imported %d responses of spider %s", count, spider_name)
+        imported += count
+        storage.db.close()
+    return imported
+
+
+def import_response(storage, fingerprint, rpath):
+    metapath = os.path.join(rpath, "pickled_meta")
+    if not os.path.exists(metapath):
+        return False
+    metadata = pickle.loads(read_maybe_gzipped(metapath))
+    storage.put(
+        fingerprint,
+        metadata["url"],
+        metadata.get("response_url") or metadata["url"],
+        metadata["status"],
+        read_maybe_gzipped(os.path.join(rpath, "response_headers")),
+        read_maybe_gzipped(os.path.join(rpath, "response_body")),
+        # FilesystemCacheStorage expires entries by pickled_meta's mtime
+        os.stat(metapath).st_mtime,
+    )
+    return True
+
+
+def read_maybe_gzipped(path):
+    """The file's content, whether or not HTTPCACHE_GZIP was set"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:2] == b"\x1f\x8b":
+        return gzip.decompress(data)
+    return data
+
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] != "import":
+        sys.exit("usage: python -m mfma.httpcache import HTTPCACHE_DIR")
+    logging.basicConfig(level=logging.INFO)
+    print(import_filesystem_cache(sys.argv[2], get_project_settings()))
+
+
+if __name__ == "__main__":
+    main()
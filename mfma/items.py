@@ -22,9 +22,15 @@ class PageItem(scrapy.Item):
     body = scrapy.Field()
     form_table_rows = scrapy.Field()
     breadcrumbs = scrapy.Field()
+    # Set on every page of a paged listing but the last
+    more_pages = scrapy.Field()
+    # Set on a paged listing whose last page never came, with the rows of
+    # the pages that did
+    incomplete = scrapy.Field()
 
 
 class FileItem(scrapy.Item):
     type = scrapy.Field()
     original_url = scrapy.Field()
     path = scrapy.Field()
+    modified_date = scrapy.Field()
@@ -0,0 +1,300 @@
+"""
+Resumable crawls.
+
+With CRAWL_JOB_DIR set, the state of a crawl in progress is kept in a
+SQLite database there, committed every few seconds, so a crawl that's
+stopped, killed or loses power can be resumed where it got to:
+
+- the frontier: every page request the spider made, and whether its
+  response has been parsed, so a resumed crawl requests the pages that
+  weren't and skips those that were (ResumeMiddleware)
+- the pages of paged listings held back by DepaginatingPipeline
+- the files FileArchivePipeline was still archiving
+- the rows CrawlState has seen and failed, to commit when the resumed crawl
+  finishes
+
+A crawl that finishes clears it. Scrapy's JOBDIR isn't used because its
+queues are only written out on a clean shutdown. The feed is flushed to
+disk before each commit (see mfma.feeds), so a request is never done in the
+job without its items in the feed.
+
+bin/run.sh resumes an unfinished crawl, appending to its feed, with
+
+    python -m mfma.jobs prepare JOB_DIR NEW_FEED
+
+which prints the feed the crawl should write to: the unfinished crawl's,
+with any line cut short by the interruption removed, or NEW_FEED. A
+compressed feed (see mfma.feeds) is rewritten without it.
+"""
+
+from mfma import feeds
+from scrapy import signals
+from scrapy.utils.reqser import request_from_dict, request_to_dict
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+DATABASE = "job.sqlite"
+COMMIT_INTERVAL = 5
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT)",
+    # request is cleared once done, the fingerprint is enough to skip it
+    "CREATE TABLE IF NOT EXISTS frontier "
+    "(fingerprint TEXT PRIMARY KEY, request BLOB, done INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS held_pages "
+    "(path TEXT NOT NULL, page INTEGER NOT NULL, rows TEXT NOT NULL, "
+    "PRIMARY KEY (path, page))",
+    "CREATE TABLE IF NOT EXISTS files_in_flight (path TEXT PRIMARY KEY, item TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS crawl_state "
+    "(path TEXT PRIMARY KEY, modified TEXT, failed INTEGER NOT NULL DEFAULT 0)",
+]
+WORK_TABLES = ["frontier", "held_pages", "files_in_flight", "crawl_state"]
+
+NEW = "new"
+RUNNING = "running"
+FINISHED = "finished"
+
+
+class Job(object):
+    """
+    The crawl's state in CRAWL_JOB_DIR. One is shared by everything in a
+    crawler that keeps state there, see from_crawler.
+    """
+
+    def __init__(self, directory, commit_interval=COMMIT_INTERVAL):
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.db = None
+        self.resuming = False
+        self.last_commit = 0
+        # Called before each commit
+        self.flushes = []
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        """The crawler's job, opened on first use, or None without CRAWL_JOB_DIR"""
+        directory = crawler.settings.get("CRAWL_JOB_DIR")
+        if not directory:
+            return None
+        job = getattr(crawler, "job", None)
+        if job is None:
+            job = crawler.job = cls(directory)
+            job.open()
+            crawler.signals.connect(job.spider_closed, signal=signals.spider_closed)
+            crawler.stats.set_value("resume/resumed", int(job.resuming))
+        return job
+
+    def connect(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.directory, DATABASE))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def open(self):
+        """Resume an unfinished crawl, or start afresh"""
+        self.connect()
+        self.resuming = self.get("status") == RUNNING
+        if self.resuming:
+            pending, done = self.db.execute(
+                "SELECT count(*) - sum(done), sum(done) FROM frontier"
+            ).fetchone()
+            logger.info(
+                "Resuming crawl in %s: %s requests pending, %s done",
+                self.directory, pending, done,
+            )
+        else:
+            self.clear()
+        self.set("status", RUNNING)
+        self.db.commit()
+
+    def clear(self):
+        for table in WORK_TABLES:
+            self.db.execute(f"DELETE FROM {table}")
+
+    def spider_closed(self, spider, reason):
+        self.close(reason)
+
+    def close(self, reason):
+        if reason == "finished":
+            self.clear()
+            self.set("status", FINISHED)
+            logger.info("Crawl finished, cleared its state in %s", self.directory)
+        else:
+            logger.info("Crawl %s, can be resumed from %s", reason, self.directory)
+        self.commit()
+        if reason == "finished":
+            self.db.execute("VACUUM")
+        self.db.close()
+
+    def get(self, key):
+        row = self.db.execute("SELECT value FROM run WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO run (key, value) VALUES (?, ?)", (key, value))
+
+    def flush_before_commit(self, flush):
+        """Call flush before each commit, to write out what the job relies on"""
+        self.flushes.append(flush)
+
+    def commit(self):
+        for flush in self.flushes:
+            flush()
+        self.db.commit()
+        self.last_commit = time.monotonic()
+
+    def commit_soon(self):
+        """Commit if it's been commit_interval seconds since the last commit"""
+        if time.monotonic() - self.last_commit >= self.commit_interval:
+            self.commit()
+
+    # The frontier
+
+    def add_request(self, fingerprint, request, spider):
+        self.db.execute(
+            "INSERT OR IGNORE INTO frontier (fingerprint, request) VALUES (?, ?)",
+            (fingerprint, pickle.dumps(request_to_dict(request, spider), protocol=4)),
+        )
+
+    def request_done(self, fingerprint):
+        self.db.execute(
+            "INSERT OR REPLACE INTO frontier (fingerprint, request, done) VALUES (?, NULL, 1)",
+            (fingerprint,),
+        )
+
+    def is_done(self, fingerprint):
+        row = self.db.execute(
+            "SELECT done FROM frontier WHERE fingerprint = ?", (fingerprint,)
+        ).fetchone()
+        return bool(row and row[0])
+
+    def pending_requests(self, spider):
+        rows = self.db.execute("SELECT request FROM frontier WHERE done = 0").fetchall()
+        for (request,) in rows:
+            yield request_from_dict(pickle.loads(request), spider)
+
+    # DepaginatingPipeline's held pages
+
+    def hold_page(self, path, page, rows):
+        self.db.execute(
+            "INSERT OR REPLACE INTO held_pages (path, page, rows) VALUES (?, ?, ?)",
+            (path, page, json.dumps(rows)),
+        )
+
+    def release_pages(self, path):
+        self.db.execute("DELETE FROM held_pages WHERE path = ?", (path,))
+
+    def held_pages(self):
+        """(path, rows) of each held page, in order"""
+        rows = self.db.execute("SELECT path, rows FROM held_pages ORDER BY path, page")
+        for path, page_rows in rows.fetchall():
+            yield path, json.loads(page_rows)
+
+    # FileArchivePipeline's files in flight
+
+    def file_started(self, item):
+        self.db.execute(
+            "INSERT OR REPLACE INTO files_in_flight (path, item) VALUES (?, ?)",
+            (item["path"], json.dumps(dict(item))),
+        )
+
+    def file_finished(self, path):
+        self.db.execute("DELETE FROM files_in_flight WHERE path = ?", (path,))
+
+    def files_in_flight(self):
+        rows = self.db.execute("SELECT item FROM files_in_flight").fetchall()
+        return [json.loads(item) for (item,) in rows]
+
+    # CrawlState's staged rows and failures
+
+    def stage_row(self, path, modified):
+        self.db.execute(
+            "INSERT INTO crawl_state (path, modified) VALUES (?, ?) "
+            "ON CONFLICT (path) DO UPDATE SET modified = excluded.modified",
+            (path, modified),
+        )
+
+    def stage_failure(self, path):
+        self.db.execute(
+            "INSERT INTO crawl_state (path, failed) VALUES (?, 1) "
+            "ON CONFLICT (path) DO UPDATE SET failed = 1",
+            (path,),
+        )
+
+    def staged_rows(self):
+        """The rows seen and the paths failed so far"""
+        staged = {}
+        failures = set()
+        for path, modified, failed in self.db.execute(
+            "SELECT path, modified, failed FROM crawl_state"
+        ).fetchall():
+            if modified is not None:
+                staged[path] = modified
+            if failed:
+                failures.add(path)
+        return staged, failures
+
+
+def prepare(directory, new_feed):
+    """
+    The feed for the next crawl to write to: the unfinished crawl's, cut
+    back to its last whole line, or new_feed for a new crawl.
+    """
+    job = Job(directory)
+    job.connect()
+    try:
+        feed = job.get("feed")
+        if job.get("status") == RUNNING and feed and os.path.exists(feed):
+            codec = feeds.compression(feed)
+            if codec:
+                feeds.truncate_partial_line(feed, codec)
+            else:
+                truncate_partial_line(feed)
+            return feed
+        job.clear()
+        job.set("status", NEW)
+        job.set("feed", new_feed)
+        job.db.commit()
+        return new_feed
+    finally:
+        job.db.close()
+
+
+def truncate_partial_line(path):
+    """Remove whatever follows the last newline, a line cut short"""
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(end - 65536, 0)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end != size:
+            logger.warning("Removing %d bytes of a partial line from %s", size - end, path)
+            f.truncate(end)
+
+
+def main():
+    if len(sys.argv) != 4 or sys.argv[1] != "prepare":
+        sys.exit("usage: python -m mfma.jobs prepare JOB_DIR NEW_FEED")
+    print(prepare(sys.argv[2], sys.argv[3]))
+
+
+if __name__ == "__main__":
+    main()
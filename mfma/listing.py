@@ -0,0 +1,189 @@
+"""
+Rows of SharePoint document library listings.
+
+The spider used to find each row with a CSS query and a ../.. parent hop,
+then run an XPath query each for its label, link and modified date and a
+CSS query for its user, taking the first result of each. extract_rows
+finds the rows in one pass over the page's tables and walks each row's
+links, cells and nobrs once, picking out the same four values, into
+compact Row records that become dicts only when the page item is output.
+
+A listing view's table links to its XML data through owssvr.dll, for
+exporting it to a spreadsheet. list_data_url makes that the URL of every
+row of a folder in the view, and list_data_rows reads them into the same
+Row records, so a paged listing needn't be fetched 30 rows at a time.
+"""
+
+from lxml import etree
+import datetime
+import urllib.parse
+
+
+ROWSET = "{urn:schemas-microsoft-com:rowset}"
+ROW = "{#RowsetSchema}row"
+XML_PARSER = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=True)
+
+
+class Row(object):
+    __slots__ = ("label", "path", "modified_date", "user")
+
+    def __init__(self, label, path, modified_date, user):
+        self.label = label
+        self.path = path
+        self.modified_date = modified_date
+        self.user = user
+
+    def as_dict(self):
+        return {
+            "type": "table_form_item",
+            "label": self.label,
+            "path": self.path,
+            "modified_date": self.modified_date,
+            "user": self.user,
+        }
+
+
+def extract_rows(root):
+    """
+    The Row of each document library row under the lxml element root: the
+    tr holding a td of class ms-vb-title around a table of class
+    ms-unselectedtitle, as .ms-vb-title .ms-unselectedtitle and ../.. found it
+    """
+    for table in root.iter("table"):
+        if has_class(table, "ms-unselectedtitle"):
+            td = table.getparent()
+            if td is not None and has_class(td, "ms-vb-title"):
+                yield read_row(td.getparent())
+
+
+def read_row(tr):
+    """
+    The row's first link in a table nested in it, and that link's text, the
+    text of the first nobr in a td of class ms-vb2, and the text in the
+    elements of its ms-vb-user cells, as .//tr/td/a, .//td[@class="ms-vb2"]
+    /nobr/text() and .ms-vb-user *::text found them
+    """
+    label = href = modified_date = None
+    user = []
+    # Only these tags' elements are made into python objects
+    for element in tr.iterdescendants("a", "nobr", "td"):
+        tag = element.tag
+        if tag == "a":
+            if label is None or href is None:
+                td = element.getparent()
+                if td.tag == "td" and td.getparent() is not tr and td.getparent().tag == "tr":
+                    if href is None:
+                        href = element.get("href")
+                    if label is None:
+                        label = first_text(element)
+        elif tag == "nobr":
+            if modified_date is None:
+                td = element.getparent()
+                if td.tag == "td" and td.get("class") == "ms-vb2":
+                    modified_date = first_text(element)
+        elif has_class(element, "ms-vb-user"):
+            for child in element:
+                if isinstance(child.tag, str):
+                    element_texts(child, user)
+    if label is None or href is None or modified_date is None:
+        raise ValueError("Document library row without a link, its text or a modified date")
+    return Row(label, get_row_link_path(href), modified_date, " ".join(user).strip())
+
+
+def has_class(element, name):
+    classes = element.get("class")
+    return classes is not None and name in classes.split()
+
+
+def first_text(element):
+    """The element's first text node, as text()[0] would find it"""
+    if element.text:
+        return element.text
+    for child in element:
+        if child.tail:
+            return child.tail
+    return None
+
+
+def element_texts(element, out):
+    """Append the text nodes in element and the elements in it"""
+    if element.text:
+        out.append(element.text)
+    for child in element:
+        if isinstance(child.tag, str):
+            element_texts(child, out)
+        if child.tail:
+            out.append(child.tail)
+
+
+def list_data_url(root, folder):
+    """
+    The owssvr.dll URL of the XML data of all of the folder's rows in the
+    listing view under the lxml element root, or None if it doesn't link to
+    its data
+    """
+    for table in root.iter("table"):
+        href = table.get("o:webquerysourcehref")
+        if href and "owssvr.dll" in href:
+            parts = urllib.parse.urlsplit(href)
+            query = [
+                (name, value)
+                for name, value in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+                if name not in ("RowLimit", "RootFolder")
+            ]
+            query += [("RowLimit", "0"), ("RootFolder", folder)]
+            return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+    return None
+
+
+def list_data_rows(body):
+    """
+    The Row of each z:row of owssvr.dll XML data. ValueError if body isn't
+    list data, or a row lacks its path or modified date.
+    """
+    try:
+        root = etree.fromstring(body, XML_PARSER)
+    except etree.XMLSyntaxError as e:
+        raise ValueError(f"Not XML: {e}")
+    data = root.find(ROWSET + "data")
+    if data is None:
+        raise ValueError("No rs:data in the XML")
+    return [list_data_row(element) for element in data.iter(ROW)]
+
+
+def list_data_row(element):
+    file_ref = lookup_value(element.get("ows_FileRef"))
+    modified = element.get("ows_Modified")
+    if not file_ref or not modified:
+        raise ValueError("List data row without ows_FileRef or ows_Modified")
+    path = "/" + file_ref.lstrip("/")
+    label = lookup_value(element.get("ows_LinkFilename") or element.get("ows_FileLeafRef"))
+    user = lookup_value(element.get("ows_Editor"))
+    return Row(label or path.rsplit("/", 1)[-1], path, list_data_date(modified), user or "")
+
+
+def lookup_value(value):
+    """The value of a lookup or user field's "id;#value", or of an expanded "id;#value,#..." """
+    if value is None:
+        return None
+    return value.split(";#", 1)[-1].split(",#", 1)[0]
+
+
+def list_data_date(value):
+    """The "6/24/2010 10:07 AM" a listing shows for list data's "2010-06-24 10:07:00" """
+    when = datetime.datetime.strptime(value.replace("T", " "), "%Y-%m-%d %H:%M:%S")
+    hour = when.hour % 12 or 12
+    meridiem = "AM" if when.hour < 12 else "PM"
+    return f"{when.month}/{when.day}/{when.year} {hour}:{when.minute:02d} {meridiem}"
+
+
+def get_row_link_path(row_href):
+    if "RootFolder" in row_href:
+        return decode_url_root_folder(row_href)
+    else:
+        return urllib.parse.unquote(row_href)
+
+
+def decode_url_root_folder(url):
+    querystring = urllib.parse.urlsplit(url).query
+    return urllib.parse.parse_qs(querystring)["RootFolder"][0]
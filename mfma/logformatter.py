@@ -0,0 +1,23 @@
+"""
+Scrapy's LogFormatter, but listing pages held back by DepaginatingPipeline
+are logged briefly at DEBUG, rather than as dropped items at WARNING with
+the whole item.
+"""
+
+from mfma.pipelines import HeldPage
+from scrapy import logformatter
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class LogFormatter(logformatter.LogFormatter):
+    def dropped(self, item, exception, response, spider):
+        if isinstance(exception, HeldPage):
+            return {
+                "level": logging.DEBUG,
+                "msg": "%(exception)s",
+                "args": {"exception": exception},
+            }
+        return super().dropped(item, exception, response, spider)
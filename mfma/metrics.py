@@ -0,0 +1,136 @@
+"""
+Process-wide counters and latency histograms for the parts of a crawl that
+have no crawler to hand, like DiskCache and the sinks' thread pools, written
+out by mfma.extensions.MetricsExporter.
+
+Calls come from the reactor thread and the upload threads, so updates are
+made under a lock.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+
+# Upper bounds in seconds, from a cache lookup to an upload of a large file
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+
+class Histogram(object):
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        # The last count is for observations above the last bucket
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """(upper bound, observations at or below it) for each bucket"""
+        total = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Registry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, ((label, value), ...)): number
+        self.counters = {}
+        # (name, ((label, value), ...)): Histogram
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def clear(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def prometheus(self, prefix="mfma_"):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {prefix}{name} counter")
+                    typed.add(name)
+                lines.append(f"{prefix}{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append(f"# TYPE {prefix}{name} histogram")
+                    typed.add(name)
+                for bound, count in histogram.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    bucket_labels = labels + (("le", le),)
+                    lines.append(
+                        f"{prefix}{name}_bucket{format_labels(bucket_labels)} {count}"
+                    )
+                lines.append(f"{prefix}{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{prefix}{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """The metrics as JSON serialisable lists, one entry per label set"""
+        with self.lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, []).append(dict(labels, value=value))
+            histograms = {}
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                histograms.setdefault(name, []).append(dict(
+                    labels,
+                    count=histogram.count,
+                    sum=histogram.sum,
+                    mean=histogram.sum / histogram.count,
+                    buckets={
+                        "+Inf" if bound == float("inf") else str(bound): count
+                        for bound, count in histogram.cumulative()
+                    },
+                ))
+        return {"counters": counters, "histograms": histograms}
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, escape(str(value))) for name, value in labels
+    )
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = Registry()
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+timer = REGISTRY.time
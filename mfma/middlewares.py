@@ -0,0 +1,227 @@
+from mfma import bandwidth
+from mfma.dupefilters import canonical_fingerprint
+from mfma.jobs import Job
+from scrapy import signals
+from scrapy.core.downloader import Slot
+from scrapy.downloadermiddlewares.httpcache import HttpCacheMiddleware
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request
+from twisted.internet import reactor, task
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+PAGES = "pages"
+REVALIDATIONS = "revalidations"
+FILES = "files"
+
+
+class DownloadSlotsMiddleware(object):
+    """
+    Puts HTML pages, conditional requests for files that are already
+    archived, and full file downloads in their own download slots, each with
+    the concurrency and delay set for it in DOWNLOAD_SLOTS, so a run of big
+    files doesn't hold up finding the rest of the site and cheap 304s don't
+    wait as long as downloads.
+
+    Pages come first: while the scheduler still has pages to fetch, full
+    file downloads are limited to their discovery_concurrency, and archiving
+    gets its full concurrency once the site is mapped.
+    """
+
+    def __init__(self, crawler, slots):
+        self.crawler = crawler
+        self.slots = slots
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        slots = crawler.settings.getdict('DOWNLOAD_SLOTS')
+        if not slots:
+            raise NotConfigured('DOWNLOAD_SLOTS is not set')
+        return cls(crawler, slots)
+
+    def process_request(self, request, spider):
+        name = slot_name(request)
+        if name not in self.slots:
+            return None
+        request.meta['download_slot'] = name
+        slot = self.slot(name, spider)
+        if name == FILES:
+            slot.concurrency = self.files_concurrency()
+        return None
+
+    def slot(self, name, spider):
+        """
+        The downloader's slot, created with this slot's settings. Idle
+        slots are dropped by the downloader, so this can happen again.
+        """
+        downloader = self.crawler.engine.downloader
+        slot = downloader.slots.get(name)
+        if slot is None:
+            config = self.slots[name]
+            delay = config.get('delay', self.crawler.settings.getfloat('DOWNLOAD_DELAY'))
+            slot = downloader.slots[name] = Slot(
+                config.get('concurrency', 1),
+                delay,
+                config.get('randomize_delay', downloader.randomize_delay),
+            )
+            # The least delay AutoThrottle may bring this slot down to
+            slot.mindelay = delay
+            logger.debug(
+                "Download slot %s: concurrency %d, delay %.2fs",
+                name, slot.concurrency, slot.delay,
+            )
+        return slot
+
+    def files_concurrency(self):
+        config = self.slots[FILES]
+        concurrency = config.get('concurrency', 1)
+        scheduler = self.crawler.engine.slot.scheduler
+        if scheduler.has_pending_requests():
+            return min(concurrency, config.get('discovery_concurrency', concurrency))
+        return concurrency
+
+
+def slot_name(request):
+    if not request.meta.get('file_archive'):
+        return PAGES
+    if 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers:
+        return REVALIDATIONS
+    return FILES
+
+
+class BandwidthMiddleware(object):
+    """
+    Counts the bytes of each page and file Scrapy downloads against their
+    bandwidth budget, and holds requests back while it's in debt, see
+    mfma.bandwidth. It comes after the HTTP cache, so cached pages aren't
+    held back.
+    """
+
+    def __init__(self, budgets):
+        self.budgets = budgets
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        middleware = cls(bandwidth.Bandwidth.from_crawler(crawler))
+        crawler.signals.connect(middleware.bytes_received, signal=signals.bytes_received)
+        return middleware
+
+    def process_request(self, request, spider):
+        bucket = self.budgets[bandwidth_budget(request)]
+        delay = bucket.delay()
+        if not delay:
+            return None
+        bucket.waited(delay)
+        return task.deferLater(reactor, delay, lambda: None)
+
+    def bytes_received(self, data, request, spider):
+        self.budgets[bandwidth_budget(request)].take(len(data))
+
+
+def bandwidth_budget(request):
+    if slot_name(request) == PAGES:
+        return bandwidth.PAGES
+    return bandwidth.FILES
+
+
+class RevalidatingCacheMiddleware(HttpCacheMiddleware):
+    """
+    Scrapy's HttpCacheMiddleware, counting the pages that were revalidated
+    (a 304, replaying the cached page) and fully downloaded, and restarting
+    the expiry of revalidated pages in the cache. For
+    mfma.httpcache.RevalidatingPolicy and SqliteCacheStorage.
+    """
+
+    def process_response(self, request, response, spider):
+        cachedresponse = request.meta.get('cached_response')
+        result = super().process_response(request, response, spider)
+        if request.meta.get('dont_cache') or 'cached' in response.flags:
+            return result
+        if response.status == 304 and result is cachedresponse:
+            self.stats.inc_value('httpcache/pages_revalidated', spider=spider)
+            self.stats.inc_value(
+                'httpcache/revalidated_bytes_saved', len(cachedresponse.body), spider=spider
+            )
+            self.storage.touch(spider, request)
+        elif response.status == 200:
+            self.stats.inc_value('httpcache/pages_downloaded', spider=spider)
+        return result
+
+
+class ResumeMiddleware(object):
+    """
+    Records the page requests the spider makes in the crawl's job, and each
+    response once it's been parsed, so a resumed crawl starts from the
+    requests that weren't done instead of the start URLs, and doesn't
+    request pages that were again. See mfma.jobs.
+
+    A response is only done once every item parsed from it has been
+    through the pipelines, and so handed to the feed, which the job flushes
+    before it commits. Items still in the pipelines (held back, or being
+    archived) when the crawl stops are parsed again when it resumes.
+    """
+
+    def __init__(self, job, stats):
+        self.job = job
+        self.stats = stats
+        # response: [items not through the pipelines yet, whether the
+        # spider has finished parsing it]
+        self.parsing = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        job = Job.from_crawler(crawler)
+        if job is None:
+            raise NotConfigured('CRAWL_JOB_DIR is not set')
+        middleware = cls(job, crawler.stats)
+        for signal in (signals.item_scraped, signals.item_dropped, signals.item_error):
+            crawler.signals.connect(middleware.item_processed, signal=signal)
+        return middleware
+
+    def process_start_requests(self, start_requests, spider):
+        if self.job.resuming:
+            for request in self.job.pending_requests(spider):
+                self.stats.inc_value('resume/requests_restored')
+                yield request
+            return
+        for request in start_requests:
+            self.job.add_request(canonical_fingerprint(request), request, spider)
+            yield request
+
+    def process_spider_output(self, response, result, spider):
+        parsing = self.parsing[response] = [0, False]
+        for x in result:
+            if isinstance(x, Request):
+                fingerprint = canonical_fingerprint(x)
+                if self.job.is_done(fingerprint):
+                    self.stats.inc_value('resume/requests_skipped_done')
+                    continue
+                self.job.add_request(fingerprint, x, spider)
+            else:
+                parsing[0] += 1
+            yield x
+        parsing[1] = True
+        self.parsed(response)
+
+    def item_processed(self, item, response, spider, **kwargs):
+        parsing = self.parsing.get(response)
+        if parsing is not None:
+            parsing[0] -= 1
+            self.parsed(response)
+
+    def parsed(self, response):
+        items, finished = self.parsing[response]
+        if items or not finished:
+            return
+        del self.parsing[response]
+        if response.request is not None:
+            self.done(response.request)
+        self.job.commit_soon()
+
+    def done(self, request):
+        self.job.request_done(canonical_fingerprint(request))
+        for url in request.meta.get('redirect_urls', []):
+            self.job.request_done(canonical_fingerprint(request.replace(url=url)))
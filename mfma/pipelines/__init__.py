@@ -1,25 +1,218 @@
 # -*- coding: utf-8 -*-
 
-from mfma.items import FileItem
+from mfma import metrics
+from mfma.items import FileItem, PageItem
+from mfma.jobs import Job
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider, DropItem
+from scrapy.http import Request
+import json
 import logging
+import tempfile
 
 
 logger = logging.getLogger(__name__)
 
 
+DEFAULT_MEMORY_ROWS = 10000
+
+
+class HeldPage(DropItem):
+    """
+    A listing page held back by DepaginatingPipeline. mfma.logformatter logs
+    these at DEBUG rather than as dropped items.
+    """
+
+
 class DepaginatingPipeline(object):
     """
-    Last page item wins, so overwrite page with this page plus previous page's
-    table items
+    A document library listing is split across pages, each a page item with
+    the same path and more_pages set on all but the last. The pages of a
+    listing are held back, and once its last page arrives a single page item
+    is emitted: the last page with every page's table rows, in order.
+
+    Held rows are kept in memory up to memory_rows in total, past which the
+    listings holding the most are spilled to temporary files in spill_dir.
+    With a job, held pages are also kept in it, for a resumed crawl to carry
+    on from.
+
+    Listings still held once the crawl has nothing left to do never got
+    their last page, because it failed. Rather than lose the pages that
+    came, each is emitted with their rows and incomplete set.
     """
 
-    def __init__(self):
-        self.page_rows = {}
+    def __init__(self, stats, memory_rows=DEFAULT_MEMORY_ROWS, spill_dir=None, job=None):
+        self.stats = stats
+        self.memory_rows = memory_rows
+        self.spill_dir = spill_dir
+        self.job = job
+        # path: Listing of the pages held back so far
+        self.listings = {}
+        self.crawler = None
+        self.emitting_incomplete = False
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        pipeline = cls(
+            crawler.stats,
+            memory_rows=crawler.settings.getint(
+                'DEPAGINATE_MEMORY_ROWS', DEFAULT_MEMORY_ROWS
+            ),
+            spill_dir=crawler.settings.get('DEPAGINATE_SPILL_DIR'),
+            job=Job.from_crawler(crawler),
+        )
+        pipeline.crawler = crawler
+        crawler.signals.connect(pipeline.spider_idle, signal=signals.spider_idle)
+        return pipeline
+
+    def open_spider(self, spider):
+        if self.job is None or not self.job.resuming:
+            return
+        for path, rows in self.job.held_pages():
+            listing = self.listings.get(path)
+            if listing is None:
+                listing = self.listings[path] = Listing(self.spill_dir)
+                self.stats.inc_value('resume/listings_restored')
+            listing.add(rows)
+        self.held_changed()
+        self.spill()
+
+    def close_spider(self, spider):
+        for path, listing in self.listings.items():
+            if self.job is None:
+                logger.warning(
+                    "Listing %s never got its last page, dropped %d pages",
+                    path, listing.pages,
+                )
+                self.stats.inc_value('depaginate/incomplete_listings')
+            listing.close()
+        self.listings = {}
 
     def process_item(self, item, spider):
-        if item['type'] == 'page':
-            rows = self.page_rows.get(item['path'], [])
-            rows.extend(item['form_table_rows'])
-            item['form_table_rows'] = rows
-            self.page_rows[item['path']] = rows
-        return item
+        with metrics.timer('pipeline_seconds', pipeline='DepaginatingPipeline', method='process_item'):
+            if item['type'] != 'page':
+                return item
+            more_pages = item.pop('more_pages', False)
+            listing = self.listings.get(item['path'])
+            if listing is None and not more_pages:
+                return item
+
+            if listing is None:
+                listing = self.listings[item['path']] = Listing(self.spill_dir)
+            listing.add(item['form_table_rows'], page=item)
+            if self.job is not None:
+                self.job.hold_page(item['path'], listing.pages, item['form_table_rows'])
+            self.stats.inc_value('depaginate/pages_held')
+            self.held_changed()
+
+            if more_pages:
+                self.spill()
+                raise HeldPage(
+                    "Holding page %d of listing %s" % (listing.pages, item['path'])
+                )
+
+            del self.listings[item['path']]
+            if self.job is not None:
+                self.job.release_pages(item['path'])
+            item['form_table_rows'] = listing.rows()
+            listing.close()
+            self.held_changed()
+            self.stats.inc_value('depaginate/listings_merged')
+            logger.debug("Merged %d pages of listing %s", listing.pages, item['path'])
+            return item
+
+    def spider_idle(self, spider):
+        if not self.listings or self.emitting_incomplete:
+            return
+        # Items can only be emitted from a callback, so make a request for one
+        self.emitting_incomplete = True
+        request = Request(
+            'data:,',
+            callback=self.incomplete_listings,
+            dont_filter=True,
+            meta={'dont_cache': True, 'dont_obey_robotstxt': True},
+        )
+        self.crawler.engine.crawl(request, spider)
+        raise DontCloseSpider
+
+    def incomplete_listings(self, response):
+        """A page item of each listing still held, with the rows it has"""
+        for path in list(self.listings):
+            listing = self.listings.pop(path)
+            item = PageItem(listing.page or {'type': 'page', 'path': path})
+            item['form_table_rows'] = listing.rows()
+            item['incomplete'] = True
+            listing.close()
+            if self.job is not None:
+                self.job.release_pages(path)
+            logger.warning(
+                "Listing %s never got its last page, emitting its %d pages",
+                path, listing.pages,
+            )
+            self.stats.inc_value('depaginate/incomplete_listings')
+            yield item
+        self.held_changed()
+
+    def held_changed(self):
+        held = sum(listing.size for listing in self.listings.values())
+        self.stats.set_value('depaginate/rows_held', held)
+        self.stats.max_value('depaginate/rows_held_max', held)
+
+    def spill(self):
+        in_memory = sum(len(listing.memory) for listing in self.listings.values())
+        self.stats.max_value('depaginate/rows_in_memory_max', in_memory)
+        while in_memory > self.memory_rows:
+            listing = max(self.listings.values(), key=lambda l: len(l.memory))
+            spilled = listing.spill()
+            self.stats.inc_value('depaginate/rows_spilled', spilled)
+            in_memory -= spilled
+
+
+class Listing(object):
+    """The rows of the pages of a listing held back so far"""
+
+    def __init__(self, spill_dir=None):
+        self.spill_dir = spill_dir
+        self.pages = 0
+        self.size = 0
+        self.memory = []
+        # Rows spilled to disk, one json object per line, all before memory
+        self.file = None
+        # The fields of the last page held but its rows, if known
+        self.page = None
+
+    def add(self, rows, page=None):
+        if page is not None:
+            self.page = {
+                name: value for name, value in page.items()
+                if name not in ('form_table_rows', 'more_pages')
+            }
+        self.pages += 1
+        self.size += len(rows)
+        self.memory.extend(rows)
+
+    def spill(self):
+        """Write the rows in memory to the spill file, return how many"""
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(
+                'w+', encoding='utf-8', dir=self.spill_dir, suffix='.depaginate'
+            )
+        for row in self.memory:
+            self.file.write(json.dumps(row) + '\n')
+        spilled = len(self.memory)
+        self.memory = []
+        return spilled
+
+    def rows(self):
+        rows = []
+        if self.file is not None:
+            self.file.seek(0)
+            rows.extend(json.loads(line) for line in self.file)
+        rows.extend(self.memory)
+        return rows
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.memory = []
@@ -0,0 +1,460 @@
+# 1. ask every sink what it has archived for the file
+# 2. request the file once, conditional on the strongest validator every
+#    sink's copy shares
+# 3. if it changed, hand the body to every sink, which uploads it unless
+#    its own copy is already current
+#
+# Sinks are listed in FILE_ARCHIVE_SINKS. Each implements
+#
+#    open(spider) and close(spider)
+#    archived(item) -> Archived, None if not archived, or a Deferred of either
+#    store(item, response, body, archived) -> None or a Deferred
+#
+# and can raise NotConfigured from from_crawler to disable itself.
+#
+# Files bigger than FILE_ARCHIVE_SPOOL_THRESHOLD (or of unknown size) aren't
+# read into memory: once their headers arrive, Scrapy writes the rest of the
+# body to a spool file on disk instead (see mfma.downloadhandlers), which
+# sinks upload in parts. Spool files are removed once every sink is done
+# with them, and any left behind by a crash when the spider next opens.
+
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+from io import BytesIO
+from mfma import metrics
+from mfma.disk_cache import DiskCache
+from mfma.items import FileItem
+from mfma.jobs import Job
+from scrapy import signals
+from scrapy.exceptions import DropItem, NotConfigured
+from scrapy.http import Request
+from scrapy.pipelines.media import MediaPipeline
+from scrapy.utils.misc import create_instance, load_object
+from scrapy.utils.project import project_data_dir
+from scrapy.utils.request import referer_str
+from twisted.internet.defer import DeferredList, maybeDeferred
+from twisted.web.iweb import UNKNOWN_LENGTH
+import hashlib
+import logging
+import os
+import tempfile
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_SPOOL_THRESHOLD = 8 * 1024 * 1024
+DEFAULT_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+SPOOL_CHUNK_SIZE = 64 * 1024
+
+
+class Archived(namedtuple('Archived', ['etag', 'last_modified'])):
+    """The upstream validators of a sink's copy of a file"""
+
+    def is_current(self, etag, last_modified):
+        if self.etag and etag:
+            return self.etag == etag
+        return bool(self.last_modified) and self.last_modified == last_modified
+
+
+class Body(object):
+    """
+    A downloaded file, either in memory or spooled to a file on disk, and the
+    sha256 of its content
+    """
+
+    def __init__(self, data=None, path=None, sha256=None):
+        self.data = data
+        self.path = path
+        self.size = len(data) if path is None else os.path.getsize(path)
+        if sha256 is None:
+            sha256 = hashlib.sha256()
+            with self.open() as f:
+                for chunk in iter(lambda: f.read(SPOOL_CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+            sha256 = sha256.hexdigest()
+        self.sha256 = sha256
+
+    @property
+    def spooled(self):
+        return self.path is not None
+
+    def open(self):
+        if self.path is None:
+            return BytesIO(self.data)
+        return open(self.path, 'rb')
+
+    def cleanup(self):
+        self.data = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class Spool(object):
+    """
+    A file body being written to disk as it downloads, hashed on the way,
+    in place of the download handler's in-memory buffer
+    """
+
+    def __init__(self, directory):
+        fd, self.path = tempfile.mkstemp(suffix='.spool', dir=directory)
+        self.file = os.fdopen(fd, 'wb')
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.file.write(data)
+
+    def getvalue(self):
+        # The response's body, which is on disk instead
+        return b''
+
+    def truncate(self, size=None):
+        # The download is cancelled, past DOWNLOAD_MAXSIZE
+        self.discard()
+
+    def body(self):
+        self.file.close()
+        return Body(path=self.path, sha256=self.sha256.hexdigest())
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ContentIndex(object):
+    """
+    Maps the sha256 of each file a sink holds to the key it holds it under,
+    in a cache next to the sink's etag cache, so the same bytes published
+    under another path can be copied within the sink instead of uploaded
+    again. Bytes saved that way are counted in the crawl stats.
+
+    Each key's sha256 is kept too, so that when a key is stored with new
+    content its old content no longer maps to it. Sinks still check the
+    source's sha256 metadata before copying, for changes made elsewhere.
+    """
+
+    def __init__(self, name, stats):
+        self.name = name
+        self.stats = stats
+        self.cache = DiskCache(name + '-content')
+        self.keys = DiskCache(name + '-content-keys')
+        self.copies = 0
+        self.bytes_saved = 0
+
+    def load(self):
+        self.cache.load()
+        self.keys.load()
+
+    def close(self):
+        logger.info(
+            "%s deduplicated %d files, saving %d bytes of uploads",
+            self.name, self.copies, self.bytes_saved,
+        )
+        self.cache.close()
+        self.keys.close()
+
+    def get(self, sha256):
+        key = self.cache.get(sha256)
+        if key is None:
+            return None
+        stored = self.keys.get(key)
+        if stored is not None and stored != sha256:
+            # The key has been stored with other content since
+            return None
+        return key
+
+    def put(self, sha256, key):
+        previous = self.keys.get(key)
+        if previous is not None and previous != sha256 and self.cache.get(previous) == key:
+            self.cache.delete(previous)
+        self.cache.put(sha256, key)
+        self.keys.put(key, sha256)
+
+    def copied(self, size):
+        self.copies += 1
+        self.bytes_saved += size
+        self.stats.inc_value(f'file_archive/{self.name}/dedup_copies')
+        self.stats.inc_value(f'file_archive/{self.name}/dedup_bytes_saved', size)
+
+
+class FileArchivePipeline(MediaPipeline):
+    def __init__(self, sinks, stats, spool_dir=None,
+                 spool_threshold=DEFAULT_SPOOL_THRESHOLD, job=None):
+        self.download_func = None  # A MediaPipeline expected attribute
+        self.handle_httpstatus_list = None  # A MediaPipeline expected attribute
+        self.sinks = sinks
+        self.stats = stats
+        self.spool_dir = spool_dir
+        self.spool_threshold = spool_threshold
+        # Files in flight are kept in the job, if any, for a resumed crawl
+        # to archive
+        self.job = job
+        # What each sink has archived, looked up in process_item for
+        # get_media_requests to use
+        self.archived = {}
+        # Bytes of file bodies held in memory until every sink is done
+        self.in_memory = 0
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        cls.crawler = crawler # a MediaPipeline expectation
+        sinks = []
+        for path in crawler.settings.getlist('FILE_ARCHIVE_SINKS'):
+            try:
+                sinks.append(create_instance(load_object(path), crawler.settings, crawler))
+            except NotConfigured as e:
+                logger.warning("Disabled file archive sink %s: %s", path, e)
+        pipeline = cls(
+            sinks,
+            crawler.stats,
+            spool_dir=(
+                crawler.settings.get('FILE_ARCHIVE_SPOOL_DIR')
+                or os.path.join(project_data_dir(), 'file-archive-spool')
+            ),
+            spool_threshold=crawler.settings.getint(
+                'FILE_ARCHIVE_SPOOL_THRESHOLD', DEFAULT_SPOOL_THRESHOLD
+            ),
+            job=Job.from_crawler(crawler),
+        )
+        crawler.signals.connect(pipeline.headers_received, signal=signals.headers_received)
+        return pipeline
+
+    def open_spider(self, spider):
+        super(FileArchivePipeline, self).open_spider(spider)
+        if self.spool_dir:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self.remove_spool_files()
+        dfd = self.each_sink('open', spider)
+        if self.job is not None and self.job.resuming:
+            dfd.addCallback(self.resume, spider)
+        return dfd
+
+    def resume(self, result, spider):
+        """
+        Archive the files that were in flight when the crawl stopped, and
+        signal how it went as the scraper would have, for the crawl state
+        and the feed.
+        """
+        for fields in self.job.files_in_flight():
+            item = FileItem(fields)
+            logger.info("Resuming archiving %s", item['path'])
+            self.stats.inc_value('resume/files_restored')
+            self.process_item(item, spider).addCallbacks(
+                self.resumed, self.resume_failed,
+                callbackArgs=(spider,), errbackArgs=(item, spider),
+            )
+        return result
+
+    def resumed(self, item, spider):
+        self.crawler.signals.send_catch_log(
+            signals.item_scraped, item=item, response=None, spider=spider
+        )
+
+    def resume_failed(self, failure, item, spider):
+        if failure.check(DropItem):
+            logger.warning("Dropped resumed %s: %s", item['path'], failure.value)
+            self.crawler.signals.send_catch_log(
+                signals.item_dropped, item=item, response=None, spider=spider,
+                exception=failure.value,
+            )
+        else:
+            log_failure(f"Error archiving resumed {item['path']}", failure)
+
+    def close_spider(self, spider):
+        def closed(result):
+            if self.spool_dir:
+                self.remove_spool_files()
+            return result
+
+        return self.each_sink('close', spider).addBoth(closed)
+
+    def remove_spool_files(self):
+        for name in os.listdir(self.spool_dir):
+            if name.endswith('.spool'):
+                logger.info("Removing spool file %s", name)
+                os.remove(os.path.join(self.spool_dir, name))
+
+    def each_sink(self, method, *args):
+        dlist = [maybeDeferred(getattr(sink, method), *args) for sink in self.sinks]
+        return DeferredList(dlist, fireOnOneErrback=True, consumeErrors=True)
+
+    def process_item(self, item, spider):
+        if not isinstance(item, FileItem):
+            return item
+        if not self.sinks:
+            # Not scraped, so the crawl state doesn't count it as archived
+            raise DropItem(f"No file archive sinks to archive {item['path']}")
+        dlist = [maybeDeferred(sink.archived, item) for sink in self.sinks]
+        if self.job is not None:
+            self.job.file_started(item)
+
+        def process(results):
+            archived = []
+            for sink, (success, result) in zip(self.sinks, results):
+                if success:
+                    archived.append(result)
+                else:
+                    log_failure(f"Error checking {type(sink).__name__} for {item['path']}", result)
+                    archived.append(None)
+            self.archived[item['path']] = archived
+            return super(FileArchivePipeline, self).process_item(item, spider)
+
+        def finished(result):
+            if self.job is not None:
+                self.job.file_finished(item['path'])
+            return result
+
+        return DeferredList(dlist, consumeErrors=True).addCallback(process).addBoth(finished)
+
+    def get_media_requests(self, item, info):
+        with metrics.timer('pipeline_seconds', pipeline='FileArchivePipeline', method='get_media_requests'):
+            if isinstance(item, FileItem):
+                logger.info("Archiving %s to %s", item['original_url'], item['path'])
+                archived = self.archived.pop(item['path'])
+                meta = {
+                    "archived": archived,
+                    "file_archive": True,
+                    # the scrapy cache seems to be interfering with our etag/if-none-match
+                    # submission and we don't need to cache it when using if-none-match
+                    # with the etag in the archive anyway
+                    "dont_cache": True,
+                }
+                headers = conditional_headers(archived)
+                logger.info(f"Requesting {item['original_url']} {headers}")
+                return [Request(item['original_url'], headers=headers, meta=meta)]
+            else:
+                return []
+
+    def media_downloaded(self, response, request, info, *, item=None):
+        # Until the upload's started; the sinks' blocking_call_seconds time the rest
+        with metrics.timer('pipeline_seconds', pipeline='FileArchivePipeline', method='media_downloaded'):
+            # The final request's, after any redirects
+            spool = response.meta.get('spool')
+            if response.status == 200 and spool is not None and not response.body:
+                logger.info("Spooled %s to disk", item['path'])
+                return self.store(spool.body(), item, response)
+            if spool is not None:
+                spool.discard()
+            if response.status == 304:
+                logger.info("%s is archived and up to date", item['path'])
+            elif response.status == 200:
+                return self.store(Body(data=response.body), item, response)
+            else:
+                referer = referer_str(request)
+                logger.warning(
+                    'File (code: %(status)s): Error downloading file from '
+                    '%(request)s referred in <%(referer)s>',
+                    {'status': response.status,
+                     'request': request, 'referer': referer},
+                    extra={'spider': info.spider}
+                )
+                raise Exception(f"Error downloading {item['path']}")
+
+    def item_completed(self, results, item, info):
+        """
+        Drop files that didn't make it to every sink, so the crawl state
+        doesn't count them as archived and they're retried next crawl
+        """
+        if isinstance(item, FileItem) and not all(success for success, result in results):
+            raise DropItem(f"Failed to archive {item['path']}")
+        return item
+
+    def media_failed(self, failure, request, info):
+        spool = request.meta.get('spool')
+        if spool is not None:
+            spool.discard()
+        return super(FileArchivePipeline, self).media_failed(failure, request, info)
+
+    def headers_received(self, headers, body_length, request, spider):
+        """Spool the body of files too big to hold in memory to disk"""
+        if not request.meta.get('file_archive'):
+            return
+        # Redirected and retried requests carry the meta of the first
+        previous = request.meta.pop('spool', None)
+        if previous is not None:
+            previous.discard()
+        if body_length == UNKNOWN_LENGTH or body_length > self.spool_threshold:
+            request.meta['spool'] = Spool(self.spool_dir)
+
+    def store(self, body, item, response):
+        self.count(body)
+        archived = response.meta["archived"]
+        dlist = [
+            maybeDeferred(sink.store, item, response, body, sink_archived)
+            for sink, sink_archived in zip(self.sinks, archived)
+        ]
+
+        def stored(results):
+            failed = 0
+            for sink, (success, result) in zip(self.sinks, results):
+                if not success:
+                    log_failure(f"Error archiving {item['path']} to {type(sink).__name__}", result)
+                    failed += 1
+            if failed:
+                raise Exception(f"Error archiving {item['path']} to {failed} sinks")
+
+        def release(result):
+            if not body.spooled:
+                self.in_memory -= body.size
+            body.cleanup()
+            return result
+
+        return DeferredList(dlist, consumeErrors=True).addCallback(stored).addBoth(release)
+
+    def count(self, body):
+        if body.spooled:
+            self.stats.inc_value('file_archive/spooled')
+            self.stats.inc_value('file_archive/spooled_bytes', body.size)
+            file_memory = SPOOL_CHUNK_SIZE
+        else:
+            self.stats.inc_value('file_archive/in_memory')
+            self.stats.inc_value('file_archive/in_memory_bytes', body.size)
+            self.in_memory += body.size
+            file_memory = body.size
+        self.stats.max_value('file_archive/file_memory_max', file_memory)
+        self.stats.max_value('file_archive/in_flight_memory_max', self.in_memory)
+
+
+def conditional_headers(archived):
+    """
+    The strongest validator that every sink's copy satisfies: If-None-Match
+    if they all hold the same etag, else If-Modified-Since the oldest copy if
+    they all know when theirs was modified. Otherwise at least one sink needs
+    the file in full.
+    """
+    if not archived or None in archived:
+        return {}
+    etags = {a.etag for a in archived}
+    if len(etags) == 1 and all(etags):
+        return {'If-None-Match': etags.pop()}
+    if all(a.last_modified for a in archived):
+        try:
+            oldest = min(archived, key=lambda a: parsedate_to_datetime(a.last_modified))
+        except (TypeError, ValueError):
+            return {}
+        return {'If-Modified-Since': oldest.last_modified}
+    return {}
+
+
+def response_validators(response):
+    """The etag and last-modified of a response, None for either missing"""
+    etag = response.headers.get('etag')
+    last_modified = response.headers.get('last-modified')
+    return (
+        etag.decode("utf-8") if etag else None,
+        last_modified.decode("utf-8") if last_modified else None,
+    )
+
+
+def log_failure(message, failure):
+    logger.error(
+        message,
+        exc_info=(failure.type, failure.value, failure.getTracebackObject()),
+    )
@@ -1,118 +1,308 @@
 # 1. calculate they file key based on its upstream path
 # 2. see if we have an etag for it
 #    a. if we have it in the on-disk cache, assume s3's etag is the same
-#    b. else try and fetch the etag from s3
-# 3. request it including its etag if we have one
+#    b. else if it's in the bucket's manifest, use that
+#    c. else try and fetch the etag from s3
+# 3. FileArchivePipeline requests it, conditional on what every sink has
 # 4. if the latest version isn't archived, upload the latest version
+#
+# Before uploading, the content index is checked for the same bytes under
+# another key, which are copied within the bucket instead, if the sha256 in
+# that object's metadata says it still has them.
+#
+# The manifest is one object in the bucket mapping each key to the upstream
+# etag, last-modified and size we archived. It's loaded when the spider opens
+# and written back when it closes, so a container with an empty .scrapy
+# volume doesn't need a HEAD request for every file it has archived before.
 
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from mfma import bandwidth
 from mfma.disk_cache import DiskCache
-from scrapy.pipelines.media import MediaPipeline
-from io import BytesIO
-from mfma.items import FileItem
+from mfma.pipelines.archive import Archived, ContentIndex, response_validators
+from mfma.pipelines.archive import DEFAULT_MULTIPART_CHUNK_SIZE
+from mfma.pipelines.threads import BlockingCalls
+import gzip
+import json
 import logging
-from scrapy.http import Request
-from scrapy.utils.request import referer_str
 from botocore.exceptions import ClientError
+from scrapy.exceptions import NotConfigured
 
 
 logger = logging.getLogger(__name__)
 
 
-class S3FileArchivePipeline(MediaPipeline):
-    def __init__(self, s3_bucket_name, aws_key_id, aws_key_secret):
-        self.download_func = None  # A MediaPipeline expected attribute
-        self.handle_httpstatus_list = None  # A MediaPipeline expected attribute
+DEFAULT_MANIFEST_KEY = '_mfmacrawl/manifest.json.gz'
+
+
+class S3FileArchiveSink(object):
+    """
+    boto3 calls block, so they run on a pool of S3_CONCURRENT_UPLOADS threads
+    sharing one client with that many pooled connections, and the crawl
+    carries on while they're in progress.
+
+    Spooled files are uploaded from disk in multipart_chunk_size parts,
+    multipart_concurrency of them at once.
+
+    Uploads share the s3_uploads bandwidth budget, upload_budget.
+    """
+
+    def __init__(self, stats, s3_bucket_name, aws_key_id, aws_key_secret,
+                 manifest_key=DEFAULT_MANIFEST_KEY, concurrent_uploads=2,
+                 multipart_chunk_size=DEFAULT_MULTIPART_CHUNK_SIZE,
+                 multipart_concurrency=2, upload_budget=None):
         self.s3_bucket_name = s3_bucket_name
         self.aws_key_id = aws_key_id
         self.aws_key_secret = aws_key_secret
+        self.manifest_key = manifest_key
+        self.concurrent_uploads = concurrent_uploads
+        self.multipart_concurrency = multipart_concurrency
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_chunk_size,
+            multipart_chunksize=multipart_chunk_size,
+            max_concurrency=multipart_concurrency,
+        )
         self.etag_cache = DiskCache('s3-file-archive')
+        self.stats = stats
+        self.content_index = ContentIndex('s3-file-archive', stats)
+        self.blocking = BlockingCalls('s3-file-archive', concurrent_uploads)
+        self.upload_budget = upload_budget or bandwidth.TokenBucket(bandwidth.S3_UPLOADS)
 
     @classmethod
     def from_crawler(cls, crawler):
-        cls.crawler = crawler # a MediaPipeline expectation
+        s3_bucket_name = crawler.settings.get('S3_BUCKET_NAME')
+        if not s3_bucket_name:
+            raise NotConfigured('S3_BUCKET_NAME is not set')
         return cls(
-            s3_bucket_name=crawler.settings.get('S3_BUCKET_NAME'),
+            crawler.stats,
+            s3_bucket_name=s3_bucket_name,
             aws_key_id=crawler.settings.get('AWS_KEY_ID'),
             aws_key_secret=crawler.settings.get('AWS_KEY_SECRET'),
+            manifest_key=crawler.settings.get('S3_MANIFEST_KEY', DEFAULT_MANIFEST_KEY),
+            concurrent_uploads=crawler.settings.getint('S3_CONCURRENT_UPLOADS', 2),
+            multipart_chunk_size=crawler.settings.getint(
+                'FILE_ARCHIVE_MULTIPART_CHUNK_SIZE', DEFAULT_MULTIPART_CHUNK_SIZE
+            ),
+            multipart_concurrency=crawler.settings.getint(
+                'FILE_ARCHIVE_MULTIPART_CONCURRENCY', 2
+            ),
+            upload_budget=bandwidth.Bandwidth.from_crawler(crawler)[bandwidth.S3_UPLOADS],
         )
 
-    def open_spider(self, spider):
-        super(S3FileArchivePipeline, self).open_spider(spider)
+    def open(self, spider):
+        self.etag_cache.load()
+        self.content_index.load()
         self.s3 = boto3.client(
             "s3",
             region_name="eu-west-1",
             aws_access_key_id=self.aws_key_id,
-            aws_secret_access_key=self.aws_key_secret
+            aws_secret_access_key=self.aws_key_secret,
+            config=Config(
+                max_pool_connections=self.concurrent_uploads * self.multipart_concurrency
+            ),
         )
+        self.manifest = EtagManifest(self.s3, self.s3_bucket_name, self.manifest_key)
+        self.blocking.start()
+        return self.blocking(self.manifest.load)
 
-    def get_media_requests(self, item, info):
-        if isinstance(item, FileItem):
-            logger.info("Archiving %s to %s", item['original_url'], item['path'])
-            key_str = item['path'][1:] # strip root /
-            etag = self.etag_cache.get(key_str)
-            if not etag:
-                try:
-                    heads = self.s3.head_object(Bucket=self.s3_bucket_name, Key=key_str)
-                    etag = heads.get('x-amz-meta-upstream-etag', '')
-                    if etag:
-                        self.etag_cache.put(key_str, etag)
-                except ClientError as ex:
-                    if ex.response['Error']['Code'] == '404':
-                        logger.info('got Not Found when doing HEAD')
-                    else:
-                        logger.info(f"Unexpected error fetching metadata {ex.response}")
-                        raise ex
-            headers = {'If-None-Match': etag}
-            logger.info(f"Requesting {item['original_url']}")
-            meta = {
-                "key_str": key_str,
-                # the scrapy cache seems to be interfering with our etag/if-none-match
-                # submission and we don't need to cache it when using if-none-match
-                # with the etag in the archive anyway
-                "dont_cache": True,
-            }
-            return [Request(item['original_url'], headers=headers, meta=meta)]
-        else:
-            return []
+    def close(self, spider):
+        dfd = self.blocking(self.manifest.save)
+
+        def closed(result):
+            self.blocking.stop()
+            self.etag_cache.close()
+            self.content_index.close()
+            return result
+
+        return dfd.addBoth(closed)
 
-    def media_downloaded(self, response, request, info, *, item=None):
-        key_str = response.meta["key_str"]
+    def archived(self, item):
+        key_str = item['path'][1:] # strip root /
+        etag = self.etag_cache.get(key_str)
+        if key_str in self.manifest:
+            manifest_etag, last_modified, size = self.manifest.entries[key_str]
+            return Archived(etag or manifest_etag, last_modified)
+        if etag:
+            return Archived(etag, None)
+        dfd = self.blocking(self.head_object, key_str)
+        return dfd.addCallback(self.remember_head, key_str)
 
-        if response.status == 304:
+    def head_object(self, key_str):
+        """Return the object's metadata, or None if it doesn't exist"""
+        try:
+            return self.s3.head_object(Bucket=self.s3_bucket_name, Key=key_str)
+        except ClientError as ex:
+            if ex.response['Error']['Code'] == '404':
+                logger.info('got Not Found when doing HEAD')
+                return None
+            else:
+                logger.info(f"Unexpected error fetching metadata {ex.response}")
+                raise ex
+
+    def remember_head(self, heads, key_str):
+        if heads is None:
+            return None
+        metadata = heads.get('Metadata', {})
+        etag = metadata.get('upstream-etag', '')
+        last_modified = metadata.get('last-modified', '')
+        self.manifest.put(key_str, etag, last_modified, heads.get('ContentLength', 0))
+        if etag:
+            self.etag_cache.put(key_str, etag)
+        return Archived(etag, last_modified)
+
+    def store(self, item, response, body, archived):
+        key_str = item['path'][1:] # strip root /
+        etag, last_modified = response_validators(response)
+        if archived and archived.is_current(etag, last_modified):
             logger.info("%s already exists in s3 and is up to date", key_str)
-        elif response.status == 200:
-            logger.info(f"Uploading {item['path']}")
-            last_modified = response.headers['last-modified'].decode("utf-8")
-            content_type = response.headers['content-type'].decode("utf-8")
-            if 'etag' in response.headers:
-                etag = response.headers['etag'].decode("utf-8")
-            meta = {
-                'last-modified': last_modified,
-            }
-            if 'etag' in response.headers:
-                meta['upstream-etag'] = etag
-            try:
-                self.s3.put_object(
-                    ACL="public-read",
-                    Key=key_str,
-                    Bucket=self.s3_bucket_name,
-                    Metadata=meta,
-                    ContentType=content_type,
-                    Body=BytesIO(response.body)
-                )
-            except Exception as e:
-                logger.exception(f"e", exc_info=True)
-            # Update cache with latest etag
-            if 'etag' in response.headers:
+            self.content_index.put(body.sha256, key_str)
+            return None
+
+        content_type = response.headers['content-type'].decode("utf-8")
+        meta = {
+            'last-modified': last_modified or '',
+            'sha256': body.sha256,
+        }
+        if etag:
+            meta['upstream-etag'] = etag
+        extra_args = {
+            'ACL': "public-read",
+            'Metadata': meta,
+            'ContentType': content_type,
+        }
+        source = self.content_index.get(body.sha256)
+        if source and source != key_str:
+            dfd = self.copy(source, key_str, extra_args, body)
+        else:
+            dfd = self.upload(key_str, extra_args, body)
+
+        def uploaded(result):
+            # Update cache and manifest with latest etag
+            self.manifest.put(key_str, etag or '', last_modified or '', body.size)
+            if etag:
                 self.etag_cache.put(key_str, etag)
+            self.content_index.put(body.sha256, key_str)
+
+        return dfd.addCallback(uploaded)
+
+    def upload(self, key_str, extra_args, body):
+        logger.info(f"Uploading {key_str}")
+        # boto3 calls back with each chunk it sends, so waiting on the
+        # budget there holds the upload to it
+        if body.spooled:
+            dfd = self.blocking(
+                self.s3.upload_file,
+                body.path,
+                self.s3_bucket_name,
+                key_str,
+                ExtraArgs=extra_args,
+                Callback=self.upload_budget.consume,
+                Config=self.transfer_config,
+            )
         else:
-            referer = referer_str(request)
-            logger.warning(
-                'File (code: %(status)s): Error downloading file from '
-                '%(request)s referred in <%(referer)s>',
-                {'status': response.status,
-                 'request': request, 'referer': referer},
-                extra={'spider': info.spider}
+            dfd = self.blocking(
+                self.s3.upload_fileobj,
+                body.open(),
+                self.s3_bucket_name,
+                key_str,
+                ExtraArgs=extra_args,
+                Callback=self.upload_budget.consume,
+                Config=self.transfer_config,
             )
-            raise Exception(f'Error downloading {key_str}')
+
+        def uploaded(result):
+            self.stats.inc_value('file_archive/s3-file-archive/uploaded_bytes', body.size)
+            return result
+
+        return dfd.addCallback(uploaded)
+
+    def copy(self, source, key_str, extra_args, body):
+        """Copy source, which has the same content, uploading if that fails"""
+        logger.info(f"Copying {source} to {key_str}, which has the same content")
+        dfd = self.blocking(self.copy_object, source, key_str, extra_args, body.sha256)
+
+        def copied(result):
+            if not result:
+                logger.warning(f"{source} no longer has the same content, uploading instead")
+                return self.upload(key_str, extra_args, body)
+            self.content_index.copied(body.size)
+
+        def copy_failed(failure):
+            failure.trap(ClientError)
+            logger.warning(f"Copying {source} failed, uploading instead: {failure.value}")
+            return self.upload(key_str, extra_args, body)
+
+        return dfd.addCallbacks(copied, copy_failed)
+
+    def copy_object(self, source, key_str, extra_args, sha256):
+        """
+        Copy source if its metadata says it has the content sha256, and it
+        hasn't changed since. Return whether it was copied.
+        """
+        heads = self.head_object(source)
+        if heads is None or heads.get('Metadata', {}).get('sha256') != sha256:
+            return False
+        self.s3.copy(
+            {'Bucket': self.s3_bucket_name, 'Key': source},
+            self.s3_bucket_name,
+            key_str,
+            ExtraArgs=dict(
+                extra_args, MetadataDirective='REPLACE', CopySourceIfMatch=heads['ETag']
+            ),
+            Config=self.transfer_config,
+        )
+        return True
+
+
+class EtagManifest(object):
+    """
+    Maps each key in the bucket to [upstream etag, last-modified, size],
+    stored as gzipped JSON in a single object in the same bucket.
+    """
+
+    def __init__(self, s3, bucket_name, key):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.key = key
+        self.entries = {}
+        self.dirty = False
+
+    def load(self):
+        try:
+            response = self.s3.get_object(Bucket=self.bucket_name, Key=self.key)
+        except ClientError as ex:
+            if ex.response['Error']['Code'] in ('NoSuchKey', '404'):
+                logger.info("No manifest at %s yet", self.key)
+                return
+            raise ex
+        self.entries = json.loads(gzip.decompress(response['Body'].read()))
+        logger.info("Loaded manifest of %d keys from %s", len(self.entries), self.key)
+
+    def save(self):
+        if not self.dirty:
+            return
+        entries_json = json.dumps(self.entries, separators=(',', ':'))
+        body = gzip.compress(entries_json.encode('utf-8'))
+        self.s3.put_object(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            Body=body,
+            ContentType='application/json',
+            ContentEncoding='gzip',
+        )
+        self.dirty = False
+        logger.info("Saved manifest of %d keys to %s", len(self.entries), self.key)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        return entry[0] if entry else None
+
+    def put(self, key, etag, last_modified, size):
+        entry = [etag, last_modified, size]
+        if self.entries.get(key) != entry:
+            self.entries[key] = entry
+            self.dirty = True
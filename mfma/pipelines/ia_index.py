@@ -0,0 +1,194 @@
+# A local index of the files archived in the Internet Archive collection, so
+# the sink can tell what's archived without a get_bucket and get_key round
+# trip per file.
+#
+# The index maps each item identifier in the collection to its files'
+# upstream etag and last-modified. ias3 keeps a file's x-amz-meta-* headers
+# as fields of the file in the item's metadata, so they're read from the
+# metadata API rather than HEAD requests.
+#
+# Refreshing lists every identifier in the collection with when it was last
+# updated in a few scrape API queries, then fetches the metadata of only the
+# items that are new or were updated since the last refresh, a few at a
+# time. It's kept in an SQLite file in the project data dir between crawls.
+
+from concurrent.futures import ThreadPoolExecutor
+from mfma.pipelines.archive import Archived
+from scrapy.utils.project import project_data_dir
+import json
+import logging
+import os
+import sqlite3
+import urllib.parse
+import urllib.request
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_ENDPOINT = 'https://archive.org'
+SCRAPE_PAGE_SIZE = 10000
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS items (identifier TEXT PRIMARY KEY, updated TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS files (identifier TEXT NOT NULL, name TEXT NOT NULL, '
+    'etag TEXT, last_modified TEXT, PRIMARY KEY (identifier, name))',
+]
+
+
+class CollectionIndex(object):
+    """
+    Lookups and updates happen on the reactor thread. refresh fetches on
+    the calling thread and returns what it found for apply to store, so it
+    can run on a thread pool meanwhile.
+    """
+
+    def __init__(self, collection, endpoint=DEFAULT_ENDPOINT, concurrency=4,
+                 name='internet-archive-index', timeout=60):
+        self.collection = collection
+        self.endpoint = endpoint.rstrip('/')
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.path = os.path.join(project_data_dir(), name + '.sqlite')
+        self.db = None
+        # identifier: when it was last updated, as of the last refresh
+        self.updated = {}
+        # identifier: {file name: Archived}
+        self.files = {}
+        # True once refreshed, so an identifier that isn't in it doesn't exist
+        self.complete = False
+        # Set to stop a refresh in progress early
+        self.stopping = False
+
+    def load(self):
+        self.db = sqlite3.connect(self.path)
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+        self.updated = dict(self.db.execute('SELECT identifier, updated FROM items'))
+        for identifier, name, etag, last_modified in self.db.execute(
+            'SELECT identifier, name, etag, last_modified FROM files'
+        ):
+            self.files.setdefault(identifier, {})[name] = Archived(etag or '', last_modified)
+        logger.info("Loaded %d items of collection %s", len(self.updated), self.collection)
+
+    def close(self):
+        self.stopping = True
+        self.db.commit()
+        self.db.close()
+
+    def __contains__(self, identifier):
+        return identifier in self.updated
+
+    def get(self, identifier, key_str):
+        """The archived file's validators, or None if it isn't in the item"""
+        return self.files.get(identifier, {}).get(key_str.lstrip('/'))
+
+    def put(self, identifier, key_str, etag, last_modified):
+        """Record a file this crawl archived"""
+        name = key_str.lstrip('/')
+        self.files.setdefault(identifier, {})[name] = Archived(etag or '', last_modified)
+        if identifier not in self.updated:
+            # Fetched again on the next refresh, when it'll be listed
+            self.updated[identifier] = ''
+            self.db.execute(
+                'INSERT OR IGNORE INTO items (identifier, updated) VALUES (?, ?)',
+                (identifier, ''),
+            )
+        self.db.execute(
+            'INSERT OR REPLACE INTO files (identifier, name, etag, last_modified) '
+            'VALUES (?, ?, ?, ?)',
+            (identifier, name, etag, last_modified),
+        )
+        self.db.commit()
+
+    # Refreshing
+
+    def refresh(self):
+        """
+        Fetch the collection's items that changed since the last refresh,
+        returning (every identifier: when it was updated, {identifier: files}
+        of those fetched), for apply
+        """
+        listed = dict(self.scrape())
+        changed = [
+            identifier for identifier, updated in listed.items()
+            if self.updated.get(identifier) != updated
+        ]
+        logger.info(
+            "Collection %s has %d items, fetching metadata of %d changed",
+            self.collection, len(listed), len(changed),
+        )
+        fetched = {}
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for identifier, files in zip(changed, executor.map(self.item_files, changed)):
+                if files is not None:
+                    fetched[identifier] = files
+        return listed, fetched
+
+    def apply(self, result):
+        listed, fetched = result
+        for identifier in set(self.updated) - set(listed):
+            if self.updated[identifier]:
+                # Gone from the collection
+                del self.updated[identifier]
+                self.files.pop(identifier, None)
+                self.db.execute('DELETE FROM items WHERE identifier = ?', (identifier,))
+                self.db.execute('DELETE FROM files WHERE identifier = ?', (identifier,))
+        for identifier, files in fetched.items():
+            self.updated[identifier] = listed[identifier]
+            self.files[identifier] = files
+            self.db.execute(
+                'INSERT OR REPLACE INTO items (identifier, updated) VALUES (?, ?)',
+                (identifier, listed[identifier]),
+            )
+            self.db.execute('DELETE FROM files WHERE identifier = ?', (identifier,))
+            self.db.executemany(
+                'INSERT INTO files (identifier, name, etag, last_modified) VALUES (?, ?, ?, ?)',
+                [(identifier, name, a.etag, a.last_modified) for name, a in files.items()],
+            )
+        self.db.commit()
+        # Complete unless stopped before fetching every changed item
+        self.complete = all(
+            self.updated.get(identifier) == updated for identifier, updated in listed.items()
+        )
+        logger.info(
+            "Refreshed %d items of collection %s%s", len(fetched), self.collection,
+            "" if self.complete else ", incompletely",
+        )
+        return len(fetched)
+
+    def scrape(self):
+        """(identifier, when it was last updated) of each item in the collection"""
+        cursor = None
+        while True:
+            query = {
+                'q': f'collection:{self.collection}',
+                'fields': 'identifier,oai_updatedate',
+                'count': SCRAPE_PAGE_SIZE,
+            }
+            if cursor:
+                query['cursor'] = cursor
+            page = self.get_json('/services/search/v1/scrape?' + urllib.parse.urlencode(query))
+            for item in page.get('items', []):
+                updated = item.get('oai_updatedate', '')
+                if isinstance(updated, list):
+                    updated = max(updated, default='')
+                yield item['identifier'], updated
+            cursor = page.get('cursor')
+            if not cursor:
+                return
+
+    def item_files(self, identifier):
+        """{file name: Archived} of the item's files, None if stopping"""
+        if self.stopping:
+            return None
+        metadata = self.get_json('/metadata/' + urllib.parse.quote(identifier))
+        return {
+            f['name']: Archived(f.get('upstream-etag', ''), f.get('last-modified'))
+            for f in metadata.get('files', [])
+            if f.get('source') == 'original'
+        }
+
+    def get_json(self, path):
+        with urllib.request.urlopen(self.endpoint + path, timeout=self.timeout) as response:
+            return json.loads(response.read())
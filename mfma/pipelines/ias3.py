@@ -0,0 +1,211 @@
+# A client for the Internet Archive's S3-like API, ias3, built for its
+# quirks rather than legacy boto's S3 connection:
+#
+# - one urllib3 pool of kept-alive HTTPS connections, shared by every
+#   thread uploading, so uploads run in parallel without a connection each
+# - requests IA answers with 503 (its "slow down") or 5xx, or that fail to
+#   connect, are retried after its Retry-After or an exponential backoff
+#   with jitter, rewinding the body
+# - items are created by the first upload to them with
+#   x-archive-auto-make-bucket rather than a request of their own
+# - item metadata that isn't ASCII is sent as uri(...), which ias3 decodes
+#
+# See https://archive.org/developers/ias3.html
+
+from io import BytesIO
+from xml.etree import ElementTree
+import logging
+import random
+import re
+import time
+import urllib.parse
+import urllib3
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_S3_ENDPOINT = 'https://s3.us.archive.org'
+RETRY_STATUSES = {500, 502, 503, 504}
+READ_SIZE = 64 * 1024
+
+
+class IAS3Error(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(f"{status} {code}: {message}")
+        self.status = status
+        self.code = code
+        self.message = message
+
+    @classmethod
+    def from_response(cls, response):
+        code = message = ''
+        try:
+            root = ElementTree.fromstring(response.data)
+            code = root.findtext('Code') or ''
+            message = root.findtext('Message') or ''
+        except ElementTree.ParseError:
+            message = response.data[:200].decode('utf-8', 'replace')
+        return cls(response.status, code, message)
+
+
+class IAS3Client(object):
+    """
+    Safe to share between threads. on_retry(error, delay) is called before
+    each retry, from the thread making the request.
+    """
+
+    def __init__(self, key_id, key_secret, endpoint=DEFAULT_S3_ENDPOINT,
+                 pool_size=4, retries=8, backoff=1, max_backoff=120,
+                 timeout=300, on_retry=None, sleep=time.sleep):
+        self.endpoint = endpoint.rstrip('/')
+        self.auth = f'LOW {key_id}:{key_secret}'
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.on_retry = on_retry
+        self.sleep = sleep
+        self.http = urllib3.PoolManager(
+            maxsize=pool_size,
+            block=True,
+            retries=False,
+            timeout=urllib3.Timeout(connect=30, read=timeout),
+        )
+
+    def url(self, identifier, key=None, query=None):
+        # Keys are quoted whole after the identifier, as boto did, so a key
+        # starting with / is the same file it archived
+        path = '/' + urllib.parse.quote(identifier)
+        if key is not None:
+            path += '/' + urllib.parse.quote(key)
+        if query:
+            path += '?' + query
+        return self.endpoint + path
+
+    def request(self, method, url, headers=None, body=None):
+        """The response, after retrying, or raise IAS3Error"""
+        headers = dict(headers or {}, authorization=self.auth)
+        attempt = 0
+        while True:
+            if body is not None:
+                body.seek(0)
+            try:
+                response = self.http.request(
+                    method, url, headers=headers, body=body, redirect=False
+                )
+            except urllib3.exceptions.HTTPError as e:
+                error = e
+                delay = None
+            else:
+                if response.status < 300 or (method == 'HEAD' and response.status == 404):
+                    return response
+                error = IAS3Error.from_response(response)
+                if response.status not in RETRY_STATUSES:
+                    raise error
+                delay = retry_after(response)
+            if attempt >= self.retries:
+                raise error
+            if delay is None:
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                delay = delay / 2 + random.uniform(0, delay / 2)
+            logger.info("Retrying %s %s in %.1fs after %s", method, url, delay, error)
+            if self.on_retry is not None:
+                self.on_retry(error, delay)
+            self.sleep(delay)
+            attempt += 1
+
+    def head(self, identifier, key):
+        """The file's headers, or None if it or its item doesn't exist"""
+        response = self.request('HEAD', self.url(identifier, key))
+        if response.status == 404:
+            return None
+        return response.headers
+
+    def put(self, identifier, key, section, headers):
+        headers = dict(headers, **{'content-length': str(section.size)})
+        return self.request('PUT', self.url(identifier, key), headers, section)
+
+    def copy(self, identifier, key, source_identifier, source_key, headers):
+        headers = dict(headers, **{
+            'x-amz-copy-source': '/' + urllib.parse.quote(source_identifier)
+            + '/' + urllib.parse.quote(source_key),
+            'x-amz-metadata-directive': 'REPLACE',
+            'content-length': '0',
+        })
+        return self.request('PUT', self.url(identifier, key), headers)
+
+    def initiate_multipart(self, identifier, key, headers):
+        response = self.request('POST', self.url(identifier, key, 'uploads'), headers)
+        return find_text(response.data, 'UploadId')
+
+    def upload_part(self, identifier, key, upload_id, part_num, section):
+        query = urllib.parse.urlencode({'partNumber': part_num, 'uploadId': upload_id})
+        headers = {'content-length': str(section.size)}
+        response = self.request('PUT', self.url(identifier, key, query), headers, section)
+        return response.headers.get('etag')
+
+    def complete_multipart(self, identifier, key, upload_id, etags):
+        parts = ''.join(
+            f'<Part><PartNumber>{n}</PartNumber><ETag>{etag}</ETag></Part>'
+            for n, etag in enumerate(etags, 1)
+        )
+        body = f'<CompleteMultipartUpload>{parts}</CompleteMultipartUpload>'.encode()
+        query = urllib.parse.urlencode({'uploadId': upload_id})
+        self.request('POST', self.url(identifier, key, query), {}, Section.of_bytes(body))
+
+    def abort_multipart(self, identifier, key, upload_id):
+        query = urllib.parse.urlencode({'uploadId': upload_id})
+        self.request('DELETE', self.url(identifier, key, query))
+
+
+class Section(object):
+    """
+    size bytes of an open file from offset, to send as a request body,
+    calling on_read with the size of each read. Rewound for retries.
+    """
+
+    def __init__(self, f, offset, size, on_read=None):
+        self.f = f
+        self.offset = offset
+        self.size = size
+        self.on_read = on_read
+        self.remaining = size
+
+    @classmethod
+    def of_bytes(cls, data):
+        return cls(BytesIO(data), 0, len(data))
+
+    def seek(self, position):
+        self.f.seek(self.offset + position)
+        self.remaining = self.size - position
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(min(size, READ_SIZE))
+        self.remaining -= len(data)
+        if self.on_read is not None and data:
+            self.on_read(len(data))
+        return data
+
+
+def retry_after(response):
+    try:
+        return max(0, float(response.headers.get('retry-after')))
+    except (TypeError, ValueError):
+        return None
+
+
+def find_text(xml, tag):
+    """The text of the first element named tag, whatever its namespace"""
+    for element in ElementTree.fromstring(xml).iter():
+        if re.sub(r'^\{.*\}', '', element.tag) == tag:
+            return element.text
+    return None
+
+
+def header_value(value):
+    """value as ias3 takes it in a header, uri(...) encoded if it isn't ASCII"""
+    if value.isascii() and '\n' not in value:
+        return value
+    return 'uri(' + urllib.parse.quote(value) + ')'
@@ -17,192 +17,345 @@
 # 1. calculate the bucket name and key string based on file path
 # 2. see if we have an etag cached for it
 #    a. if we have it in the on-disk cache, assume internet archive's etag is the same
-#    b. else try and fetch the etag from internet archive
-#        3. fetch the bucket
-#        4. fetch the key
-# 4. request the file from upstream (including its etag if we have one)
+#    b. else look it up in the local index of the collection (ia_index)
+#    c. else, for items the index doesn't know yet, try and fetch the etag
+#       from internet archive
+#        3. HEAD the key
+# 4. FileArchivePipeline requests the file, conditional on what every sink has
 # 5. if the latest version isn't archived, upload the latest version
-#    a. create the bucket, tolerating conflicts
-#    b. create the key
-#    c. upload the file, with flag to keep multiple versions
+#    a. the first upload to an item creates it, with x-archive-auto-make-bucket
+#    b. copy the same content from another key if the content index has it
+#       and that key's sha256 metadata still matches, else upload the file,
+#       with flag to keep multiple versions
 
 
-from boto.s3.connection import OrdinaryCallingFormat
-from boto.s3.key import Key
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
+from mfma import bandwidth
 from mfma.disk_cache import DiskCache
-from mfma.items import FileItem
-from os.path import basename, splitext, exists
-from scrapy.http import Request
-from scrapy.pipelines.media import MediaPipeline
-from scrapy.pipelines.media import MediaPipeline
-from scrapy.utils.request import referer_str
-from tempfile import NamedTemporaryFile
-import boto
+from mfma.pipelines.archive import Archived, ContentIndex, response_validators
+from mfma.pipelines.archive import DEFAULT_MULTIPART_CHUNK_SIZE, log_failure
+from mfma.pipelines.ia_index import DEFAULT_ENDPOINT, CollectionIndex
+from mfma.pipelines.ias3 import DEFAULT_S3_ENDPOINT, IAS3Client, IAS3Error, Section
+from mfma.pipelines.ias3 import header_value
+from mfma.pipelines.threads import BlockingCalls
+from os.path import basename, splitext
+from scrapy.exceptions import NotConfigured
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
 import logging
 import re
-import requests
 
 
 MFMA_RIGHTS = 'These National Treasury publications may not be reproduced wholly or in part without the express authorisation of the National Treasury in writing unless used for non-profit purposes.'
 MFMA_DOC_KEYWORDS = 'Local Government;MFMA;Municipal Financial Management Act;Finance;Governance;Management;National;Local;Government;Planning;South Africa;Provincial'
+DEFAULT_COLLECTION = 'mfmasouthafrica'
 
 
 logger = logging.getLogger(__name__)
 
 
-class InternetArchiveFileArchivePipeline(MediaPipeline):
-    def __init__(self, key_id, key_secret):
-        self.download_func = None  # A MediaPipeline expected attribute
-        self.handle_httpstatus_list = None  # A MediaPipeline expected attribute
-        self.key_id = key_id
-        self.key_secret = key_secret
+class InternetArchiveFileArchiveSink(object):
+    """
+    ias3 requests block, so they run on a pool of
+    INTERNET_ARCHIVE_CONCURRENT_UPLOADS threads sharing the client's pool of
+    kept-alive connections, and the crawl carries on while they're in
+    progress. Requests IA asks to slow down are retried up to
+    INTERNET_ARCHIVE_RETRIES times.
+
+    Spooled files bigger than multipart_chunk_size are uploaded from disk in
+    parts of that size, multipart_concurrency of them at once.
+
+    Uploads share the internet_archive_uploads bandwidth budget,
+    upload_budget.
+
+    The collection's index is refreshed in the background when the spider
+    opens; until it's complete, items it doesn't know are looked up
+    directly.
+    """
+
+    def __init__(self, stats, key_id, key_secret, concurrent_uploads=2,
+                 multipart_chunk_size=DEFAULT_MULTIPART_CHUNK_SIZE,
+                 multipart_concurrency=2, upload_budget=None,
+                 collection=DEFAULT_COLLECTION, endpoint=DEFAULT_ENDPOINT,
+                 s3_endpoint=DEFAULT_S3_ENDPOINT, retries=8):
+        self.multipart_chunk_size = multipart_chunk_size
+        self.multipart_concurrency = multipart_concurrency
+        self.stats = stats
         self.etag_cache = DiskCache('internet-archive-file-archive')
+        self.content_index = ContentIndex('internet-archive-file-archive', stats)
+        self.blocking = BlockingCalls('internet-archive-file-archive', concurrent_uploads)
+        self.upload_budget = upload_budget or bandwidth.TokenBucket(
+            bandwidth.INTERNET_ARCHIVE_UPLOADS
+        )
+        self.client = IAS3Client(
+            key_id,
+            key_secret,
+            endpoint=s3_endpoint,
+            pool_size=concurrent_uploads * multipart_concurrency,
+            retries=retries,
+            on_retry=self.retried,
+        )
+        self.collection = collection
+        self.index = CollectionIndex(collection, endpoint)
+        self.refreshing = None
+        # Identifiers whose buckets are known to exist, for upload
+        self.buckets = set()
 
     @classmethod
     def from_crawler(cls, crawler):
-        cls.crawler = crawler # a MediaPipeline expectation
+        key_id = crawler.settings.get('INTERNET_ARCHIVE_KEY_ID')
+        if not key_id:
+            raise NotConfigured('INTERNET_ARCHIVE_KEY_ID is not set')
         return cls(
-            key_id=crawler.settings.get('INTERNET_ARCHIVE_KEY_ID'),
+            crawler.stats,
+            key_id=key_id,
             key_secret=crawler.settings.get('INTERNET_ARCHIVE_KEY_SECRET'),
+            concurrent_uploads=crawler.settings.getint(
+                'INTERNET_ARCHIVE_CONCURRENT_UPLOADS', 2
+            ),
+            multipart_chunk_size=crawler.settings.getint(
+                'FILE_ARCHIVE_MULTIPART_CHUNK_SIZE', DEFAULT_MULTIPART_CHUNK_SIZE
+            ),
+            multipart_concurrency=crawler.settings.getint(
+                'FILE_ARCHIVE_MULTIPART_CONCURRENCY', 2
+            ),
+            upload_budget=bandwidth.Bandwidth.from_crawler(crawler)[
+                bandwidth.INTERNET_ARCHIVE_UPLOADS
+            ],
+            collection=crawler.settings.get('INTERNET_ARCHIVE_COLLECTION', DEFAULT_COLLECTION),
+            endpoint=crawler.settings.get('INTERNET_ARCHIVE_ENDPOINT', DEFAULT_ENDPOINT),
+            s3_endpoint=crawler.settings.get(
+                'INTERNET_ARCHIVE_S3_ENDPOINT', DEFAULT_S3_ENDPOINT
+            ),
+            retries=crawler.settings.getint('INTERNET_ARCHIVE_RETRIES', 8),
+        )
+
+    def open(self, spider):
+        self.etag_cache.load()
+        self.content_index.load()
+        self.index.load()
+        self.blocking.start()
+        self.refreshing = deferToThread(self.index.refresh)
+        self.refreshing.addCallback(self.index_refreshed)
+        self.refreshing.addErrback(
+            lambda failure: log_failure("Error refreshing the collection index", failure)
         )
 
-    def open_spider(self, spider):
-        super(InternetArchiveFileArchivePipeline, self).open_spider(spider)
-        self.conn = boto.connect_s3(
-            self.key_id,
-            self.key_secret,
-            host='s3.us.archive.org',
-            is_secure=False,
-            # OrdinaryCallingFormat places the bucket name in the path
-            # as opposed to the default SubdomainCallingFormat which treats
-            # the bucket as a subdomain of the hostname
-            calling_format=OrdinaryCallingFormat()
+    def index_refreshed(self, result):
+        fetched = self.index.apply(result)
+        self.stats.set_value(
+            'file_archive/internet-archive-file-archive/index_items', len(self.index.updated)
         )
+        self.stats.set_value(
+            'file_archive/internet-archive-file-archive/index_items_fetched', fetched
+        )
+
+    def close(self, spider):
+        # Stop a refresh that's still going, keeping what it's fetched
+        self.index.stopping = True
 
-    def get_media_requests(self, item, info):
-        if isinstance(item, FileItem):
-            identifier = path_identifier(item['path'])
-            logger.info("Archiving %s to %s", item['original_url'], identifier)
-            key_str = item['path']
-            etag = self.etag_cache.get(key_str)
-            bucket = None
-            if not etag:
-                try:
-                    bucket = self.conn.get_bucket(identifier)
-                    key = bucket.get_key(key_str)
-                    if key:
-                        etag = key.get_metadata('upstream-etag') or ''
-                    if etag:
-                        self.etag_cache.put(key_str, etag)
-                    logger.info(f"Key { key } for { key_str }")
-                except boto.exception.S3ResponseError as e:
-                    if e.code == 'NoSuchBucket':
-                        logger.info(f"Bucket { identifier } does not exist yet.")
-                    else:
-                        raise e
-
-            headers = {'If-None-Match': etag}
-            logger.info(f"Requesting {item['original_url']}")
-            meta = {
-                "key_str": key_str,
-                "bucket": bucket,
-                # the scrapy cache seems to be interfering with our etag/if-none-match
-                # submission and we don't need to cache it when using if-none-match
-                # with the etag in the archive anyway
-                "dont_cache": True,
-            }
-            return [Request(item['original_url'], headers=headers, meta=meta)]
-        else:
-            return []
-
-    def media_downloaded(self, response, request, info, *, item=None):
-        key_str = response.meta["key_str"]
-        bucket = response.meta["bucket"]
+        def closed(result):
+            self.blocking.stop()
+            self.etag_cache.close()
+            self.content_index.close()
+            self.index.close()
+
+        return self.refreshing.addBoth(closed)
+
+    def archived(self, item):
+        key_str = item['path']
         identifier = path_identifier(key_str)
+        etag = self.etag_cache.get(key_str)
+        if etag:
+            self.buckets.add(identifier)
+            return Archived(etag, None)
+        if identifier in self.index:
+            self.buckets.add(identifier)
+            archived = self.index.get(identifier, key_str)
+            # A file without validators in the index is looked up directly,
+            # rather than uploaded again
+            if archived and (archived.etag or archived.last_modified):
+                self.stats.inc_value('file_archive/internet-archive-file-archive/index_hits')
+                return archived
+        elif self.index.complete:
+            # Not in the collection
+            self.stats.inc_value('file_archive/internet-archive-file-archive/index_hits')
+            return None
+        self.stats.inc_value('file_archive/internet-archive-file-archive/index_misses')
+        dfd = self.blocking(self.archived_key, identifier, key_str)
+        return dfd.addCallback(self.remember_etag, key_str)
+
+    def archived_key(self, identifier, key_str):
+        """Return the archived key's validators, or None if it isn't archived"""
+        headers = self.client.head(identifier, key_str)
+        if headers is None:
+            logger.info(f"{key_str} isn't in archive.org identifier {identifier} yet")
+            return None
+        self.buckets.add(identifier)
+        return Archived(
+            headers.get('x-amz-meta-upstream-etag') or '',
+            headers.get('x-amz-meta-last-modified'),
+        )
+
+    def remember_etag(self, archived, key_str):
+        if archived and archived.etag:
+            self.etag_cache.put(key_str, archived.etag)
+        return archived
 
-        if response.status == 304:
+    def store(self, item, response, body, archived):
+        key_str = item['path']
+        etag, last_modified = response_validators(response)
+        if archived and archived.is_current(etag, last_modified):
             logger.info("%s already exists at archive.org and is up to date", key_str)
-        elif response.status == 200:
-            try:
-                last_modified = response.headers['last-modified'].decode("utf-8")
-                content_type = response.headers['content-type'].decode("utf-8")
-                if 'etag' in response.headers:
-                    etag = response.headers['etag'].decode("utf-8")
-                else:
-                    etag = None
-
-                if not bucket:
-                    title = splitext(basename(item['path']))[0]
-                    bucket = self.create_bucket(
-                        content_type,
-                        last_modified,
-                        item['path'],
-                        title,
-                        identifier
-                    )
-                key = Key(bucket, name=key_str)
-
-                with NamedTemporaryFile(delete=False) as fd:
-                    fd.write(response.body)
-                    fd.flush()
-                    key.set_metadata('last-modified', last_modified)
-                    if etag:
-                        key.set_metadata('upstream-etag', etag)
-
-                    logger.info(f"Uploading {item['path']} to archive.org identifier {identifier}")
-                    try:
-                        key.set_contents_from_file(fd, rewind=True)
-                    except boto.exception.S3ResponseError as e:
-                        if e.code == "BadContent" and len(response.body) == 0:
-                            logger.error("Invalid file from upstream rejected by internet archive")
-                        else:
-                            raise e
-
-                    # after successful upload, update cached etag
-                    if etag:
-                        self.etag_cache.put(key_str, etag)
-            except Exception as e:
-                logger.exception(f"e", exc_info=True)
-
-        else:
-            referer = referer_str(request)
-            logger.warning(
-                'File (code: %(status)s): Error downloading file from '
-                '%(request)s referred in <%(referer)s>',
-                {'status': response.status,
-                 'request': request, 'referer': referer},
-                extra={'spider': info.spider}
-            )
-            raise Exception(f'Error downloading {key_str}')
-
-    def create_bucket(self, content_type, last_modified, description, title, identifier):
-        """Return a bucket or raise an exception."""
-
-        bucket_headers = {
+            self.content_index.put(body.sha256, key_str)
+            return None
+
+        source = self.content_index.get(body.sha256)
+        if source == key_str:
+            source = None
+        dfd = self.blocking(self.upload, response, body, key_str, etag, source)
+
+        def uploaded(copied):
+            # after successful upload, update cached etag
+            if etag:
+                self.etag_cache.put(key_str, etag)
+            self.index.put(path_identifier(key_str), key_str, etag, last_modified)
+            if copied:
+                self.content_index.copied(body.size)
+            else:
+                self.stats.inc_value(
+                    'file_archive/internet-archive-file-archive/uploaded_bytes', body.size
+                )
+            self.content_index.put(body.sha256, key_str)
+
+        return dfd.addCallback(uploaded)
+
+    def upload(self, response, body, key_str, etag, source=None):
+        """
+        Upload the response body, creating the item if needed, or copy it
+        from the source key with the same content. Return whether it was
+        copied.
+        """
+        identifier = path_identifier(key_str)
+        _, last_modified = response_validators(response)
+        content_type = response.headers['content-type'].decode("utf-8")
+
+        headers = {
             'x-archive-keep-old-version': '1',
-            'x-archive-meta-content-type': content_type,
-            'x-archive-meta-date': str(datetime.strptime(last_modified, '%a, %d %b %Y %H:%M:%S %Z')),
-            'x-archive-meta-description': item['path'],
-            'x-archive-meta-licenseurl': 'http://mfma.treasury.gov.za',
-            'x-archive-meta-mediatype': 'text',
-            'x-archive-meta-publisher': 'National Treasury, Republic of South Africa',
-            'x-archive-meta-rights': MFMA_RIGHTS,
-            'x-archive-meta-subject': MFMA_DOC_KEYWORDS,
-            'x-archive-meta-title': title,
-            'x-archive-meta-collection': 'mfmasouthafrica',
+            'x-amz-meta-sha256': body.sha256,
         }
+        if last_modified:
+            headers['x-amz-meta-last-modified'] = last_modified
+        if etag:
+            headers['x-amz-meta-upstream-etag'] = etag
+        if identifier not in self.buckets:
+            # The upload creates the item, with its metadata
+            title = splitext(basename(key_str))[0]
+            headers.update(self.item_headers(content_type, last_modified, key_str, title))
+
+        if source and not self.has_content(source, body.sha256):
+            logger.warning(f"{source} no longer has the same content, uploading instead")
+            source = None
+        if source:
+            logger.info(f"Copying {source} to {key_str}, which has the same content")
+            try:
+                self.client.copy(identifier, key_str, path_identifier(source), source, headers)
+                self.buckets.add(identifier)
+                return True
+            except IAS3Error as e:
+                logger.warning(f"Copying {source} failed, uploading instead: {e}")
+
+        logger.info(f"Uploading {key_str} to archive.org identifier {identifier}")
+        headers['content-type'] = content_type
         try:
-            return self.conn.create_bucket(identifier, headers=bucket_headers)
-        except boto.exception.S3CreateError as e:
-            if e.code == 'BucketAlreadyExists':
-                logger.info((f"Thought bucket didn't exist but got key"
-                             f"conflict so it's probably ok ({ key_str })"))
-                return self.conn.get_bucket(identifier)
+            if body.spooled and body.size > self.multipart_chunk_size:
+                self.upload_multipart(identifier, key_str, headers, body)
+            else:
+                with body.open() as f:
+                    section = Section(f, 0, body.size, self.upload_budget.consume)
+                    self.client.put(identifier, key_str, section, headers)
+        except IAS3Error as e:
+            if e.code == "BadContent" and body.size == 0:
+                logger.error("Invalid file from upstream rejected by internet archive")
             else:
                 raise e
+        self.buckets.add(identifier)
+        return False
+
+    def has_content(self, key_str, sha256):
+        """Whether the sha256 in the archived key's metadata is sha256"""
+        try:
+            headers = self.client.head(path_identifier(key_str), key_str)
+        except IAS3Error as e:
+            logger.warning(f"Checking {key_str} failed: {e}")
+            return False
+        return headers is not None and headers.get('x-amz-meta-sha256') == sha256
+
+    def upload_multipart(self, identifier, key_str, headers, body):
+        """Upload a spooled body in parts, cancelling the upload on failure"""
+        upload_id = self.client.initiate_multipart(identifier, key_str, headers)
+        try:
+            with ThreadPoolExecutor(self.multipart_concurrency) as executor:
+                parts = [
+                    executor.submit(
+                        self.upload_part,
+                        identifier,
+                        key_str,
+                        upload_id,
+                        part_num,
+                        body.path,
+                        offset,
+                        min(self.multipart_chunk_size, body.size - offset),
+                    )
+                    for part_num, offset in enumerate(
+                        range(0, body.size, self.multipart_chunk_size), 1
+                    )
+                ]
+                etags = [part.result() for part in parts]
+            self.client.complete_multipart(identifier, key_str, upload_id, etags)
+        except Exception:
+            self.client.abort_multipart(identifier, key_str, upload_id)
+            raise
+
+    def upload_part(self, identifier, key_str, upload_id, part_num, path, offset, size):
+        with open(path, 'rb') as f:
+            section = Section(f, offset, size, self.upload_budget.consume)
+            return self.client.upload_part(identifier, key_str, upload_id, part_num, section)
+
+    def item_headers(self, content_type, last_modified, description, title):
+        """
+        Headers creating the item with its metadata, if it doesn't exist,
+        dated by last_modified if there is one
+        """
+        metadata = {
+            'content-type': content_type,
+            'description': description,
+            'licenseurl': 'http://mfma.treasury.gov.za',
+            'mediatype': 'text',
+            'publisher': 'National Treasury, Republic of South Africa',
+            'rights': MFMA_RIGHTS,
+            'subject': MFMA_DOC_KEYWORDS,
+            'title': title,
+            'collection': self.collection,
+        }
+        if last_modified:
+            metadata['date'] = str(datetime.strptime(last_modified, '%a, %d %b %Y %H:%M:%S %Z'))
+        headers = {
+            f'x-archive-meta-{name}': header_value(value) for name, value in metadata.items()
+        }
+        headers['x-archive-auto-make-bucket'] = '1'
+        return headers
+
+    def retried(self, error, delay):
+        # The client retries on the thread pool, and the stats aren't thread-safe
+        reactor.callFromThread(self.count_retry, error, delay)
+
+    def count_retry(self, error, delay):
+        self.stats.inc_value('file_archive/internet-archive-file-archive/retries')
+        if getattr(error, 'status', None) == 503:
+            self.stats.inc_value('file_archive/internet-archive-file-archive/slow_downs')
+        self.stats.inc_value('file_archive/internet-archive-file-archive/retry_seconds', delay)
 
 
 def path_identifier(path):
@@ -0,0 +1,83 @@
+# Mirrors files under FILE_ARCHIVE_DIR at their upstream path.
+#
+# The upstream etag of each file is kept in the on-disk cache and its
+# last-modified is the file's mtime, so a file copied in from elsewhere can
+# still be revalidated with If-Modified-Since.
+
+from email.utils import formatdate, parsedate_to_datetime
+from mfma.disk_cache import DiskCache
+from mfma.pipelines.archive import Archived, response_validators
+from mfma.pipelines.threads import BlockingCalls
+from scrapy.exceptions import NotConfigured
+import logging
+import os
+import shutil
+
+
+logger = logging.getLogger(__name__)
+
+
+class LocalFileArchiveSink(object):
+    def __init__(self, stats, directory):
+        self.stats = stats
+        self.directory = directory
+        self.etag_cache = DiskCache('local-file-archive')
+        self.blocking = BlockingCalls('local-file-archive', 1)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        directory = crawler.settings.get('FILE_ARCHIVE_DIR')
+        if not directory:
+            raise NotConfigured('FILE_ARCHIVE_DIR is not set')
+        return cls(crawler.stats, directory)
+
+    def open(self, spider):
+        self.etag_cache.load()
+        self.blocking.start()
+
+    def close(self, spider):
+        self.blocking.stop()
+        self.etag_cache.close()
+
+    def file_path(self, item):
+        return os.path.join(self.directory, item['path'].lstrip('/'))
+
+    def archived(self, item):
+        path = self.file_path(item)
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+        etag = self.etag_cache.get(path) or ''
+        return Archived(etag, formatdate(mtime, usegmt=True))
+
+    def store(self, item, response, body, archived):
+        etag, last_modified = response_validators(response)
+        if archived and archived.is_current(etag, last_modified):
+            logger.info("%s already exists in %s and is up to date", item['path'], self.directory)
+            return None
+
+        path = self.file_path(item)
+        dfd = self.blocking(self.write, path, body, last_modified)
+
+        def written(result):
+            self.stats.inc_value('file_archive/local-file-archive/uploaded_bytes', body.size)
+            if etag:
+                self.etag_cache.put(path, etag)
+
+        return dfd.addCallback(written)
+
+    def write(self, path, body, last_modified):
+        """Write body to path via a temporary file so it's never partial"""
+        logger.info(f"Writing {path}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = path + '.partial'
+        with body.open() as src, open(partial, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        if last_modified:
+            try:
+                mtime = parsedate_to_datetime(last_modified).timestamp()
+                os.utime(partial, (mtime, mtime))
+            except (TypeError, ValueError):
+                logger.warning(f"Unparseable last-modified {last_modified} for {path}")
+        os.replace(partial, path)
@@ -0,0 +1,30 @@
+from mfma import metrics
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+class BlockingCalls(object):
+    """
+    Runs blocking client calls on a bounded pool of threads, returning a
+    Deferred for each, so they don't hold up the reactor. Calls beyond the
+    pool's size wait for a free thread. How long each call takes on its
+    thread is recorded in mfma.metrics.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.pool = ThreadPool(minthreads=0, maxthreads=size, name=name)
+
+    def start(self):
+        self.pool.start()
+
+    def stop(self):
+        self.pool.stop()
+
+    def __call__(self, f, *args, **kwargs):
+        return deferToThreadPool(reactor, self.pool, self.timed, f, *args, **kwargs)
+
+    def timed(self, f, *args, **kwargs):
+        with metrics.timer('blocking_call_seconds', pool=self.name, call=getattr(f, '__name__', repr(f))):
+            return f(*args, **kwargs)
@@ -0,0 +1,51 @@
+# Times items through the item pipelines for mfma.extensions.MetricsExporter.
+#
+# PipelineTimer runs first in ITEM_PIPELINES and notes when each item goes
+# in. The item_scraped, item_dropped and item_error signals that follow the
+# last pipeline, or the one that drops or fails the item, end its time,
+# observed in mfma.metrics as item_pipelines_seconds by outcome. Times run until
+# Deferreds the pipelines return fire.
+
+from mfma import metrics
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineTimer(object):
+    def __init__(self):
+        # id of each item in the pipelines: when it went in
+        self.started = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('METRICS_ENABLED'):
+            raise NotConfigured('METRICS_ENABLED is off')
+        timer = cls()
+        crawler.signals.connect(timer.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(timer.item_dropped, signal=signals.item_dropped)
+        crawler.signals.connect(timer.item_error, signal=signals.item_error)
+        return timer
+
+    def process_item(self, item, spider):
+        self.started[id(item)] = time.perf_counter()
+        return item
+
+    def item_scraped(self, item, **kwargs):
+        self.finished(item, 'scraped')
+
+    def item_dropped(self, item, **kwargs):
+        self.finished(item, 'dropped')
+
+    def item_error(self, item, **kwargs):
+        self.finished(item, 'error')
+
+    def finished(self, item, outcome):
+        # Items the pipelines resume by themselves weren't timed in
+        started = self.started.pop(id(item), None)
+        if started is not None:
+            metrics.observe('item_pipelines_seconds', time.perf_counter() - started, outcome=outcome)
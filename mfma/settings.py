@@ -13,6 +13,7 @@ BOT_NAME = 'mfma'
 
 SPIDER_MODULES = ['mfma.spiders']
 NEWSPIDER_MODULE = 'mfma.spiders'
+COMMANDS_MODULE = 'mfma.commands'
 
 
 # Crawl responsibly by identifying yourself (and your website) on the user-agent
@@ -22,7 +23,9 @@ USER_AGENT = 'mfmacrawl (+mfmamirror.github.io/)'
 ROBOTSTXT_OBEY = True
 
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
-CONCURRENT_REQUESTS = 3
+# The sum of the DOWNLOAD_SLOTS concurrencies, so file downloads never hold
+# back pages
+CONCURRENT_REQUESTS = 5
 
 # Configure a delay for requests for the same website (default: 0)
 # See http://scrapy.readthedocs.org/en/latest/topics/settings.html#download-delay
@@ -32,6 +35,15 @@ DOWNLOAD_DELAY = 2
 #CONCURRENT_REQUESTS_PER_DOMAIN = 16
 #CONCURRENT_REQUESTS_PER_IP = 16
 
+# DownloadSlotsMiddleware's slots for HTML pages, conditional requests for
+# archived files (mostly 304s), and full file downloads. While pages are
+# still queued, full downloads are limited to discovery_concurrency.
+DOWNLOAD_SLOTS = {
+    'pages': {'concurrency': 2, 'delay': 2},
+    'revalidations': {'concurrency': 2, 'delay': 0.25},
+    'files': {'concurrency': 1, 'delay': 2, 'discovery_concurrency': 1},
+}
+
 # Disable cookies (enabled by default)
 #COOKIES_ENABLED = False
 
@@ -47,29 +59,115 @@ DOWNLOAD_DELAY = 2
 # Enable or disable spider middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/spider-middleware.html
 SPIDER_MIDDLEWARES = {
+    'mfma.middlewares.ResumeMiddleware': 50,
     'scrapy_querycleaner.QueryCleanerMiddleware': 100,
 }
 
+# Keep the state of the crawl in progress here so it can be resumed if it's
+# interrupted, see mfma.jobs. bin/run.sh sets it.
+#CRAWL_JOB_DIR = '/var/lib/mfmacrawl/job'
+
 QUERYCLEANER_REMOVE = "FolderCTID"
 
+# Treat every spelling of a SharePoint page's URL as the same request
+DUPEFILTER_CLASS = 'mfma.dupefilters.CanonicalDupeFilter'
+
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
-#DOWNLOADER_MIDDLEWARES = {
-#    'mfma.middlewares.MyCustomDownloaderMiddleware': 543,
-#}
+DOWNLOADER_MIDDLEWARES = {
+    'mfma.middlewares.DownloadSlotsMiddleware': 50,
+    'scrapy.downloadermiddlewares.httpcache.HttpCacheMiddleware': None,
+    'mfma.middlewares.RevalidatingCacheMiddleware': 900,
+    'mfma.middlewares.BandwidthMiddleware': 950,
+}
+
+# Bytes per second each kind of traffic may use, see mfma.bandwidth. Each
+# has its own budget, so uploads carry on at their rate while an upstream
+# download is slow. 0 or leaving one out is unlimited.
+BANDWIDTH_LIMITS = {
+    'pages': 50 * 1024,
+    'files': 150 * 1024,
+    's3_uploads': 100 * 1024,
+    'internet_archive_uploads': 100 * 1024,
+}
 
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    'scrapy.extensions.telnet.TelnetConsole': None,
-#}
+EXTENSIONS = {
+    'scrapy.extensions.throttle.AutoThrottle': None,
+    'mfma.extensions.SlotAutoThrottle': 0,
+    'mfma.extensions.MetricsExporter': 500,
+    'mfma.deltas.DeltaFeed': 500,
+}
+
+# Write the items added, changed and removed since the last successful crawl
+# to DELTA_FEED, by default <feed>.delta.jsonlines next to the feed
+DELTA_FEED_ENABLED = True
+
+# Write timings and counts every METRICS_INTERVAL seconds and at the end of
+# the crawl, next to the feed or in METRICS_DIR if it's set
+METRICS_ENABLED = True
+METRICS_INTERVAL = 60
+
+# Feed formats that compress jsonlines as it's written, see mfma.feeds,
+# flushed every FEED_FLUSH_INTERVAL seconds. They and jsonlines are synced to
+# disk before each commit of the crawl's job.
+FEED_EXPORTERS = {
+    'jsonlines': 'mfma.feeds.SyncedJsonLinesItemExporter',
+    'jsonlines.gz': 'mfma.feeds.GzipJsonLinesItemExporter',
+    'jsonlines.zst': 'mfma.feeds.ZstdJsonLinesItemExporter',
+}
+FEED_FLUSH_INTERVAL = 30
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
+    # First, to time items through the rest with METRICS_ENABLED
+    'mfma.pipelines.timing.PipelineTimer': 0,
     'mfma.pipelines.DepaginatingPipeline': 100,
-    'mfma.pipelines.aws_s3.S3FileArchivePipeline': 100,
-    'mfma.pipelines.internet_archive.InternetArchiveFileArchivePipeline': 100,
+    'mfma.pipelines.archive.FileArchivePipeline': 100,
+}
+
+# DepaginatingPipeline holds back the pages of a paged listing until its
+# last page, with at most this many table rows in memory in total; the rest
+# are spilled to temporary files in DEPAGINATE_SPILL_DIR
+DEPAGINATE_MEMORY_ROWS = 10000
+
+# Logs the pages DepaginatingPipeline holds back at DEBUG, not as dropped
+LOG_FORMATTER = 'mfma.logformatter.LogFormatter'
+
+# Where FileArchivePipeline archives each file it downloads. Sinks that
+# aren't configured (no bucket, keys or directory) disable themselves.
+FILE_ARCHIVE_SINKS = [
+    'mfma.pipelines.aws_s3.S3FileArchiveSink',
+    'mfma.pipelines.internet_archive.InternetArchiveFileArchiveSink',
+    'mfma.pipelines.local.LocalFileArchiveSink',
+]
+
+# Number of uploads (and other blocking calls) each archive sink runs at
+# once, on its own thread pool so the crawl carries on meanwhile
+S3_CONCURRENT_UPLOADS = 2
+INTERNET_ARCHIVE_CONCURRENT_UPLOADS = 2
+
+# The Internet Archive collection files are archived to, indexed locally
+# from INTERNET_ARCHIVE_ENDPOINT's scrape and metadata APIs
+INTERNET_ARCHIVE_COLLECTION = 'mfmasouthafrica'
+INTERNET_ARCHIVE_ENDPOINT = 'https://archive.org'
+
+# Where files are uploaded with ias3, and how many times a request IA asks
+# to slow down (503) or that fails is retried, backing off exponentially
+INTERNET_ARCHIVE_S3_ENDPOINT = 'https://s3.us.archive.org'
+INTERNET_ARCHIVE_RETRIES = 8
+
+# Files bigger than this are streamed to disk rather than held in memory,
+# by the download handler below, and uploaded in parts of
+# FILE_ARCHIVE_MULTIPART_CHUNK_SIZE, this many at once
+FILE_ARCHIVE_SPOOL_THRESHOLD = 8 * 1024 * 1024
+FILE_ARCHIVE_MULTIPART_CHUNK_SIZE = 8 * 1024 * 1024
+FILE_ARCHIVE_MULTIPART_CONCURRENCY = 2
+DOWNLOAD_HANDLERS = {
+    'http': 'mfma.downloadhandlers.SpoolingHTTPDownloadHandler',
+    'https': 'mfma.downloadhandlers.SpoolingHTTPDownloadHandler',
 }
 
 # Enable and configure the AutoThrottle extension (disabled by default)
@@ -88,8 +186,14 @@ AUTOTHROTTLE_DEBUG = True
 # Enable and configure HTTP caching (disabled by default)
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
 HTTPCACHE_ENABLED = True
-HTTPCACHE_EXPIRATION_SECS = 604800 # 1 week
+# Pages with an ETag or Last-Modified are revalidated every time, and kept
+# this long to revalidate; others are reused for HTTPCACHE_FRESHNESS_SECS
+HTTPCACHE_POLICY = 'mfma.httpcache.RevalidatingPolicy'
+HTTPCACHE_EXPIRATION_SECS = 7776000 # 90 days
+HTTPCACHE_FRESHNESS_SECS = 604800 # 1 week
 HTTPCACHE_DIR = 'httpcache'
 HTTPCACHE_IGNORE_HTTP_CODES = [429]
-HTTPCACHE_STORAGE = 'scrapy.extensions.httpcache.FilesystemCacheStorage'
-HTTPCACHE_GZIP = True
+# One compressed SQLite file per spider in HTTPCACHE_DIR, see mfma.httpcache
+HTTPCACHE_STORAGE = 'mfma.httpcache.SqliteCacheStorage'
+# The oldest responses are evicted past this many (compressed) bytes
+HTTPCACHE_MAX_SIZE = 1024 * 1024 * 1024
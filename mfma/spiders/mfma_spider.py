@@ -1,5 +1,13 @@
-from bs4 import BeautifulSoup
+from mfma.crawl_state import CrawlState
 from mfma.items import PageItem, MenuItem, FileItem
+from mfma.jobs import Job
+from mfma.listing import (
+    extract_rows,
+    list_data_rows,
+    list_data_url,
+)
+from mfma.transform import HtmlTransform
+from scrapy import signals
 import logging
 import re
 import scrapy
@@ -14,19 +22,51 @@ class MfmaSpider(scrapy.Spider):
     allowed_domains = ["mfma.treasury.gov.za"]
     start_urls = ["http://mfma.treasury.gov.za"]
 
-    def __init__(self, start_url=None, scrape_menu="true"):
+    def __init__(
+        self, start_url=None, scrape_menu="true", full_recrawl="false", list_data="false"
+    ):
         self.base = "http://mfma.treasury.gov.za"
 
         self.form_table_css = (
             "div.mainContent > table > tr > td#MSOZoneCell_WebPartWPQ2"
         )
         self.simple_content_css = ".mainContent"
+        self.body_transform = HtmlTransform(whitelist={"src", "href", "target", "alt"})
+        self.breadcrumbs_transform = HtmlTransform()
 
         if start_url:
             logger.info(f"Starting at {start_url}")
             self.start_urls = [start_url]
 
         self.should_scrape_menu = scrape_menu == "true"
+        # Doesn't reach the whole site, so what it didn't see may still be there
+        self.partial = bool(start_url) or not self.should_scrape_menu
+        self.full_recrawl = full_recrawl == "true"
+        # Fetch the rest of a paged listing's rows from its XML data, until
+        # that fails
+        self.list_data = list_data == "true"
+        # Set up in from_crawler. Without it every row is crawled.
+        self.crawl_state = None
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.crawl_state = CrawlState(job=Job.from_crawler(crawler))
+        spider.crawl_state.load()
+        crawler.signals.connect(spider.file_archived, signal=signals.item_scraped)
+        crawler.signals.connect(spider.file_failed, signal=signals.item_dropped)
+        crawler.signals.connect(spider.file_failed, signal=signals.item_error)
+        crawler.signals.connect(spider.callback_failed, signal=signals.spider_error)
+        return spider
+
+    def closed(self, reason):
+        if self.crawl_state is None:
+            return
+        if reason == "finished":
+            self.crawl_state.commit()
+        else:
+            logger.info(f"Crawl state not committed, crawl {reason}")
+        self.crawl_state.close()
 
     def parse(self, response):
         if self.should_scrape_menu:
@@ -65,18 +105,19 @@ class MfmaSpider(scrapy.Spider):
         page_item["type"] = "page"
         page_item["form_table_rows"] = []
 
+        # Before the content, for a listing's later pages to carry it
+        title_css = ".breadcrumbCurrent"
+        if response.selector.css(title_css):
+            page_item["title"] = (
+                response.selector.css(title_css).xpath("text()")[0].extract()
+            )
+
         if response.selector.css(self.form_table_css):
             for item in self.set_form_table_content(page_item, response):
                 yield item
         elif response.selector.css(self.simple_content_css):
             for item in self.set_simple_content(page_item, response):
                 yield item
-
-        title_css = ".breadcrumbCurrent"
-        if response.selector.css(title_css):
-            page_item["title"] = (
-                response.selector.css(title_css).xpath("text()")[0].extract()
-            )
         yield page_item
 
     def set_form_table_content(self, page_item, response):
@@ -87,44 +128,164 @@ class MfmaSpider(scrapy.Spider):
         location = self.dedotnet(purl.path, indexhtml=False)
         page_item["original_url"] = url
         page_item["path"] = location
-
-        for row in get_rows(response):
-            label = row.xpath(".//tr/td/a/text()")[0].extract()
-            row_href = row.xpath(".//tr/td/a/@href")[0].extract()
-            path = get_row_link_path(row_href)
-            user = get_user(row)
-            mod_date_xpath = './/td[@class="ms-vb2"]/nobr/text()'
-            mod_date = row.xpath(mod_date_xpath)[0].extract()
-            row_item = {
-                "type": "table_form_item",
-                "label": label,
-                "path": path,
-                "modified_date": mod_date,
-                "user": user,
+        row_meta = {}
+        if response.request is not None and "row_path" in response.meta:
+            row_meta = {
+                "row_path": response.meta["row_path"],
+                "row_modified": response.meta["row_modified"],
             }
-            page_item["form_table_rows"].append(row_item)
-
-            if self.has_file_extension(path):
-                file_item = FileItem()
-                file_item["original_url"] = urllib.parse.urljoin(response.url, path)
-                file_item["path"] = urllib.parse.unquote(path)
-                file_item["type"] = "file"
-                yield file_item
-            else:
-                child = "http://%s%s" % (purl.netloc, path)
-                yield scrapy.Request(child)
+            if self.crawl_state is not None:
+                self.crawl_state.seen(row_meta["row_path"], row_meta["row_modified"])
+
+        rows = []
+        for row in extract_rows(response.selector.root):
+            rows.append(row)
+            label = row.label
+            item = self.row_item(row, purl, response.url)
+            if item is not None:
+                yield item
 
-        nextlink = response.xpath('//img[@alt="Next"]')
-        if nextlink:
-            qs = urllib.parse.urlencode({"p_FileLeafRef": label, "Paged": "TRUE"})
-            next_page_url = urllib.parse.urljoin(url, "?" + qs)
-            yield scrapy.Request(next_page_url)
+        page_item["form_table_rows"].extend(row.as_dict() for row in rows)
 
         breadcrumbs_css = "#ctl00_PlaceHolderTitleBreadcrumb_ContentMap"
         css_match = response.selector.css(breadcrumbs_css)
         if css_match:
             page_item["breadcrumbs"] = self.breadcrumbs_html(css_match)
 
+        nextlink = response.xpath('//img[@alt="Next"]')
+        if nextlink:
+            page_item["more_pages"] = True
+            qs = urllib.parse.urlencode({"p_FileLeafRef": label, "Paged": "TRUE"})
+            next_page_url = urllib.parse.urljoin(url, "?" + qs)
+            data_url = None
+            if self.list_data:
+                folder = urllib.parse.unquote(location).rstrip("/")
+                data_url = list_data_url(response.selector.root, folder)
+            if data_url:
+                page = {
+                    name: value for name, value in page_item.items()
+                    if name not in ("form_table_rows", "more_pages")
+                }
+                meta = {
+                    "listing_page": page,
+                    "listed": [row.path for row in rows],
+                    "next_page": next_page_url,
+                    # Any status, to fall back to paging on
+                    "handle_httpstatus_all": True,
+                    **row_meta,
+                }
+                yield scrapy.Request(
+                    data_url,
+                    callback=self.parse_list_data,
+                    errback=self.list_data_failed,
+                    meta=meta,
+                )
+            else:
+                yield self.next_page_request(next_page_url, row_meta)
+
+    def row_item(self, row, purl, base_url):
+        """
+        The FileItem of a listing row that's a file, or the Request for one
+        that's a folder, or None if it hasn't changed since the last crawl
+        """
+        path = row.path
+        mod_date = row.modified_date
+        row_path = urllib.parse.unquote(path)
+        if self.unchanged(row_path, mod_date):
+            return None
+        if self.has_file_extension(path):
+            file_item = FileItem()
+            file_item["original_url"] = urllib.parse.urljoin(base_url, path)
+            file_item["path"] = row_path
+            file_item["type"] = "file"
+            file_item["modified_date"] = mod_date
+            return file_item
+        else:
+            child = "http://%s%s" % (purl.netloc, path)
+            meta = {"row_path": row_path, "row_modified": mod_date}
+            return scrapy.Request(child, meta=meta, errback=self.folder_failed)
+
+    def next_page_request(self, next_page_url, row_meta):
+        if row_meta:
+            return scrapy.Request(
+                next_page_url, meta=dict(row_meta), errback=self.folder_failed
+            )
+        return scrapy.Request(next_page_url)
+
+    def parse_list_data(self, response):
+        """
+        The rest of a paged listing's rows from its XML data, as the page
+        item of its last page, or its next page if the data isn't available.
+        """
+        try:
+            if response.status != 200:
+                raise ValueError(f"HTTP {response.status}")
+            rows = list_data_rows(response.body)
+        except ValueError as e:
+            for request in self.list_data_unavailable(response.meta, str(e)):
+                yield request
+            return
+
+        page_item = PageItem(response.meta["listing_page"])
+        page_item["form_table_rows"] = []
+        purl = urllib.parse.urlparse(page_item["original_url"])
+        listed = set(response.meta["listed"])
+        for row in rows:
+            # The rows of the page that requested the data are in its item
+            if row.path in listed:
+                continue
+            page_item["form_table_rows"].append(row.as_dict())
+            item = self.row_item(row, purl, response.url)
+            if item is not None:
+                yield item
+        self.crawler.stats.inc_value("list_data/listings")
+        self.crawler.stats.inc_value("list_data/rows", len(page_item["form_table_rows"]))
+        yield page_item
+
+    def list_data_failed(self, failure):
+        return self.list_data_unavailable(failure.request.meta, repr(failure.value))
+
+    def list_data_unavailable(self, meta, reason):
+        if self.list_data:
+            logger.warning(f"Listing XML data not available ({reason}), paging listings")
+            self.list_data = False
+        self.crawler.stats.inc_value("list_data/fallbacks")
+        row_meta = {
+            name: meta[name] for name in ("row_path", "row_modified") if name in meta
+        }
+        yield self.next_page_request(meta["next_page"], row_meta)
+
+    def unchanged(self, row_path, modified):
+        """
+        Whether a row is as it was at the last successful crawl, so the
+        file needn't be archived again or the folder crawled again.
+        """
+        if self.crawl_state is None or self.full_recrawl:
+            return False
+        if not self.crawl_state.unchanged(row_path, modified):
+            return False
+        if self.has_file_extension(row_path):
+            self.crawler.stats.inc_value("crawl_state/unchanged_files")
+        else:
+            self.crawler.stats.inc_value("crawl_state/unchanged_folders")
+        return True
+
+    def file_archived(self, item, response, spider):
+        if isinstance(item, FileItem) and "modified_date" in item:
+            self.crawl_state.seen(item["path"], item["modified_date"])
+
+    def file_failed(self, item, response, spider, **kwargs):
+        if isinstance(item, FileItem):
+            self.crawl_state.failed(item["path"])
+
+    def folder_failed(self, failure):
+        if self.crawl_state is not None:
+            self.crawl_state.failed(failure.request.meta["row_path"])
+
+    def callback_failed(self, failure, response, spider):
+        if "row_path" in response.meta:
+            self.crawl_state.failed(response.meta["row_path"])
+
     @staticmethod
     def has_file_extension(path):
         regex = r"^.+(\..{1,4})$"
@@ -134,8 +295,8 @@ class MfmaSpider(scrapy.Spider):
         url = urllib.parse.urlparse(response.url)
         page_item["original_url"] = response.url
         page_item["path"] = self.dedotnet(url.path)
-        body = response.selector.css(self.simple_content_css)[0].extract()
-        for x in self.fix_body(page_item, body):
+        content = response.selector.css(self.simple_content_css)[0]
+        for x in self.fix_body(page_item, content.root):
             yield x
 
         breadcrumbs_css = "#ctl00_PlaceHolderTitleBreadcrumb_siteMapPath"
@@ -144,126 +305,57 @@ class MfmaSpider(scrapy.Spider):
             page_item["breadcrumbs"] = self.breadcrumbs_html(css_match)
 
     def breadcrumbs_html(self, match):
-        breadcrumbs_html = match[0].extract()
-        breadcrumbs_html = self.fix_links(breadcrumbs_html)
-        soup = BeautifulSoup(breadcrumbs_html, "html.parser")
-        for a in soup.findAll("a"):
-            a["href"] = self.dedotnet(a["href"], indexhtml=False)
-        return str(soup)
-
-    def fix_body(self, page_item, html):
-        soup = BeautifulSoup(html, "html.parser")
-        for a in soup.findAll("a"):
-            if not "href" in a:
-                continue
-            url = a["href"]
-            if self.is_forms_url(url):
-                url = self.fix_forms_url(url)
-            purl = urllib.parse.urlparse(url)
-            if purl.scheme == "mailto":
-                continue
-            if purl.hostname:
-                abs_url = url
-            else:
-                abs_url = self.base + url
-
-            if (
-                self.has_file_extension(purl.path)
-                and not purl.path.endswith("aspx")
-                and not purl.hostname
-            ):
-                a["href"] = abs_url
-                file_item = FileItem()
-                file_item["original_url"] = abs_url
-                file_item["path"] = urllib.parse.unquote(purl.path)
-                file_item["type"] = "file"
-                yield file_item
-            elif "Authenticate" in url:
-                continue
-            elif purl.hostname == "mfma.treasury.gov.za" or not purl.hostname:
-                a["href"] = self.dedotnet(purl.path)
-                yield scrapy.Request(abs_url)
-            else:
-                pass
-
-        body = self.clean_html(str(soup))
-        page_item["body"] = body
-
-    def fix_links(self, html):
-        soup = BeautifulSoup(html, "html.parser")
-        for a in soup.findAll("a"):
-            url = a["href"]
-            purl = urllib.parse.urlparse(url)
-            if not purl.hostname:
-                url = self.base + url
-            if self.is_forms_url(url):
-                url = self.fix_forms_url(url)
-            a["href"] = url
-
-        return str(soup)
-
-    def clean_html(self, html):
-        soup = BeautifulSoup(html, "html.parser")
-        whitelist = {"src", "href", "target", "alt"}
-        cleanups = list()
-
-        # identify cleanups
-        for tag in soup.findAll(True):
-            for attr in tag.attrs.keys():
-                if attr not in whitelist:
-                    cleanups.append((tag, attr))
-
-        # perform cleanups
-        for tag, attr in cleanups:
-            del tag.attrs[attr]
-
-        html = str(soup)
-        html = re.sub(r"</?br>\s*</?br>(\s*</?br>)*", "<br><br>", html)
-        return html
+        return self.breadcrumbs_transform.transform(match[0].root, self.fix_link)
+
+    def fix_body(self, page_item, element):
+        # Body links are left as they are and not followed, as the
+        # BeautifulSoup fix_body's href check never matched
+        html = self.body_transform.transform(element)
+        page_item["body"] = re.sub(r"</?br>\s*</?br>(\s*</?br>)*", "<br><br>", html)
+        return []
+
+    def fix_link(self, url):
+        purl = urllib.parse.urlparse(url)
+        if not purl.hostname:
+            url = self.base + url
+        if self.is_forms_url(url):
+            url = self.fix_forms_url(url)
+        return self.dedotnet(url, indexhtml=False)
 
     def is_forms_url(self, url):
-        parsed = urllib.parse.urlparse(url)
-        return "RootFolder" in url
+        return is_forms_url(url)
 
     def fix_forms_url(self, url):
-        parsed_url = urllib.parse.urlparse(url)
-        parsed_qs = urllib.parse.parse_qs(parsed_url.query)
-        if "RootFolder" in parsed_qs:
-            parsed_rootfolder = urllib.parse.urlparse(parsed_qs["RootFolder"][0])
-            if parsed_url.netloc:
-                return "http://%s%s" % (parsed_url.netloc, parsed_rootfolder.path)
-            else:
-                return parsed_rootfolder.path
-        else:
-            return url
+        return fix_forms_url(url)
 
     def dedotnet(self, path, indexhtml=True, trailing_slash=True):
-        if indexhtml:
-            replacement = "/index.html"
-        else:
-            replacement = "/" if trailing_slash else ""
-        path = path.replace("/Pages/Default.aspx", replacement)
-        path = path.replace("/Pages/default.aspx", replacement)
-        path = path.replace("/Forms/AllItems.aspx", replacement)
-        path = path.replace(".aspx", replacement)
-        return path
+        return dedotnet(path, indexhtml, trailing_slash)
 
 
-def get_rows(response):
-    return response.css(".ms-vb-title .ms-unselectedtitle").xpath("../..")
+def is_forms_url(url):
+    return "RootFolder" in url
 
 
-def get_row_link_path(row_href):
-    if "RootFolder" in row_href:
-        return decode_url_root_folder(row_href)
+def fix_forms_url(url):
+    parsed_url = urllib.parse.urlparse(url)
+    parsed_qs = urllib.parse.parse_qs(parsed_url.query)
+    if "RootFolder" in parsed_qs:
+        parsed_rootfolder = urllib.parse.urlparse(parsed_qs["RootFolder"][0])
+        if parsed_url.netloc:
+            return "http://%s%s" % (parsed_url.netloc, parsed_rootfolder.path)
+        else:
+            return parsed_rootfolder.path
     else:
-        return urllib.parse.unquote(row_href)
+        return url
 
 
-def decode_url_root_folder(url):
-    querystring = urllib.parse.urlsplit(url).query
-    return urllib.parse.parse_qs(querystring)["RootFolder"][0]
-
-
-def get_user(row):
-    return " ".join(row.css(".ms-vb-user *::text").extract()).strip()
+def dedotnet(path, indexhtml=True, trailing_slash=True):
+    if indexhtml:
+        replacement = "/index.html"
+    else:
+        replacement = "/" if trailing_slash else ""
+    path = path.replace("/Pages/Default.aspx", replacement)
+    path = path.replace("/Pages/default.aspx", replacement)
+    path = path.replace("/Forms/AllItems.aspx", replacement)
+    path = path.replace(".aspx", replacement)
+    return path
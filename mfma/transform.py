@@ -0,0 +1,176 @@
+"""
+Single pass HTML transform for content pulled out of SharePoint pages.
+
+The spider used to serialise a selector, parse it again with BeautifulSoup's
+html.parser to rewrite links, serialise it, and parse it once more to strip
+attributes. HtmlTransform walks the lxml element parsel already built and
+writes exactly what that BeautifulSoup round trip wrote, so pages built
+from the feed don't change, but each page is only ever parsed once.
+"""
+
+from functools import lru_cache
+from html import unescape
+from lxml import etree
+import re
+
+
+# Tags BeautifulSoup closes as soon as they're opened, written as <tag/>
+VOID_TAGS = frozenset([
+    "area", "base", "basefont", "bgsound", "br", "col", "command", "embed",
+    "frame", "hr", "image", "img", "input", "isindex", "keygen", "link",
+    "menuitem", "meta", "nextid", "param", "source", "spacer", "track", "wbr",
+])
+
+# Tags whose text BeautifulSoup writes out without entity substitution
+RAW_TEXT_TAGS = frozenset(["script", "style"])
+
+# Tags inside which BeautifulSoup keeps whitespace-only strings as they are
+PRESERVE_WHITESPACE_TAGS = frozenset(["pre", "textarea"])
+ASCII_SPACES = " \n\t\x0c\r"
+
+# Attributes BeautifulSoup splits on whitespace and joins with a single space
+LIST_ATTRIBUTES = {
+    "*": frozenset(["class", "accesskey", "dropzone"]),
+    "a": frozenset(["rel", "rev"]),
+    "link": frozenset(["rel", "rev"]),
+    "td": frozenset(["headers"]),
+    "th": frozenset(["headers"]),
+    "form": frozenset(["accept-charset"]),
+    "object": frozenset(["archive"]),
+    "area": frozenset(["rel"]),
+    "icon": frozenset(["sizes"]),
+    "iframe": frozenset(["sandbox"]),
+    "output": frozenset(["for"]),
+}
+
+# Attributes libxml2 URI-escapes when it serialises HTML
+URI_ATTRIBUTES = frozenset(["href", "src", "action"])
+
+# Attributes libxml2 writes without a value, whatever their value
+BOOLEAN_ATTRIBUTES = frozenset([
+    "checked", "compact", "declare", "defer", "disabled", "ismap", "multiple",
+    "nohref", "noresize", "noshade", "nowrap", "readonly", "selected",
+])
+
+BR_RUN_RE = re.compile(r"<br/>(?:\s*<br/>)+")
+NON_WHITESPACE_RE = re.compile(r"\S+")
+
+
+class HtmlTransform(object):
+    """
+    Serialise an lxml element as BeautifulSoup would have after a round trip
+    through lxml's serialiser and html.parser.
+
+    - whitelist: if given, only these attributes are kept
+    - collapse_br: collapse runs of two or more <br/> into exactly two
+    """
+
+    def __init__(self, whitelist=None, collapse_br=False):
+        self.whitelist = whitelist
+        self.collapse_br = collapse_br
+
+    def transform(self, element, fix_link=None):
+        """
+        Return the HTML for element, calling fix_link with the href of every
+        <a> that has one and writing out whatever it returns instead.
+        """
+        out = []
+        self._node(element, fix_link, False, out)
+        html = "".join(out)
+        if self.collapse_br:
+            html = BR_RUN_RE.sub("<br/><br/>", html)
+        return html
+
+    def _node(self, el, fix_link, preserve, out):
+        tag = el.tag
+        if tag is etree.Comment:
+            out.append("<!--%s-->" % squash(el.text or "", preserve))
+        elif tag is etree.ProcessingInstruction:
+            if el.text:
+                pi = "%s %s" % (el.target, el.text)
+            else:
+                pi = el.target
+            out.append("<?%s>" % squash(pi, preserve))
+        elif isinstance(tag, str):
+            self._tag(el, tag, fix_link, preserve, out)
+
+    def _tag(self, el, tag, fix_link, preserve, out):
+        attrs = []
+        for name, value in el.items():
+            if self.whitelist is not None and name not in self.whitelist:
+                continue
+            if name in BOOLEAN_ATTRIBUTES:
+                value = ""
+            elif name in URI_ATTRIBUTES or (name == "name" and tag == "a"):
+                value = serialised_uri(name, value)
+            if name == "href" and tag == "a" and fix_link is not None:
+                value = fix_link(value)
+            if is_list_attribute(tag, name):
+                value = " ".join(NON_WHITESPACE_RE.findall(value))
+            attrs.append((name, value))
+        attrs.sort()
+        start = "".join(
+            [" %s=%s" % (name, quote_attribute(value)) for name, value in attrs]
+        )
+
+        if tag in VOID_TAGS:
+            # BeautifulSoup closes these straight away, so anything libxml2
+            # put inside ends up after them.
+            out.append("<%s%s/>" % (tag, start))
+            self._children(el, tag, fix_link, preserve, out)
+        else:
+            out.append("<%s%s>" % (tag, start))
+            inner = preserve or tag in PRESERVE_WHITESPACE_TAGS
+            self._children(el, tag, fix_link, inner, out)
+            out.append("</%s>" % tag)
+
+    def _children(self, el, tag, fix_link, preserve, out):
+        if el.text:
+            text = squash(el.text, preserve)
+            if tag in RAW_TEXT_TAGS:
+                out.append(text)
+            else:
+                out.append(escape(text))
+        for child in el:
+            self._node(child, fix_link, preserve, out)
+            if child.tail:
+                out.append(escape(squash(child.tail, preserve)))
+
+
+def squash(text, preserve):
+    """BeautifulSoup turns whitespace-only strings into one newline or space"""
+    if preserve or text.strip(ASCII_SPACES):
+        return text
+    return "\n" if "\n" in text else " "
+
+
+def escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def quote_attribute(value):
+    value = escape(value)
+    if '"' in value:
+        if "'" in value:
+            return '"%s"' % value.replace('"', "&quot;")
+        return "'%s'" % value
+    return '"%s"' % value
+
+
+def is_list_attribute(tag, name):
+    return name in LIST_ATTRIBUTES["*"] or name in LIST_ATTRIBUTES.get(tag, ())
+
+
+@lru_cache(maxsize=8192)
+def serialised_uri(name, value):
+    """
+    The value html.parser reads back after libxml2 serialises a URI attribute.
+
+    libxml2 strips leading blanks and percent-escapes these, and exactly how
+    differs between versions, so ask it rather than reimplement it.
+    """
+    el = etree.Element("a")
+    el.set(name, value)
+    html = etree.tostring(el, method="html", encoding="unicode")
+    quoted = html[len("<a %s" % name):-len("></a>")]
+    return unescape(quoted[2:-1])
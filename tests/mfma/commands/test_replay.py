@@ -0,0 +1,67 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+from scrapy.crawler import Crawler
+from scrapy.http import HtmlResponse, Request
+from scrapy.settings import Settings
+from mfma import disk_cache, settings as mfma_settings
+from mfma.commands import replay
+from mfma.httpcache import SqliteCacheStorage
+from mfma.spiders.mfma_spider import MfmaSpider
+
+
+FIXTURES = os.path.join(
+    os.path.dirname(__file__), "..", "spiders", "test_mfma_spider"
+)
+
+
+class ReplayTestCase(TestCase):
+    def setUp(self):
+        self.cachedir = TemporaryDirectory()
+        datadir = mock.patch.object(
+            disk_cache, "project_data_dir", lambda: self.cachedir.name
+        )
+        datadir.start()
+        self.addCleanup(datadir.stop)
+        self.settings = Settings()
+        self.settings.setmodule(mfma_settings)
+        self.settings.set("HTTPCACHE_DIR", self.cachedir.name)
+        self.settings.set(
+            "ITEM_PIPELINES",
+            replay.stub_archive_pipelines(self.settings.getdict("ITEM_PIPELINES")),
+        )
+
+        storage = SqliteCacheStorage(self.settings)
+        spider = MfmaSpider()
+        storage.open_spider(spider)
+        url = "http://mfma.treasury.gov.za/Circulars/Pages/Circular48.aspx"
+        with open(
+            os.path.join(FIXTURES, "SimpleContentTestCase_page_source.html"), "rb"
+        ) as f:
+            response = HtmlResponse(
+                url, body=f.read(), headers={"Content-Type": "text/html"}
+            )
+        storage.store_response(spider, Request(url), response)
+        storage.close_spider(spider)
+
+    def tearDown(self):
+        self.cachedir.cleanup()
+
+    def test_stub_archive_pipelines(self):
+        pipelines = self.settings.getdict("ITEM_PIPELINES")
+        self.assertIsNone(pipelines["mfma.pipelines.archive.FileArchivePipeline"])
+        self.assertEqual(100, pipelines[replay.STUB_PIPELINE])
+        self.assertEqual(100, pipelines["mfma.pipelines.DepaginatingPipeline"])
+
+    def test_replay(self):
+        crawler = Crawler(MfmaSpider, self.settings)
+        crawler.spider = crawler._create_spider(scrape_menu="false")
+        run = replay.Replay(crawler)
+        run.run(replay.cached_responses(self.settings, crawler.spider))
+
+        self.assertEqual(1, run.counts["pages"])
+        self.assertEqual(1, run.counts["PageItem"])
+        self.assertEqual(1, run.calls["page_item"])
+        stub = [p for p in run.pipelines if type(p) == replay.StubFileArchivePipeline]
+        self.assertEqual(0, stub[0].files)
+        self.assertIn("pages:", run.report())
@@ -0,0 +1,202 @@
+from mfma import disk_cache, metrics
+from mfma.items import FileItem
+from mfma.pipelines.archive import Archived, Body, FileArchivePipeline, Spool, conditional_headers
+from mfma.pipelines.local import LocalFileArchiveSink
+from scrapy.exceptions import DropItem
+from scrapy.http import Request, Response
+from scrapy.utils.test import get_crawler
+from twisted.web.iweb import UNKNOWN_LENGTH
+from unittest import TestCase
+import os
+import tempfile
+
+
+LAST_MODIFIED = 'Tue, 01 Jun 2021 10:00:00 GMT'
+OLDER = 'Mon, 01 Mar 2021 10:00:00 GMT'
+
+
+class FakeSink(object):
+    def __init__(self, archived):
+        self._archived = archived
+        self.stored = []
+        self.bodies = []
+
+    def archived(self, item):
+        return self._archived
+
+    def store(self, item, response, body, archived):
+        if not (archived and archived.is_current(*validators(response))):
+            self.stored.append(item['path'])
+            with body.open() as f:
+                self.bodies.append((body.spooled, f.read()))
+
+
+def validators(response):
+    return (
+        response.headers.get('etag').decode('utf-8'),
+        response.headers.get('last-modified').decode('utf-8'),
+    )
+
+
+class ConditionalHeadersTestCase(TestCase):
+    def test_shared_etag(self):
+        archived = [Archived('"a"', OLDER), Archived('"a"', None)]
+        self.assertEqual({'If-None-Match': '"a"'}, conditional_headers(archived))
+
+    def test_different_etags_fall_back_to_oldest_last_modified(self):
+        archived = [Archived('"a"', LAST_MODIFIED), Archived('"b"', OLDER)]
+        self.assertEqual({'If-Modified-Since': OLDER}, conditional_headers(archived))
+
+    def test_unconditional_if_any_sink_lacks_the_file(self):
+        self.assertEqual({}, conditional_headers([Archived('"a"', OLDER), None]))
+
+    def test_unconditional_without_validators(self):
+        archived = [Archived('"a"', None), Archived('', OLDER)]
+        self.assertEqual({}, conditional_headers(archived))
+
+
+class FileArchivePipelineTestCase(TestCase):
+    def setUp(self):
+        self.current = FakeSink(Archived('"new"', LAST_MODIFIED))
+        self.missing = FakeSink(None)
+        self.stats = get_crawler().stats
+        self.spool_dir = tempfile.TemporaryDirectory()
+        self.pipeline = FileArchivePipeline(
+            [self.current, self.missing],
+            self.stats,
+            spool_dir=self.spool_dir.name,
+            spool_threshold=1024,
+        )
+        self.item = FileItem(
+            path='/Documents/a.pdf',
+            original_url='http://mfma.treasury.gov.za/Documents/a.pdf',
+        )
+
+    def test_downloads_once_and_only_stale_sinks_store(self):
+        request = self.request()
+        self.assertEqual({}, request.headers)
+        response = Response(
+            request.url,
+            headers={'etag': '"new"', 'last-modified': LAST_MODIFIED},
+            request=request,
+        )
+        self.pipeline.media_downloaded(response, request, None, item=self.item)
+        self.assertEqual([], self.current.stored)
+        self.assertEqual(['/Documents/a.pdf'], self.missing.stored)
+        self.assertEqual(1, self.stats.get_value('file_archive/in_memory'))
+        self.assertEqual(0, self.pipeline.in_memory)
+
+    def test_not_modified_stores_nothing(self):
+        self.missing._archived = Archived('"new"', None)
+        request = self.request()
+        self.assertEqual(b'"new"', request.headers['If-None-Match'])
+        response = Response(request.url, status=304, request=request)
+        self.pipeline.media_downloaded(response, request, None, item=self.item)
+        self.assertEqual([], self.current.stored + self.missing.stored)
+
+    def test_large_files_are_spooled_and_removed(self):
+        request = self.request()
+        self.pipeline.headers_received({}, 10, request, None)
+        self.assertNotIn('spool', request.meta)
+        self.pipeline.headers_received({}, UNKNOWN_LENGTH, request, None)
+        unknown_length = request.meta['spool']
+        # Redirected, to the same file now of known size
+        self.pipeline.headers_received({}, 2048, request, None)
+        self.assertFalse(os.path.exists(unknown_length.path))
+        other = Request('http://x/')
+        self.pipeline.headers_received({}, 2048, other, None)
+        self.assertNotIn('spool', other.meta)
+
+        # As the download handler writes the body
+        spool = request.meta['spool']
+        for chunk in (b'x' * 1024, b'x' * 1024):
+            spool.write(chunk)
+        response = Response(
+            request.url,
+            headers={'etag': '"newer"', 'last-modified': LAST_MODIFIED},
+            body=spool.getvalue(),
+            request=request,
+        )
+        self.pipeline.media_downloaded(response, request, None, item=self.item)
+        self.assertEqual([(True, b'x' * 2048)], self.current.bodies)
+        self.assertEqual(self.current.bodies, self.missing.bodies)
+        self.assertEqual([], os.listdir(self.spool_dir.name))
+        self.assertEqual(2048, self.stats.get_value('file_archive/spooled_bytes'))
+
+    def test_spools_of_failed_downloads_are_removed(self):
+        request = self.request()
+        self.pipeline.headers_received({}, UNKNOWN_LENGTH, request, None)
+        response = Response(request.url, status=404, request=request)
+        with self.assertRaises(Exception):
+            self.pipeline.media_downloaded(response, request, None, item=self.item)
+        self.assertEqual([], os.listdir(self.spool_dir.name))
+
+    def test_stages_are_timed(self):
+        metrics.REGISTRY.clear()
+        request = self.request()
+        response = Response(request.url, status=304, request=request)
+        self.pipeline.media_downloaded(response, request, None, item=self.item)
+        stages = metrics.REGISTRY.summary()['histograms']['pipeline_seconds']
+        self.assertEqual(
+            [('FileArchivePipeline', 'get_media_requests', 1),
+             ('FileArchivePipeline', 'media_downloaded', 1)],
+            sorted((s['pipeline'], s['method'], s['count']) for s in stages),
+        )
+
+    def test_failed_files_are_dropped(self):
+        with self.assertRaises(DropItem):
+            self.pipeline.item_completed([(False, None)], self.item, None)
+        self.assertIs(self.item, self.pipeline.item_completed([(True, None)], self.item, None))
+        with self.assertRaises(DropItem):
+            FileArchivePipeline([], self.stats).process_item(self.item, None)
+
+    def tearDown(self):
+        self.spool_dir.cleanup()
+
+    def request(self):
+        archived = [sink.archived(self.item) for sink in self.pipeline.sinks]
+        self.pipeline.archived[self.item['path']] = archived
+        [request] = self.pipeline.get_media_requests(self.item, None)
+        return request
+
+
+def test_local_sink_writes_and_revalidates(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_cache, "project_data_dir", lambda: str(tmp_path))
+    directory = tmp_path / "archive"
+    sink = LocalFileArchiveSink(get_crawler().stats, str(directory))
+    item = FileItem(path="/Documents/a.pdf")
+    assert sink.archived(item) is None
+
+    sink.write(sink.file_path(item), Body(data=b"%PDF"), LAST_MODIFIED)
+    assert (directory / "Documents" / "a.pdf").read_bytes() == b"%PDF"
+    archived = sink.archived(item)
+    assert archived.last_modified == LAST_MODIFIED
+    assert archived.is_current(None, LAST_MODIFIED)
+    assert not archived.is_current(None, OLDER)
+
+
+def test_body_cleanup(tmp_path):
+    path = tmp_path / "a.spool"
+    path.write_bytes(b"%PDF")
+    body = Body(path=str(path))
+    assert body.spooled and body.size == 4
+    body.cleanup()
+    body.cleanup()
+    assert not path.exists()
+
+
+def test_spool_hashes_what_it_writes(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.write(b"%P")
+    spool.write(b"DF")
+    assert spool.getvalue() == b""
+    body = spool.body()
+    assert body.spooled and body.size == 4
+    assert body.sha256 == Body(data=b"%PDF").sha256
+    body.cleanup()
+
+    spool = Spool(str(tmp_path))
+    spool.write(b"%P")
+    # Cancelled for going over the download max size
+    spool.truncate(0)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,188 @@
+from botocore.exceptions import ClientError
+from io import BytesIO
+from unittest import TestCase
+from mfma import disk_cache
+from mfma.bandwidth import TokenBucket
+from mfma.items import FileItem
+from mfma.pipelines.archive import Archived, Body
+from mfma.pipelines.aws_s3 import EtagManifest, S3FileArchiveSink
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.trial import unittest as trial
+import tempfile
+
+
+class FakeS3(object):
+    def __init__(self):
+        self.objects = {}
+        self.metadata = {}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        self.objects[(Bucket, Key)] = Body
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        data = Fileobj.read()
+        if Callback:
+            Callback(len(data))
+        self.objects[(Bucket, Key)] = data
+        self.metadata[(Bucket, Key)] = (ExtraArgs or {}).get('Metadata', {})
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        data = self.objects[(Bucket, Key)]
+        return {
+            'Metadata': self.metadata.get((Bucket, Key), {}),
+            'ETag': '"%d"' % hash(data),
+            'ContentLength': len(data),
+        }
+
+    def copy(self, CopySource, Bucket, Key, ExtraArgs=None, **kwargs):
+        source = (CopySource['Bucket'], CopySource['Key'])
+        if source not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        if_match = (ExtraArgs or {}).get('CopySourceIfMatch')
+        if if_match and if_match != self.head_object(*source)['ETag']:
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'CopyObject')
+        self.objects[(Bucket, Key)] = self.objects[source]
+        self.metadata[(Bucket, Key)] = (ExtraArgs or {}).get('Metadata', {})
+
+
+class EtagManifestTestCase(TestCase):
+    def setUp(self):
+        self.s3 = FakeS3()
+
+    def test_round_trip(self):
+        manifest = EtagManifest(self.s3, 'bucket', 'manifest.json.gz')
+        manifest.load()
+        self.assertNotIn('Documents/a.pdf', manifest)
+        manifest.put('Documents/a.pdf', '"abc"', 'Tue, 01 Jun 2021 10:00:00 GMT', 123)
+        manifest.save()
+
+        manifest = EtagManifest(self.s3, 'bucket', 'manifest.json.gz')
+        manifest.load()
+        self.assertIn('Documents/a.pdf', manifest)
+        self.assertEqual('"abc"', manifest.get('Documents/a.pdf'))
+
+    def test_only_saves_changes(self):
+        manifest = EtagManifest(self.s3, 'bucket', 'manifest.json.gz')
+        manifest.save()
+        self.assertEqual({}, self.s3.objects)
+
+
+def s3_sink(tmp_path, monkeypatch, uploads):
+    monkeypatch.setattr(disk_cache, "project_data_dir", lambda: str(tmp_path))
+    stats = get_crawler().stats
+    sink = S3FileArchiveSink(
+        stats, "bucket", None, None, upload_budget=TokenBucket("s3_uploads", 0, stats)
+    )
+    sink.blocking = maybeDeferred
+    sink.s3 = FakeS3()
+    sink.manifest = EtagManifest(sink.s3, "bucket", "manifest.json.gz")
+    sink.upload = lambda *args: uploads.append(args[0]) or S3FileArchiveSink.upload(sink, *args)
+    return sink
+
+
+def store(sink, path, body):
+    url = "http://mfma.treasury.gov.za" + path
+    response = Response(url, headers={"content-type": "application/pdf", "etag": '"e"'})
+    sink.store(FileItem(path=path), response, body, None)
+
+
+def test_same_content_is_copied_not_uploaded(tmp_path, monkeypatch):
+    uploads = []
+    sink = s3_sink(tmp_path, monkeypatch, uploads)
+    stats = sink.stats
+
+    body = Body(data=b"%PDF circular")
+    for path in ["/Circulars/a.pdf", "/Documents/a.pdf"]:
+        store(sink, path, body)
+
+    assert uploads == ["Circulars/a.pdf"]
+    assert stats.get_value("bandwidth/s3_uploads/bytes") == body.size
+    assert sink.s3.objects[("bucket", "Documents/a.pdf")] == b"%PDF circular"
+    assert stats.get_value("file_archive/s3-file-archive/dedup_bytes_saved") == body.size
+    assert sink.manifest.get("Documents/a.pdf") == '"e"'
+
+    # The source going missing falls back to uploading
+    sink.s3.objects.clear()
+    response = Response("http://x/", headers={"content-type": "application/pdf"})
+    sink.store(FileItem(path="/Other/a.pdf"), response, body, None)
+    assert uploads == ["Circulars/a.pdf", "Other/a.pdf"]
+
+
+def test_a_key_stored_with_new_content_isnt_copied_for_its_old_content(tmp_path, monkeypatch):
+    uploads = []
+    sink = s3_sink(tmp_path, monkeypatch, uploads)
+    store(sink, "/Documents/a.pdf", Body(data=b"first"))
+    store(sink, "/Documents/a.pdf", Body(data=b"second"))
+    assert sink.content_index.get(Body(data=b"first").sha256) is None
+    store(sink, "/Documents/b.pdf", Body(data=b"first"))
+    assert uploads == ["Documents/a.pdf", "Documents/a.pdf", "Documents/b.pdf"]
+    assert sink.s3.objects[("bucket", "Documents/b.pdf")] == b"first"
+
+
+def test_a_source_changed_elsewhere_isnt_copied(tmp_path, monkeypatch):
+    uploads = []
+    sink = s3_sink(tmp_path, monkeypatch, uploads)
+    store(sink, "/Documents/a.pdf", Body(data=b"first"))
+    # Overwritten by something other than this sink
+    sink.s3.objects[("bucket", "Documents/a.pdf")] = b"second"
+    sink.s3.metadata[("bucket", "Documents/a.pdf")] = {}
+    store(sink, "/Documents/b.pdf", Body(data=b"first"))
+    assert uploads == ["Documents/a.pdf", "Documents/b.pdf"]
+    assert sink.s3.objects[("bucket", "Documents/b.pdf")] == b"first"
+
+
+class S3SinkThreadsTestCase(trial.TestCase):
+    """The sink's calls to S3 on its thread pool, as in a crawl"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        directory = directory.name
+        self.patch(disk_cache, "project_data_dir", lambda: directory)
+        stats = get_crawler().stats
+        self.sink = S3FileArchiveSink(
+            stats, "bucket", None, None, concurrent_uploads=1,
+            upload_budget=TokenBucket("s3_uploads", 0, stats),
+        )
+        self.sink.s3 = FakeS3()
+        self.sink.manifest = EtagManifest(self.sink.s3, "bucket", "manifest.json.gz")
+        self.sink.blocking.start()
+        self.addCleanup(self.sink.blocking.stop)
+        self.item = FileItem(path="/Documents/a.pdf")
+        self.response = Response(
+            "http://mfma.treasury.gov.za/Documents/a.pdf",
+            headers={"content-type": "application/pdf", "etag": '"e"'},
+        )
+
+    def test_missing_files_are_looked_up_and_uploaded(self):
+        dfd = self.sink.archived(self.item)
+        self.assertIsInstance(dfd, Deferred)
+
+        def looked_up(archived):
+            self.assertIsNone(archived)
+            return self.sink.store(self.item, self.response, Body(data=b"%PDF"), archived)
+
+        def stored(result):
+            self.assertEqual(b"%PDF", self.sink.s3.objects[("bucket", "Documents/a.pdf")])
+            self.assertEqual(Archived('"e"', ''), self.sink.archived(self.item))
+
+        return dfd.addCallback(looked_up).addCallback(stored)
+
+    def test_failed_uploads_fail_the_deferred(self):
+        def upload_fileobj(*args, **kwargs):
+            raise ClientError({"Error": {"Code": "AccessDenied"}}, "PutObject")
+
+        self.sink.s3.upload_fileobj = upload_fileobj
+        dfd = self.sink.store(self.item, self.response, Body(data=b"%PDF"), None)
+        return self.assertFailure(dfd, ClientError)
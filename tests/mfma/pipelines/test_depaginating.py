@@ -0,0 +1,117 @@
+from mfma import metrics
+from mfma.items import PageItem
+from mfma.logformatter import LogFormatter
+from mfma.pipelines import DepaginatingPipeline, HeldPage
+from scrapy.exceptions import DontCloseSpider, DropItem
+from scrapy.utils.test import get_crawler
+from unittest import mock
+import logging
+import pytest
+
+
+def page(path, labels, more_pages=False):
+    item = PageItem()
+    item["type"] = "page"
+    item["path"] = path
+    item["title"] = path
+    item["form_table_rows"] = [{"label": label, "path": path + label} for label in labels]
+    if more_pages:
+        item["more_pages"] = True
+    return item
+
+
+def pipeline(**settings):
+    crawler = get_crawler(settings_dict=settings)
+    return DepaginatingPipeline.from_crawler(crawler), crawler.stats
+
+
+def labels(item):
+    return [row["label"] for row in item["form_table_rows"]]
+
+
+def test_one_merged_item_per_listing():
+    depaginate, stats = pipeline()
+    with pytest.raises(DropItem):
+        depaginate.process_item(page("/Documents/", ["a", "b"], more_pages=True), None)
+    # Another listing in between
+    item = depaginate.process_item(page("/Circulars/", ["x"]), None)
+    assert labels(item) == ["x"]
+    with pytest.raises(DropItem):
+        depaginate.process_item(page("/Documents/", ["c"], more_pages=True), None)
+
+    item = depaginate.process_item(page("/Documents/", ["d"]), None)
+    assert labels(item) == ["a", "b", "c", "d"]
+    assert "more_pages" not in item
+    assert depaginate.listings == {}
+    assert stats.get_value("depaginate/pages_held") == 3
+    assert stats.get_value("depaginate/listings_merged") == 1
+    assert stats.get_value("depaginate/rows_held_max") == 4
+    assert stats.get_value("depaginate/rows_held") == 0
+
+
+def test_held_and_merged_pages_are_timed():
+    metrics.REGISTRY.clear()
+    depaginate, stats = pipeline()
+    with pytest.raises(HeldPage):
+        depaginate.process_item(page("/Documents/", ["a"], more_pages=True), None)
+    depaginate.process_item(page("/Documents/", ["b"]), None)
+    [stage] = metrics.REGISTRY.summary()["histograms"]["pipeline_seconds"]
+    assert (stage["pipeline"], stage["method"]) == ("DepaginatingPipeline", "process_item")
+    assert stage["count"] == 2
+
+
+def test_rows_spill_to_disk_past_the_memory_threshold(tmp_path):
+    depaginate, stats = pipeline(DEPAGINATE_MEMORY_ROWS=3, DEPAGINATE_SPILL_DIR=str(tmp_path))
+    for n in range(4):
+        with pytest.raises(DropItem):
+            depaginate.process_item(
+                page("/Documents/", [f"{n}a", f"{n}b"], more_pages=True), None
+            )
+        assert len(depaginate.listings["/Documents/"].memory) <= 3
+
+    item = depaginate.process_item(page("/Documents/", ["last"]), None)
+    assert labels(item) == ["0a", "0b", "1a", "1b", "2a", "2b", "3a", "3b", "last"]
+    assert stats.get_value("depaginate/rows_spilled") == 8
+    assert stats.get_value("depaginate/rows_held_max") == 9
+
+
+def test_incomplete_listings_are_counted_at_close():
+    depaginate, stats = pipeline()
+    with pytest.raises(DropItem):
+        depaginate.process_item(page("/Documents/", ["a"], more_pages=True), None)
+    depaginate.close_spider(None)
+    assert stats.get_value("depaginate/incomplete_listings") == 1
+
+
+def test_held_pages_are_logged_at_debug():
+    depaginate, stats = pipeline()
+    with pytest.raises(HeldPage) as excinfo:
+        depaginate.process_item(page("/Documents/", ["a"], more_pages=True), None)
+    formatter = LogFormatter()
+    log = formatter.dropped(None, excinfo.value, None, None)
+    assert log["level"] == logging.DEBUG
+    assert "item" not in log["args"]
+    log = formatter.dropped({}, DropItem("Failed"), None, None)
+    assert log["level"] == logging.WARNING
+
+
+def test_listings_without_their_last_page_are_emitted_when_idle():
+    depaginate, stats = pipeline()
+    depaginate.crawler.engine = mock.Mock()
+    with pytest.raises(DropItem):
+        depaginate.process_item(page("/Documents/", ["a", "b"], more_pages=True), None)
+    with pytest.raises(DropItem):
+        depaginate.process_item(page("/Documents/", ["c"], more_pages=True), None)
+
+    with pytest.raises(DontCloseSpider):
+        depaginate.spider_idle(None)
+    request = depaginate.crawler.engine.crawl.call_args[0][0]
+    [item] = list(request.callback(None))
+    assert labels(item) == ["a", "b", "c"]
+    assert item["incomplete"]
+    assert item["title"] == "/Documents/"
+    assert "more_pages" not in item
+    assert depaginate.listings == {}
+    assert stats.get_value("depaginate/incomplete_listings") == 1
+    # Once emitted, the spider can close
+    depaginate.spider_idle(None)
@@ -0,0 +1,308 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mfma import disk_cache
+from mfma.pipelines import ia_index
+from mfma.items import FileItem
+from mfma.pipelines.archive import Body
+from mfma.pipelines.ias3 import IAS3Client, IAS3Error, Section, header_value
+from mfma.pipelines.internet_archive import InternetArchiveFileArchiveSink
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+from twisted.trial import unittest as trial
+from urllib.parse import parse_qs, unquote, urlsplit
+import pytest
+import tempfile
+import threading
+
+
+ERROR = '<?xml version="1.0" encoding="UTF-8"?><Error><Code>%s</Code><Message>%s</Message></Error>'
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """ias3, keeping what's uploaded in memory"""
+
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        key = unquote(url.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.requests.append((self.command, key, dict(self.headers)))
+        assert self.headers["Authorization"] == "LOW key:secret"
+        if self.server.slow_downs:
+            self.server.slow_downs -= 1
+            return self.reply(503, ERROR % ("SlowDown", "Please reduce your request rate."),
+                              {"Retry-After": "3"})
+        if self.command == "HEAD":
+            if key not in self.server.objects:
+                return self.reply(404)
+            return self.reply(200, headers=self.server.objects[key][0])
+        if self.command == "POST" and "uploads" in query:
+            self.server.uploads["1"] = {}
+            return self.reply(200, "<InitiateMultipartUploadResult><UploadId>1"
+                                   "</UploadId></InitiateMultipartUploadResult>")
+        if self.command == "PUT" and "partNumber" in query:
+            self.server.uploads[query["uploadId"][0]][int(query["partNumber"][0])] = body
+            return self.reply(200, headers={"ETag": '"part%s"' % query["partNumber"][0]})
+        if self.command == "POST" and "uploadId" in query:
+            parts = self.server.uploads.pop(query["uploadId"][0])
+            self.server.objects[key] = ({}, b"".join(parts[n] for n in sorted(parts)))
+            return self.reply(200, "<CompleteMultipartUploadResult/>")
+        if self.command == "DELETE":
+            self.server.uploads.pop(query["uploadId"][0], None)
+            return self.reply(204)
+        if self.command == "PUT" and "x-amz-copy-source" in self.headers:
+            source = unquote(self.headers["x-amz-copy-source"])
+            if source not in self.server.objects:
+                return self.reply(404, ERROR % ("NoSuchKey", "No such key"))
+            body = self.server.objects[source][1]
+        if self.command == "PUT":
+            if not body and "x-amz-copy-source" not in self.headers:
+                return self.reply(400, ERROR % ("BadContent", "Empty file"))
+            metadata = {k: v for k, v in self.headers.items() if k.startswith("x-amz-meta-")}
+            self.server.objects[key] = (metadata, body)
+            return self.reply(200)
+        self.reply(405)
+
+    do_HEAD = do_GET = do_PUT = do_POST = do_DELETE = handle_request
+
+    def reply(self, status, body="", headers=None):
+        body = body.encode()
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.requests = []
+    server.objects = {}
+    server.uploads = {}
+    server.slow_downs = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def shut_down(server):
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def ias3():
+    server = serve()
+    yield server
+    shut_down(server)
+
+
+def client(server, **kwargs):
+    return IAS3Client("key", "secret", "http://%s:%d" % server.server_address, **kwargs)
+
+
+def test_head_of_missing_key_is_none(ias3):
+    assert client(ias3).head("documents_a_pdf", "/Documents/a.pdf") is None
+    assert ias3.requests[0][:2] == ("HEAD", "/documents_a_pdf//Documents/a.pdf")
+
+
+def test_slow_down_is_retried_after_retry_after(ias3):
+    ias3.slow_downs = 2
+    sleeps = []
+    retries = []
+    c = client(ias3, sleep=sleeps.append, on_retry=lambda e, d: retries.append(e.code))
+    c.put("documents_a_pdf", "/Documents/a.pdf", Section.of_bytes(b"pdf"), {})
+    assert sleeps == [3, 3]
+    assert retries == ["SlowDown", "SlowDown"]
+    # The body is sent again in full
+    assert ias3.objects["/documents_a_pdf//Documents/a.pdf"][1] == b"pdf"
+
+
+def test_gives_up_after_retries(ias3):
+    ias3.slow_downs = 5
+    c = client(ias3, retries=2, sleep=lambda delay: None)
+    with pytest.raises(IAS3Error) as excinfo:
+        c.head("documents_a_pdf", "/Documents/a.pdf")
+    assert excinfo.value.status == 503
+    assert len(ias3.requests) == 3
+
+
+def test_errors_that_arent_retried_raise(ias3):
+    c = client(ias3, sleep=lambda delay: pytest.fail("retried"))
+    with pytest.raises(IAS3Error) as excinfo:
+        c.put("documents_a_pdf", "/Documents/a.pdf", Section.of_bytes(b""), {})
+    assert excinfo.value.code == "BadContent"
+
+
+def test_section_reads_its_part_of_the_file(tmp_path):
+    path = tmp_path / "file"
+    path.write_bytes(b"0123456789")
+    read = []
+    with open(path, "rb") as f:
+        section = Section(f, 3, 4, read.append)
+        section.seek(0)
+        assert section.read() == b"3456"
+        section.seek(2)
+        assert section.read(1) == b"5"
+    assert read == [4, 1]
+
+
+def test_non_ascii_header_values_are_uri_encoded():
+    assert header_value("Budget") == "Budget"
+    assert header_value("Thabazimbi Municipality – Budget") == (
+        "uri(Thabazimbi%20Municipality%20%E2%80%93%20Budget)"
+    )
+
+
+@pytest.fixture
+def sink(ias3, tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_cache, "project_data_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(ia_index, "project_data_dir", lambda: str(tmp_path))
+    sink = InternetArchiveFileArchiveSink(
+        get_crawler().stats, "key", "secret", multipart_chunk_size=4,
+        s3_endpoint="http://%s:%d" % ias3.server_address,
+    )
+    sink.client.sleep = lambda delay: None
+    return sink
+
+
+def response(path):
+    return Response("http://mfma.treasury.gov.za" + path, headers={
+        "Last-Modified": "Tue, 01 Jun 2021 10:00:00 GMT",
+        "Content-Type": "application/pdf",
+    })
+
+
+def test_first_upload_creates_the_item(ias3, sink):
+    ias3.slow_downs = 1
+    body = Body(b"pdf")
+    assert not sink.upload(response("/Documents/a.pdf"), body, "/Documents/a.pdf", '"a"')
+    assert not sink.upload(response("/Documents/a.pdf"), body, "/Documents/a.pdf", '"a2"')
+
+    puts = [headers for method, key, headers in ias3.requests if method == "PUT"]
+    # The first was slowed down and retried
+    assert len(puts) == 3
+    created, updated = puts[1:]
+    assert created["x-archive-auto-make-bucket"] == "1"
+    assert created["x-archive-meta-collection"] == "mfmasouthafrica"
+    assert created["x-archive-meta-title"] == "a"
+    assert "x-archive-auto-make-bucket" not in updated
+
+    archived = sink.archived_key("documents_a_pdf", "/Documents/a.pdf")
+    assert archived.etag == '"a2"'
+    assert archived.last_modified == "Tue, 01 Jun 2021 10:00:00 GMT"
+
+
+def test_uploads_without_last_modified(ias3, sink):
+    undated = Response("http://mfma.treasury.gov.za/Documents/a.pdf", headers={
+        "Content-Type": "application/pdf",
+    })
+    assert not sink.upload(undated, Body(b"pdf"), "/Documents/a.pdf", '"a"')
+
+    [created] = [headers for method, key, headers in ias3.requests if method == "PUT"]
+    assert created["x-archive-auto-make-bucket"] == "1"
+    assert "x-archive-meta-date" not in created
+    assert "x-amz-meta-last-modified" not in created
+    archived = sink.archived_key("documents_a_pdf", "/Documents/a.pdf")
+    assert archived == ('"a"', None)
+
+
+def test_spooled_files_are_uploaded_in_parts(ias3, sink, tmp_path):
+    path = tmp_path / "spooled"
+    path.write_bytes(b"0123456789")
+    sink.upload(response("/Documents/a.pdf"), Body(path=str(path)), "/Documents/a.pdf", '"a"')
+    assert ias3.objects["/documents_a_pdf//Documents/a.pdf"][1] == b"0123456789"
+
+
+def test_copies_the_same_content(ias3, sink):
+    sink.upload(response("/Documents/a.pdf"), Body(b"pdf"), "/Documents/a.pdf", '"a"')
+    copied = sink.upload(
+        response("/Documents/b.pdf"), Body(b"pdf"), "/Documents/b.pdf", '"b"',
+        source="/Documents/a.pdf",
+    )
+    assert copied
+    metadata, data = ias3.objects["/documents_b_pdf//Documents/b.pdf"]
+    assert data == b"pdf"
+    assert metadata["x-amz-meta-upstream-etag"] == '"b"'
+
+
+def test_doesnt_copy_a_source_with_other_content(ias3, sink):
+    sink.upload(response("/Documents/a.pdf"), Body(b"pdf"), "/Documents/a.pdf", '"a"')
+    sink.upload(response("/Documents/a.pdf"), Body(b"new"), "/Documents/a.pdf", '"a2"')
+    copied = sink.upload(
+        response("/Documents/b.pdf"), Body(b"pdf"), "/Documents/b.pdf", '"b"',
+        source="/Documents/a.pdf",
+    )
+    assert not copied
+    assert ias3.objects["/documents_b_pdf//Documents/b.pdf"][1] == b"pdf"
+
+
+class InternetArchiveSinkThreadsTestCase(trial.TestCase):
+    """The sink's calls to ias3 on its thread pool, as in a crawl"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        directory = directory.name
+        self.patch(disk_cache, "project_data_dir", lambda: directory)
+        self.patch(ia_index, "project_data_dir", lambda: directory)
+        self.ias3 = serve()
+        self.addCleanup(shut_down, self.ias3)
+        self.sink = InternetArchiveFileArchiveSink(
+            get_crawler().stats, "key", "secret", concurrent_uploads=1,
+            s3_endpoint="http://%s:%d" % self.ias3.server_address, retries=0,
+        )
+        self.sink.index.load()
+        self.addCleanup(self.sink.index.close)
+        self.sink.blocking.start()
+        self.addCleanup(self.sink.blocking.stop)
+        self.item = FileItem(path="/Documents/a.pdf")
+
+    def test_a_new_file_is_looked_up_then_uploaded_creating_its_item(self):
+        dfd = self.sink.archived(self.item)
+
+        def looked_up(archived):
+            self.assertIsNone(archived)
+            return self.sink.store(self.item, response("/Documents/a.pdf"), Body(b"pdf"), None)
+
+        def stored(result):
+            metadata, data = self.ias3.objects["/documents_a_pdf//Documents/a.pdf"]
+            self.assertEqual(b"pdf", data)
+            [created] = [h for method, key, h in self.ias3.requests if method == "PUT"]
+            self.assertEqual("1", created["x-archive-auto-make-bucket"])
+            self.assertIn("documents_a_pdf", self.sink.index)
+
+        return dfd.addCallback(looked_up).addCallback(stored)
+
+    def test_retries_are_counted_on_the_reactor_thread(self):
+        self.ias3.slow_downs = 1
+        self.sink.client.retries = 1
+        self.sink.client.sleep = lambda delay: None
+        count_retry = self.sink.count_retry
+        threads = []
+
+        def counted(error, delay):
+            threads.append(threading.current_thread())
+            count_retry(error, delay)
+
+        self.patch(self.sink, "count_retry", counted)
+        dfd = self.sink.store(self.item, response("/Documents/a.pdf"), Body(b"pdf"), None)
+
+        def stored(result):
+            self.assertEqual([threading.main_thread()], threads)
+            stats = self.sink.stats.get_stats()
+            self.assertEqual(1, stats["file_archive/internet-archive-file-archive/retries"])
+            self.assertEqual(1, stats["file_archive/internet-archive-file-archive/slow_downs"])
+
+        return dfd.addCallback(stored)
+
+    def test_failed_uploads_fail_the_deferred(self):
+        self.ias3.slow_downs = 1
+        dfd = self.sink.store(self.item, response("/Documents/a.pdf"), Body(b"pdf"), None)
+        return self.assertFailure(dfd, IAS3Error)
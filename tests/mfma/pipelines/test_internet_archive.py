@@ -0,0 +1,121 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mfma import disk_cache
+from mfma.items import FileItem
+from mfma.pipelines import ia_index
+from mfma.pipelines.archive import Archived
+from mfma.pipelines.internet_archive import InternetArchiveFileArchiveSink
+from scrapy.utils.test import get_crawler
+from urllib.parse import parse_qs, urlsplit
+import json
+import pytest
+import threading
+
+
+def metadata(*files):
+    return {
+        "files": [
+            {"name": name, "source": "original", "upstream-etag": etag,
+             "last-modified": "Tue, 01 Jun 2021 10:00:00 GMT"}
+            for name, etag in files
+        ] + [{"name": "documents_a_pdf_meta.xml", "source": "metadata"}],
+    }
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """archive.org's scrape and metadata APIs for the server's collection"""
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        self.server.requests.append(url.path)
+        if url.path == "/services/search/v1/scrape":
+            assert query["q"] == ["collection:mfmasouthafrica"]
+            identifiers = sorted(self.server.items)
+            # One item a page, to follow the cursor
+            start = int(query.get("cursor", ["0"])[0])
+            page = {"items": [
+                {"identifier": i, "oai_updatedate": [self.server.items[i][0]]}
+                for i in identifiers[start:start + 1]
+            ]}
+            if start + 1 < len(identifiers):
+                page["cursor"] = str(start + 1)
+            self.reply(page)
+        elif url.path.startswith("/metadata/"):
+            self.reply(self.server.items[url.path[len("/metadata/"):]][1])
+        else:
+            self.send_error(404)
+
+    def reply(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(body).encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def archive_org(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_cache, "project_data_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(ia_index, "project_data_dir", lambda: str(tmp_path))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.requests = []
+    server.items = {
+        "documents_a_pdf": ("2021-06-01T10:00:00Z", metadata(("Documents/a.pdf", '"a"'))),
+        "documents_b_pdf": ("2021-06-01T10:00:00Z", metadata(("Documents/b.pdf", '"b"'))),
+    }
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def endpoint(server):
+    return "http://%s:%d" % server.server_address
+
+
+def test_refresh_only_fetches_changed_items(archive_org):
+    index = ia_index.CollectionIndex("mfmasouthafrica", endpoint(archive_org))
+    index.load()
+    assert index.apply(index.refresh()) == 2
+    assert index.complete
+    assert index.get("documents_a_pdf", "/Documents/a.pdf").etag == '"a"'
+    assert index.get("documents_a_pdf", "/Documents/other.pdf") is None
+    index.close()
+
+    archive_org.items["documents_b_pdf"] = (
+        "2021-07-01T10:00:00Z", metadata(("Documents/b.pdf", '"b2"')),
+    )
+    del archive_org.items["documents_a_pdf"]
+    archive_org.requests.clear()
+    index = ia_index.CollectionIndex("mfmasouthafrica", endpoint(archive_org))
+    index.load()
+    assert index.get("documents_b_pdf", "/Documents/b.pdf").etag == '"b"'
+    assert index.apply(index.refresh()) == 1
+    assert [p for p in archive_org.requests if p.startswith("/metadata/")] == [
+        "/metadata/documents_b_pdf",
+    ]
+    assert index.get("documents_b_pdf", "/Documents/b.pdf").etag == '"b2"'
+    assert "documents_a_pdf" not in index
+    index.close()
+
+
+def test_sink_looks_files_up_in_the_index(archive_org):
+    stats = get_crawler().stats
+    sink = InternetArchiveFileArchiveSink(stats, "key", "secret", endpoint=endpoint(archive_org))
+    sink.etag_cache.load()
+    sink.index.load()
+    sink.index.apply(sink.index.refresh())
+    sink.blocking = lambda *args: pytest.fail("looked up over the network")
+
+    archived = sink.archived(FileItem(path="/Documents/a.pdf"))
+    assert archived == Archived('"a"', "Tue, 01 Jun 2021 10:00:00 GMT")
+    assert "documents_a_pdf" in sink.buckets
+    assert sink.archived(FileItem(path="/Documents/new.pdf")) is None
+    assert stats.get_value("file_archive/internet-archive-file-archive/index_hits") == 2
+
+    sink.index.put("documents_new_pdf", "/Documents/new.pdf", '"n"', None)
+    assert sink.archived(FileItem(path="/Documents/new.pdf")).etag == '"n"'
+    sink.index.close()
@@ -0,0 +1,51 @@
+from mfma.pipelines.threads import BlockingCalls
+from twisted.trial.unittest import TestCase
+import threading
+import time
+
+
+class BlockingCallsTestCase(TestCase):
+    def setUp(self):
+        self.calls = BlockingCalls("test-pool", 1)
+        self.calls.start()
+        self.addCleanup(lambda: self.calls.pool.joined or self.calls.stop())
+
+    def test_calls_run_on_the_pool(self):
+        reactor_thread = threading.current_thread()
+        dfd = self.calls(lambda x, y=0: (threading.current_thread(), x + y), 1, y=2)
+
+        def called(result):
+            thread, value = result
+            self.assertEqual(3, value)
+            self.assertIsNot(reactor_thread, thread)
+            self.assertIn("test-pool", thread.name)
+
+        return dfd.addCallback(called)
+
+    def test_errors_are_raised_in_the_deferred(self):
+        def fail():
+            raise ValueError("failed on its thread")
+
+        return self.assertFailure(self.calls(fail), ValueError)
+
+    def test_calls_beyond_the_pool_size_wait(self):
+        running = []
+        most = []
+
+        def call():
+            running.append(1)
+            most.append(len(running))
+            time.sleep(0.01)
+            running.pop()
+
+        self.calls(call)
+        self.calls(call)
+        return self.calls(call).addCallback(lambda result: self.assertEqual([1, 1, 1], most))
+
+    def test_stop_joins_the_threads(self):
+        def stopped(result):
+            self.calls.stop()
+            self.assertTrue(self.calls.pool.joined)
+            self.assertFalse(any(thread.is_alive() for thread in self.calls.pool.threads))
+
+        return self.calls(time.sleep, 0).addCallback(stopped)
@@ -1,19 +1,30 @@
 import os
-from unittest import TestCase
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import TestCase, mock
 from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+from mfma import disk_cache, listing
 from mfma.spiders import mfma_spider
-from mfma.items import MenuItem, PageItem
+from mfma.items import MenuItem, PageItem, FileItem
 
 
 class ResponseTestCase(TestCase):
     def setUp(self):
+        self.page_source = self.read_fixture("page_source.html")
+
+    def read_fixture(self, suffix):
         with open(
             os.path.join(
                 os.path.splitext(__file__)[0],
-                self.__class__.__name__ + "_page_source.html",
+                self.__class__.__name__ + "_" + suffix,
             )
-        ) as page_source_file:
-            self.page_source = page_source_file.read()
+        ) as fixture_file:
+            return fixture_file.read()
 
 
 class ScrapeMenuTestCase(ResponseTestCase):
@@ -64,15 +75,248 @@ class FormTableContentTestCase(ResponseTestCase):
         self.page_item["type"] = "page"
         self.page_item["form_table_rows"] = []
 
-    def test_get_rows(self):
-        rows = mfma_spider.get_rows(self.response)
+    def test_extract_rows(self):
+        rows = list(listing.extract_rows(self.response.selector.root))
+        expected = [
+            {
+                "type": "table_form_item",
+                "label": row.xpath(".//tr/td/a/text()")[0].extract(),
+                "path": listing.get_row_link_path(row.xpath(".//tr/td/a/@href")[0].extract()),
+                "modified_date": row.xpath('.//td[@class="ms-vb2"]/nobr/text()')[0].extract(),
+                "user": " ".join(row.css(".ms-vb-user *::text").extract()).strip(),
+            }
+            for row in self.response.css(".ms-vb-title .ms-unselectedtitle").xpath("../..")
+        ]
         self.assertEqual(7, len(rows))
+        self.assertEqual(expected, [row.as_dict() for row in rows])
+        self.assertEqual("/Documents/01. Integrated Development Plans", rows[0].path)
 
     def test_set_form_table_content(self):
         items = list(self.spider.set_form_table_content(self.page_item, self.response))
         self.assertEqual(7, len(self.page_item["form_table_rows"]))
         self.assertEqual(7, len(items))
 
+    def test_unchanged_folders_are_skipped(self):
+        with tempfile.TemporaryDirectory() as datadir:
+            with mock.patch.object(disk_cache, "project_data_dir", lambda: datadir):
+                spider = self.crawl_state_spider()
+                spider.crawl_state.seen(
+                    "/Documents/01. Integrated Development Plans", "6/24/2010 10:07 AM"
+                )
+                spider.crawl_state.seen("/Documents/07. Audit Reports", "1/1/2011 4:12 PM")
+                spider.closed("finished")
+
+                spider = self.crawl_state_spider()
+                items = list(spider.set_form_table_content(self.page_item, self.response))
+                self.assertEqual(7, len(self.page_item["form_table_rows"]))
+                self.assertEqual(6, len(items))
+                self.assertNotIn("01.%20Integrated", " ".join(i.url for i in items))
+                self.assertEqual(
+                    1, spider.crawler.stats.get_value("crawl_state/unchanged_folders")
+                )
+                self.assertEqual(
+                    {"row_path": "/Documents/07. Audit Reports", "row_modified": "3/1/2011 4:12 PM"},
+                    {k: items[-1].meta[k] for k in ["row_path", "row_modified"]},
+                )
+                spider.closed("shutdown")
+
+                spider = self.crawl_state_spider(full_recrawl="true")
+                self.page_item["form_table_rows"] = []
+                items = list(spider.set_form_table_content(self.page_item, self.response))
+                self.assertEqual(7, len(items))
+                spider.closed("finished")
+
+    def crawl_state_spider(self, **kwargs):
+        crawler = get_crawler(mfma_spider.MfmaSpider)
+        return mfma_spider.MfmaSpider.from_crawler(crawler, **kwargs)
+
+
+LIST_DATA = """<xml xmlns:s="uuid:BDC6E3F0-6DA3-11d1-A2A3-00AA00C14882"
+     xmlns:dt="uuid:C2F41010-65B3-11d1-A29F-00AA00C14882"
+     xmlns:rs="urn:schemas-microsoft-com:rowset" xmlns:z="#RowsetSchema">
+<s:Schema id="RowsetSchema"/>
+<rs:data>%s</rs:data>
+</xml>"""
+PAGE = """<html><body>
+<span class="breadcrumbCurrent">Documents</span>
+<div class="mainContent"><table><tr><td id="MSOZoneCell_WebPartWPQ2">%s</td></tr></table></div>
+<a href="#"><img alt="Next" src="/_layouts/images/next.gif"></a>
+</body></html>"""
+LIST_DATA_ROW = (
+    '<z:row ows_FileLeafRef="%(id)s;#%(name)s" ows_Modified="%(modified)s" '
+    'ows_Editor="12;#%(user)s" ows_FileRef="%(id)s;#Documents/%(name)s" '
+    'ows_FSObjType="%(id)s;#%(folder)s"/>'
+)
+
+
+class ListingStandIn(BaseHTTPRequestHandler):
+    """A document library whose listing is paged, and its owssvr.dll"""
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        self.server.requests.append(self.path)
+        if url.path == "/_vti_bin/owssvr.dll":
+            if not self.server.list_data:
+                return self.reply(404, "Not found", "text/html")
+            return self.reply(200, self.server.xml, "text/xml")
+        return self.reply(200, self.server.page, "text/html; charset=utf-8")
+
+    def reply(self, status, body, content_type):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ListDataTestCase(TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ListingStandIn)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = "http://127.0.0.1:%d" % self.server.server_port
+        fixture = os.path.join(
+            os.path.splitext(__file__)[0], "FormTableContentTestCase_page_source.html"
+        )
+        with open(fixture) as fixture_file:
+            page = fixture_file.read()
+        # A first page of many, its view linking to the stand-in's list data
+        self.server.page = PAGE % page.replace(
+            "http://mfma.treasury.gov.za/_vti_bin/", self.base + "/_vti_bin/"
+        )
+        rows = [
+            ("01. Integrated Development Plans", "2010-06-24 10:07:00", "Elsabe Rossouw", 1),
+            ("02. Built Environment Performance Plans", "2014-06-09 10:14:00", "Elsabe Rossouw", 1),
+            ("03. Budget Documentation", "2014-06-06 16:16:00", "Elsabe Rossouw", 1),
+            ("04. Service Delivery and Budget Implementation Plans", "2016-07-19 12:05:00",
+             "Lawrence Gqesha", 1),
+            ("05. Annual Financial Statements", "2010-06-24 16:14:00", "Elsabe Rossouw", 1),
+            ("06. Annual Reports", "2010-06-24 10:08:00", "Elsabe Rossouw", 1),
+            ("07. Audit Reports", "2011-03-01 16:12:00", "Elsabe Rossouw", 1),
+            ("08. Oversight Reports", "2012-01-05 00:30:00", "Elsabe Rossouw", 1),
+            ("Municipal Budget Circular.pdf", "2021-12-03 09:00:00", "Jan Hattingh", 0),
+        ]
+        self.server.xml = LIST_DATA % "".join(
+            LIST_DATA_ROW % {
+                "id": n, "name": name, "modified": modified, "user": user, "folder": folder
+            }
+            for n, (name, modified, user, folder) in enumerate(rows, 1)
+        )
+        self.server.list_data = True
+        self.server.requests = []
+        self.datadir = tempfile.TemporaryDirectory()
+        patch = mock.patch.object(disk_cache, "project_data_dir", lambda: self.datadir.name)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.datadir.cleanup)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        crawler = get_crawler(mfma_spider.MfmaSpider)
+        self.spider = mfma_spider.MfmaSpider.from_crawler(
+            crawler, scrape_menu="false", list_data="true"
+        )
+
+    def fetch(self, request):
+        try:
+            with urllib.request.urlopen(request.url) as f:
+                status, headers, body = f.status, f.headers, f.read()
+        except urllib.error.HTTPError as e:
+            status, headers, body = e.code, e.headers, e.read()
+        return HtmlResponse(
+            request.url, status=status, headers=dict(headers), body=body, request=request
+        )
+
+    def first_page(self):
+        request = Request(self.base + "/Documents/Forms/AllItems.aspx")
+        items = list(self.spider.page_item(self.fetch(request)))
+        self.assertEqual(7, len(items[-1]["form_table_rows"]))
+        self.assertTrue(items[-1]["more_pages"])
+        return items
+
+    def test_rest_of_listing_from_list_data(self):
+        items = self.first_page()
+        html_rows = items[-1]["form_table_rows"]
+        request = items[-2]
+        self.assertEqual(self.spider.parse_list_data, request.callback)
+        self.assertEqual(
+            {"RowLimit": ["0"], "RootFolder": ["/Documents"], "CS": ["65001"],
+             "XMLDATA": ["1"], "View": ["{84CA1A01-EF8A-4DE0-8DC4-47D223CB5867}"]},
+            urllib.parse.parse_qs(urllib.parse.urlsplit(request.url).query),
+        )
+
+        items = list(self.spider.parse_list_data(self.fetch(request)))
+        page_item = items[-1]
+        self.assertEqual(
+            [
+                {"type": "table_form_item", "label": "08. Oversight Reports",
+                 "path": "/Documents/08. Oversight Reports",
+                 "modified_date": "1/5/2012 12:30 AM", "user": "Elsabe Rossouw"},
+                {"type": "table_form_item", "label": "Municipal Budget Circular.pdf",
+                 "path": "/Documents/Municipal Budget Circular.pdf",
+                 "modified_date": "12/3/2021 9:00 AM", "user": "Jan Hattingh"},
+            ],
+            page_item["form_table_rows"],
+        )
+        self.assertEqual("/Documents/", page_item["path"])
+        self.assertEqual("Documents", page_item["title"])
+        self.assertNotIn("more_pages", page_item)
+        self.assertEqual(self.base + "/Documents/08.%20Oversight%20Reports", items[0].url)
+        self.assertEqual(
+            self.base + "/Documents/Municipal Budget Circular.pdf", items[1]["original_url"]
+        )
+        self.assertEqual(1, self.spider.crawler.stats.get_value("list_data/listings"))
+
+        # The rows the listing's HTML has, its list data has the same
+        xml = listing.list_data_rows(self.server.xml.encode("utf-8"))
+        self.assertEqual(html_rows, [row.as_dict() for row in xml[:7]])
+
+    def test_falls_back_to_paging(self):
+        self.server.list_data = False
+        request = self.first_page()[-2]
+        items = list(self.spider.parse_list_data(self.fetch(request)))
+        self.assertEqual(1, len(items))
+        self.assertEqual(
+            self.base + "/Documents/Forms/AllItems.aspx"
+            "?p_FileLeafRef=07.+Audit+Reports&Paged=TRUE",
+            items[0].url,
+        )
+        self.assertEqual(1, self.spider.crawler.stats.get_value("list_data/fallbacks"))
+
+        # Later listings page without trying the list data again
+        items = self.first_page()
+        self.assertIn("Paged=TRUE", items[-2].url)
+        self.assertEqual(1, len([r for r in self.server.requests if "owssvr" in r]))
+
+
+class SimpleContentTestCase(ResponseTestCase):
+    def setUp(self):
+        super(SimpleContentTestCase, self).setUp()
+        self.response = HtmlResponse(
+            "http://mfma.treasury.gov.za/Circulars/Pages/Circular48.aspx",
+            body=self.page_source,
+            encoding="utf-8"
+        )
+        self.spider = mfma_spider.MfmaSpider()
+
+    def test_page_item(self):
+        items = list(self.spider.page_item(self.response))
+        page_item = items[-1]
+        self.assertEqual("Circular No. 48", page_item["title"])
+        self.assertEqual("/Circulars/Pages/Circular48/index.html", page_item["path"])
+        # Byte for byte what the BeautifulSoup implementation produced
+        self.assertEqual(self.read_fixture("body.html"), page_item["body"])
+        self.assertEqual(
+            self.read_fixture("breadcrumbs.html"), page_item["breadcrumbs"]
+        )
+
+    def test_body_links_left_as_they_are(self):
+        items = list(self.spider.page_item(self.response))
+        self.assertEqual([PageItem], [type(i) for i in items])
+        self.assertIn('href="/Circulars/Circular%2047.doc"', items[0]["body"])
+
 
 def test_decode_url_root_folder():
     url = (
@@ -83,5 +327,5 @@ def test_decode_url_root_folder():
     )
     assert (
         "/Documents/01. Integrated Development Plans"
-        == mfma_spider.decode_url_root_folder(url)
+        == listing.decode_url_root_folder(url)
     )
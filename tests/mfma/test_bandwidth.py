@@ -0,0 +1,76 @@
+from mfma import bandwidth
+from mfma.bandwidth import Bandwidth, TokenBucket
+from mfma.middlewares import BandwidthMiddleware
+from scrapy.http import Request
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+from twisted.internet.defer import Deferred
+
+
+class Clock(object):
+    now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_taking_more_than_the_bucket_holds_is_paid_off_at_its_rate():
+    clock = Clock()
+    stats = get_crawler().stats
+    bucket = TokenBucket("files", 100, stats, clock=clock)
+    assert stats.get_value("bandwidth/files/limit") == 100
+
+    assert bucket.take(50) == 0
+    assert bucket.take(100) == 0.5
+    assert bucket.delay() == 0.5
+    clock.now = 0.5
+    assert bucket.delay() == 0
+    # An idle bucket only saves up a second's worth
+    clock.now = 60
+    assert bucket.take(150) == 0.5
+    assert stats.get_value("bandwidth/files/bytes") == 300
+
+
+def test_unlimited_buckets_count_without_waiting():
+    stats = get_crawler().stats
+    bucket = TokenBucket("s3_uploads", 0, stats)
+    assert bucket.take(10 ** 9) == 0
+    assert bucket.delay() == 0
+
+    # As boto3's upload callbacks do, from the sink's threads
+    for sent in [100, 200, 50]:
+        bucket.consume(sent)
+    assert stats.get_value("bandwidth/s3_uploads/bytes") == 10 ** 9 + 350
+    assert stats.get_value("bandwidth/s3_uploads/throttled_seconds") is None
+
+
+def test_threads_consuming_sleep_off_the_debt(monkeypatch):
+    slept = []
+    monkeypatch.setattr(bandwidth.time, "sleep", slept.append)
+    stats = get_crawler().stats
+    bucket = TokenBucket("internet_archive_uploads", 100, stats, clock=Clock())
+    bucket.consume(100)
+    bucket.consume(50)
+    assert slept == [0.5]
+    assert stats.get_value("bandwidth/internet_archive_uploads/throttled_seconds") == 0.5
+
+
+def test_requests_wait_while_their_budget_is_in_debt():
+    crawler = get_crawler(Spider, {"BANDWIDTH_LIMITS": {"pages": 1000}})
+    spider = Spider("mfma")
+    middleware = BandwidthMiddleware.from_crawler(crawler)
+    assert Bandwidth.from_crawler(crawler) is middleware.budgets
+
+    page = Request("http://mfma.treasury.gov.za/")
+    assert middleware.process_request(page, spider) is None
+    middleware.bytes_received(b"x" * 3000, page, spider)
+    assert crawler.stats.get_value("bandwidth/pages/bytes") == 3000
+
+    delayed = middleware.process_request(page.replace(url=page.url + "Documents/"), spider)
+    assert isinstance(delayed, Deferred)
+    delayed.cancel()
+    assert 1.9 < crawler.stats.get_value("bandwidth/pages/throttled_seconds") <= 2
+
+    # File downloads have their own budget, unlimited here
+    pdf = Request("http://mfma.treasury.gov.za/a.pdf", meta={"file_archive": True})
+    assert middleware.process_request(pdf, spider) is None
@@ -0,0 +1,122 @@
+from mfma import builder as builder_module
+from mfma.builder import Builder
+import json
+import yaml
+
+
+def page(path, title, rows=()):
+    return {
+        "type": "page",
+        "path": path,
+        "original_url": "http://mfma.treasury.gov.za" + path,
+        "title": title,
+        "body": "<p>%s</p>" % title,
+        "form_table_rows": [
+            {"type": "table_form_item", "label": row, "path": row} for row in rows
+        ],
+    }
+
+
+def build(output_dir, items, **kwargs):
+    builder = Builder(str(output_dir))
+    builder.load_manifest()
+    for item in items:
+        builder.handle_item(json.loads(json.dumps(item)))
+    return builder.finish(**kwargs)
+
+
+def test_only_changes_are_written(tmp_path):
+    items = [
+        {"type": "menu", "menu_items": [{"url": "/Documents/", "text": "Documents"}]},
+        page("/Documents", "Documents", ["/Documents/Budgets", "/Documents/a.pdf"]),
+        page("/Documents/Budgets", "Budgets"),
+        page("/Circulars", "Circulars"),
+    ]
+    summary = build(tmp_path, items)
+    assert summary["added"] == [
+        "/Circulars/index.html",
+        "/Documents/Budgets/index.html",
+        "/Documents/index.html",
+        "_data/menu.json",
+    ]
+    assert json.loads((tmp_path / "_data" / "menu.json").read_text())[0]["text"] == "Documents"
+    budgets = tmp_path / "Documents" / "Budgets" / "index.html"
+    mtime = budgets.stat().st_mtime_ns
+
+    items[2] = page("/Documents/Budgets", "Budgets")
+    items[3] = page("/Circulars", "MFMA Circulars")
+    summary = build(tmp_path, items)
+    assert summary["added"] == []
+    assert summary["changed"] == ["/Circulars/index.html"]
+    assert summary["removed"] == []
+    assert budgets.stat().st_mtime_ns == mtime
+    assert "MFMA Circulars" in (tmp_path / "Circulars" / "index.html").read_text()
+
+
+def test_removed_pages_are_deleted_unless_their_folder_is_listed(tmp_path):
+    build(tmp_path, [
+        page("/Documents", "Documents", ["/Documents/Budgets"]),
+        page("/Documents/Budgets", "Budgets"),
+        page("/Documents/Budgets/2010", "2010"),
+        page("/Circulars", "Circulars"),
+    ])
+
+    # Budgets wasn't crawled because it was unchanged, Circulars is gone
+    summary = build(tmp_path, [
+        page("/Documents", "Documents", ["/Documents/Budgets"]),
+    ])
+    assert summary["removed"] == ["/Circulars/index.html"]
+    assert not (tmp_path / "Circulars").exists()
+    assert (tmp_path / "Documents" / "Budgets" / "2010" / "index.html").exists()
+    assert "/Documents/Budgets/2010/index.html" in summary["unchanged"]
+
+    summary = build(tmp_path, [page("/Documents", "Documents")], keep_removed=True)
+    assert summary["removed"] == []
+    assert (tmp_path / "Documents" / "Budgets" / "index.html").exists()
+
+
+def test_pages_gone_from_a_recrawled_folder_are_removed(tmp_path):
+    build(tmp_path, [
+        page("/Documents", "Documents", ["/Documents/Budgets"]),
+        page("/Documents/Budgets", "Budgets", ["/Documents/Budgets/2010"]),
+        page("/Documents/Budgets/2010", "2010"),
+    ])
+
+    # Budgets was crawled again, and no longer lists 2010
+    summary = build(tmp_path, [
+        page("/Documents", "Documents", ["/Documents/Budgets"]),
+        page("/Documents/Budgets", "Budgets"),
+    ])
+    assert summary["removed"] == ["/Documents/Budgets/2010/index.html"]
+    assert not (tmp_path / "Documents" / "Budgets" / "2010").exists()
+
+
+def test_parallel_build_writes_the_same_site(tmp_path):
+    items = [
+        {"type": "menu", "menu_items": [{"url": "/Documents/", "text": "Documents"}]},
+        page("/Documents", "Documents", ["/Documents/Budgets", "/Documents/a b.pdf"]),
+        page("/Documents/Budgets", "Budgets"),
+        # A paged listing, the last page written wins
+        page("/Documents/Budgets", "Budgets page 2"),
+    ] + [page("/Circulars/%d" % n, "Circular %d" % n) for n in range(40)]
+    serial = build(tmp_path / "serial", items)
+
+    builder = Builder(str(tmp_path / "parallel"))
+    builder.load_manifest()
+    builder.write_pages((json.loads(json.dumps(item)) for item in items), jobs=2)
+    assert builder.finish() == serial
+    for filename in serial["added"]:
+        parallel_file = tmp_path / "parallel" / filename.lstrip("/")
+        serial_file = tmp_path / "serial" / filename.lstrip("/")
+        assert parallel_file.read_text() == serial_file.read_text()
+    assert "Budgets page 2" in (
+        tmp_path / "parallel" / "Documents" / "Budgets" / "index.html"
+    ).read_text()
+
+
+def test_front_matter_is_the_same_with_either_dumper(monkeypatch):
+    item = page("/Documents", "Documents: 'MFMA' – 2020", ["/Documents/a b.pdf"])
+    filename, pagestr, folders = builder_module.render_page(json.loads(json.dumps(item)))
+    monkeypatch.setattr(builder_module, "SafeDumper", yaml.SafeDumper)
+    _, python_pagestr, _ = builder_module.render_page(json.loads(json.dumps(item)))
+    assert pagestr == python_pagestr
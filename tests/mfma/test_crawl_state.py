@@ -0,0 +1,43 @@
+import pytest
+from mfma import disk_cache
+from mfma.crawl_state import CrawlState
+
+
+@pytest.fixture
+def datadir(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_cache, "project_data_dir", lambda: str(tmp_path))
+    return tmp_path
+
+
+def test_only_commit_persists(datadir):
+    state = CrawlState()
+    state.seen("/Documents/Budgets", "6/24/2010 10:07 AM")
+    assert not state.unchanged("/Documents/Budgets", "6/24/2010 10:07 AM")
+    state.close()
+
+    state = CrawlState()
+    state.load()
+    assert not state.unchanged("/Documents/Budgets", "6/24/2010 10:07 AM")
+    state.seen("/Documents/Budgets", "6/24/2010 10:07 AM")
+    state.commit()
+    state.close()
+
+    state = CrawlState()
+    state.load()
+    assert state.unchanged("/Documents/Budgets", "6/24/2010 10:07 AM")
+    assert not state.unchanged("/Documents/Budgets", "7/1/2010 9:00 AM")
+
+
+def test_failures_hold_back_their_folders(datadir):
+    state = CrawlState()
+    state.seen("/Documents", "1")
+    state.seen("/Documents/Budgets", "2")
+    state.seen("/Documents/Budgets 2011", "3")
+    state.seen("/Documents/Budgets/2010/a.pdf", "4")
+    state.failed("/Documents/Budgets/2010/b.pdf")
+    state.commit()
+
+    assert not state.unchanged("/Documents", "1")
+    assert not state.unchanged("/Documents/Budgets", "2")
+    assert state.unchanged("/Documents/Budgets 2011", "3")
+    assert state.unchanged("/Documents/Budgets/2010/a.pdf", "4")
@@ -0,0 +1,137 @@
+from mfma import deltas
+from mfma.deltas import DeltaFeed
+from mfma.items import FileItem, MenuItem, PageItem
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+import json
+
+
+def page(path, rows=(), title=None):
+    return PageItem(
+        type="page",
+        path=path,
+        original_url="http://mfma.treasury.gov.za" + path,
+        title=title or path,
+        body="<p>%s</p>" % path,
+        form_table_rows=[{"type": "table_form_item", "path": row} for row in rows],
+    )
+
+
+def file(path, modified="2021/06/01 10:00"):
+    return FileItem(type="file", path=path, modified_date=modified,
+                    original_url="http://mfma.treasury.gov.za" + path)
+
+
+def crawl(tmp_path, items, reason="finished", partial=False, job_dir=None):
+    """Scrape items, returning the changes written to the delta feed"""
+    settings = {"DELTA_FEED_ENABLED": True, "DELTA_FEED": str(tmp_path / "delta.jsonlines")}
+    if job_dir:
+        settings["CRAWL_JOB_DIR"] = job_dir
+    crawler = get_crawler(settings_dict=settings)
+    spider = Spider("mfma")
+    spider.partial = partial
+    extension = DeltaFeed.from_crawler(crawler)
+    extension.spider_opened(spider)
+    for item in items:
+        extension.item_scraped(item, None, spider)
+    extension.spider_closed(spider, reason)
+    if job_dir:
+        crawler.job.close(reason)
+    with open(tmp_path / "delta.jsonlines") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_only_changes_are_written(tmp_path, monkeypatch):
+    monkeypatch.setattr(deltas, "project_data_dir", lambda: str(tmp_path))
+    menu = MenuItem(type="menu", menu_items=[{"url": "/Documents/", "text": "Documents"}])
+    first = [
+        menu,
+        page("/Documents/", ["/Documents/Budgets", "/Documents/Circulars", "/Documents/a.pdf"]),
+        page("/Documents/Budgets/", ["/Documents/Budgets/b.pdf"]),
+        page("/Documents/Circulars/", ["/Documents/Circulars/c.pdf"]),
+        file("/Documents/a.pdf"),
+        file("/Documents/Budgets/b.pdf"),
+        file("/Documents/Circulars/c.pdf"),
+    ]
+    changes = crawl(tmp_path, first)
+    assert [c["change"] for c in changes] == ["added"] * 7
+    assert changes[1]["item"]["path"] == "/Documents/"
+
+    # Budgets hasn't changed so isn't crawled, a.pdf is gone, c.pdf changed
+    second = [
+        menu,
+        page("/Documents/", ["/Documents/Budgets", "/Documents/Circulars"], title="Docs"),
+        page("/Documents/Circulars/", ["/Documents/Circulars/c.pdf"]),
+        file("/Documents/Circulars/c.pdf", modified="2021/07/01 10:00"),
+    ]
+    changes = crawl(tmp_path, second)
+    assert changes == [
+        {"change": "changed", "type": "page", "path": "/Documents/",
+         "fields": {"title": "Docs", "form_table_rows": [
+             {"type": "table_form_item", "path": "/Documents/Budgets"},
+             {"type": "table_form_item", "path": "/Documents/Circulars"},
+         ]}},
+        {"change": "changed", "type": "file", "path": "/Documents/Circulars/c.pdf",
+         "fields": {"modified_date": "2021/07/01 10:00"}},
+        {"change": "removed", "type": "file", "path": "/Documents/a.pdf"},
+    ]
+
+    # Nothing changed
+    assert crawl(tmp_path, second) == []
+
+
+def test_an_unfinished_crawl_leaves_the_index_as_it_was(tmp_path, monkeypatch):
+    monkeypatch.setattr(deltas, "project_data_dir", lambda: str(tmp_path))
+    crawl(tmp_path, [page("/Documents/", ["/Documents/a.pdf"]), file("/Documents/a.pdf")])
+
+    changes = crawl(tmp_path, [page("/Documents/", [], title="Docs")], reason="shutdown")
+    assert [c["change"] for c in changes] == ["changed"]
+
+    # A partial crawl doesn't remove what it didn't reach
+    changes = crawl(tmp_path, [page("/Documents/", [])], partial=True)
+    assert [c["change"] for c in changes] == ["changed"]
+    changes = crawl(tmp_path, [page("/Documents/", [])])
+    assert changes == [{"change": "removed", "type": "file", "path": "/Documents/a.pdf"}]
+
+
+def test_an_incomplete_listing_removes_nothing_in_its_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(deltas, "project_data_dir", lambda: str(tmp_path))
+    rows = ["/Documents/a.pdf", "/Documents/b.pdf"]
+    crawl(tmp_path, [page("/Documents/", rows), file(rows[0]), file(rows[1])])
+
+    partial = page("/Documents/", rows[:1])
+    partial["incomplete"] = True
+    changes = crawl(tmp_path, [partial, file(rows[0])])
+    assert [c["change"] for c in changes] == ["changed"]
+
+
+def test_a_resumed_crawl_appends_what_it_hasnt_written(tmp_path, monkeypatch):
+    monkeypatch.setattr(deltas, "project_data_dir", lambda: str(tmp_path))
+    job_dir = str(tmp_path / "job")
+    changes = crawl(tmp_path, [page("/Documents/", ["/Documents/a.pdf"])],
+                    reason="shutdown", job_dir=job_dir)
+    assert len(changes) == 1
+
+    changes = crawl(tmp_path, [page("/Documents/", ["/Documents/a.pdf"]), file("/Documents/a.pdf")],
+                    job_dir=job_dir)
+    assert [(c["change"], c["path"]) for c in changes] == [
+        ("added", "/Documents/"), ("added", "/Documents/a.pdf"),
+    ]
+    assert crawl(tmp_path, [page("/Documents/", ["/Documents/a.pdf"])]) == []
+
+
+def test_changes_are_on_disk_before_theyre_committed_as_staged(tmp_path, monkeypatch):
+    monkeypatch.setattr(deltas, "project_data_dir", lambda: str(tmp_path))
+    crawler = get_crawler(settings_dict={
+        "DELTA_FEED_ENABLED": True, "DELTA_FEED": str(tmp_path / "delta.jsonlines"),
+    })
+    extension = DeltaFeed.from_crawler(crawler)
+    extension.index.commit_every = 1
+    spider = Spider("mfma")
+    extension.spider_opened(spider)
+    extension.item_scraped(file("/Documents/a.pdf"), None, spider)
+    # Committed, as if the crawl were then killed
+    assert extension.index.fields("file:/Documents/a.pdf", "staged")
+    with open(tmp_path / "delta.jsonlines") as f:
+        assert [json.loads(line)["path"] for line in f] == ["/Documents/a.pdf"]
+    extension.spider_closed(spider, "shutdown")
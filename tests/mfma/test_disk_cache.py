@@ -0,0 +1,83 @@
+import hashlib
+import os
+import pytest
+from mfma import disk_cache
+from mfma.disk_cache import DiskCache
+
+
+@pytest.fixture
+def datadir(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_cache, "project_data_dir", lambda: str(tmp_path))
+    return tmp_path
+
+
+def test_get_put_persists(datadir):
+    cache = DiskCache("test", commit_every=2)
+    assert cache.get("/a.pdf") is None
+    cache.put("/a.pdf", '"etag-a"')
+    assert cache.get("/a.pdf") == '"etag-a"'
+    cache.close()
+
+    cache = DiskCache("test")
+    cache.load()
+    assert cache.get("/a.pdf") == '"etag-a"'
+    assert cache.get("/b.pdf") is None
+
+
+def test_batches_commits(datadir):
+    cache = DiskCache("test", commit_every=2)
+    cache.put("/a.pdf", "a")
+    assert cache.pending
+    cache.put("/b.pdf", "b")
+    assert not cache.pending
+    cache.close()
+
+
+def test_reads_through_lru(datadir):
+    cache = DiskCache("test", lru_size=1)
+    cache.put("/a.pdf", "a")
+    cache.put("/b.pdf", "b")
+    cache.flush()
+    assert list(cache.lru.values()) == ["b"]
+    assert cache.get("/a.pdf") == "a"
+    assert list(cache.lru.values()) == ["a"]
+    cache.close()
+
+
+def test_unflushed_entries_pushed_out_of_the_lru_are_found(datadir):
+    cache = DiskCache("test", lru_size=1)
+    cache.put("/a.pdf", "a")
+    cache.flush()
+    cache.put("/a.pdf", "a2")
+    cache.put("/b.pdf", "b")
+    assert list(cache.lru.values()) == ["b"]
+    assert cache.get("/a.pdf") == "a2"
+    cache.close()
+
+
+def test_delete(datadir):
+    cache = DiskCache("test")
+    cache.put("/a.pdf", "a")
+    cache.flush()
+    cache.delete("/a.pdf")
+    assert cache.get("/a.pdf") is None
+    cache.close()
+
+    cache = DiskCache("test")
+    assert cache.get("/a.pdf") is None
+    cache.close()
+
+
+def test_migrates_directory_layout(datadir):
+    key = "Documents/a.pdf"
+    filename = hashlib.sha256(key.encode("utf8")).hexdigest()
+    shard = datadir / "test" / filename[:2]
+    shard.mkdir(parents=True)
+    (shard / filename).write_text('"etag"')
+
+    cache = DiskCache("test")
+    cache.load()
+    assert cache.get(key) == '"etag"'
+    assert not os.path.exists(datadir / "test")
+    assert os.path.exists(datadir / "test.migrated")
+    cache.close()
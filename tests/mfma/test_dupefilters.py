@@ -0,0 +1,71 @@
+from mfma.dupefilters import CanonicalDupeFilter, canonical_url
+from mfma.spiders.mfma_spider import MfmaSpider
+from scrapy.http import Request
+from scrapy.utils.test import get_crawler
+
+
+BASE = "http://mfma.treasury.gov.za"
+
+
+def test_spellings_of_a_page_have_one_canonical_url():
+    assert canonical_url(BASE + "/Pages/Default.aspx") == canonical_url(
+        BASE + "/Pages/default.aspx"
+    )
+    assert canonical_url(BASE + "/Pages/Default.aspx") == canonical_url(BASE + "/")
+    folder = canonical_url(BASE + "/Documents/07.%20Audit%20Reports/")
+    assert folder == canonical_url(
+        BASE + "/Documents/07. Audit Reports/Forms/AllItems.aspx"
+    )
+    assert folder == canonical_url(
+        BASE + "/Documents/Forms/AllItems.aspx"
+        "?RootFolder=%2FDocuments%2F07%2E%20Audit%20Reports"
+        "&FolderCTID=0x012000"
+    )
+    assert canonical_url(BASE + "/Circulars/Pages/Circular48.aspx") != folder
+
+
+def test_case_and_view_parameters_dont_make_another_page():
+    assert canonical_url(BASE + "/Pages/DEFAULT.aspx") == canonical_url(BASE + "/")
+    folder = canonical_url(BASE + "/Documents/Budgets/")
+    assert folder == canonical_url(BASE + "/documents/BUDGETS/Forms/allitems.aspx")
+    assert folder == canonical_url(
+        BASE + "/Documents/Forms/AllItems.aspx?RootFolder=%2FDocuments%2FBudgets"
+        "&View=%7B6C6F1B1E%2D9A1A%2D4D0B%2DB6B1%2D2F5B2F0C1D9E%7D"
+        "&InitialTabId=Ribbon%2EDocument&VisibilityContext=WSSTabPersistence"
+    )
+    assert canonical_url(BASE + "/Circulars/Pages/CIRCULAR48.aspx") == canonical_url(
+        BASE + "/circulars/pages/Circular48.aspx"
+    )
+
+
+def test_pages_of_a_listing_are_not_duplicates():
+    first = canonical_url(BASE + "/Documents/07. Audit Reports")
+    paged = canonical_url(
+        BASE + "/Documents/07. Audit Reports?p_FileLeafRef=x.pdf&Paged=TRUE"
+    )
+    assert first != paged
+    assert paged == canonical_url(
+        BASE + "/Documents/07. Audit Reports/?Paged=TRUE&p_FileLeafRef=x.pdf"
+    )
+
+
+def test_duplicates_are_filtered_and_counted():
+    crawler = get_crawler(MfmaSpider)
+    dupefilter = CanonicalDupeFilter.from_crawler(crawler)
+    dupefilter.open()
+
+    assert not dupefilter.request_seen(Request(BASE + "/Documents/Budgets"))
+    assert dupefilter.request_seen(Request(BASE + "/Documents/Budgets/Forms/AllItems.aspx"))
+    assert dupefilter.request_seen(Request(BASE + "/Documents/Budgets"))
+    assert crawler.stats.get_value("dupefilter/canonical_duplicates") == 1
+
+    # SharePoint redirecting a folder to its listing isn't a duplicate
+    redirected = Request(
+        BASE + "/Documents/Circulars/Forms/AllItems.aspx",
+        meta={"redirect_urls": [BASE + "/Documents/Circulars"]},
+    )
+    assert not dupefilter.request_seen(Request(BASE + "/Documents/Circulars"))
+    assert not dupefilter.request_seen(redirected)
+
+    dupefilter.close("finished")
+    assert crawler.stats.get_value("dupefilter/canonical_url_cache_hits") > 0
@@ -0,0 +1,78 @@
+from mfma import feeds
+from mfma.builder import read_feed
+from mfma.feeds import GzipJsonLinesItemExporter, open_feed
+from mfma.jobs import Job, prepare
+import json
+import pytest
+
+
+def export(path, items, flush_interval=30):
+    with open(path, "ab") as f:
+        exporter = GzipJsonLinesItemExporter(f, flush_interval=flush_interval)
+        exporter.start_exporting()
+        for item in items:
+            exporter.export_item(item)
+        exporter.finish_exporting()
+        assert not f.closed
+
+
+def test_compressed_feed_is_read_as_a_stream(tmp_path):
+    path = str(tmp_path / "feed.jsonlines.gz")
+    export(path, [{"type": "page", "path": "/a"}, {"type": "page", "path": "/b"}])
+    # A resumed crawl appends another gzip member
+    export(path, [{"type": "menu", "menu_items": []}])
+
+    assert feeds.compression(path) == "gzip"
+    assert [item["type"] for item in read_feed(path)] == ["page", "page", "menu"]
+
+
+def test_compressed_exporters_need_a_compressor(tmp_path):
+    with open(tmp_path / "feed.jsonlines", "wb") as f:
+        with pytest.raises(TypeError):
+            feeds.CompressedJsonLinesItemExporter(f)
+
+
+def test_flushed_items_can_be_read_before_the_feed_is_finished(tmp_path):
+    path = str(tmp_path / "feed.jsonlines.gz")
+    with open(path, "wb") as f:
+        exporter = GzipJsonLinesItemExporter(f, flush_interval=0)
+        exporter.start_exporting()
+        exporter.export_item({"path": "/a"})
+        exporter.export_item({"path": "/b"})
+        data = b"".join(feeds.decompressed_chunks(path, "gzip"))
+        exporter.finish_exporting()
+    assert data.splitlines() == [b'{"path": "/a"}', b'{"path": "/b"}']
+
+
+def test_prepare_trims_a_partial_line_from_a_compressed_feed(tmp_path):
+    job_dir = str(tmp_path / "job")
+    feed = str(tmp_path / "feed.jsonlines.gz")
+    assert prepare(job_dir, feed) == feed
+    job = Job(job_dir)
+    job.open()
+    job.db.commit()
+    job.db.close()
+
+    with open(feed, "wb") as f:
+        exporter = GzipJsonLinesItemExporter(f, flush_interval=0)
+        exporter.start_exporting()
+        exporter.export_item({"path": "/a"})
+        # Cut short mid-item and mid-stream
+        exporter.file.write(b'{"path": "/b')
+        exporter.file.flush()
+        f.write(b"\x00\x01")
+
+    assert prepare(job_dir, str(tmp_path / "second.jsonlines.gz")) == feed
+    with open_feed(feed) as f:
+        assert [json.loads(line) for line in f] == [{"path": "/a"}]
+
+    export(feed, [{"path": "/b"}])
+    assert [item["path"] for item in read_feed(feed)] == ["/a", "/b"]
+
+
+def test_uncompressed_feeds_are_still_read(tmp_path):
+    path = str(tmp_path / "feed.jsonlines")
+    with open(path, "w") as f:
+        f.write('{"type": "page"}\n')
+    assert feeds.compression(path) is None
+    assert list(read_feed(path)) == [{"type": "page"}]
@@ -0,0 +1,130 @@
+from email.utils import formatdate
+from mfma.httpcache import SqliteCacheStorage, import_filesystem_cache
+from mfma.middlewares import RevalidatingCacheMiddleware
+from scrapy.extensions.httpcache import FilesystemCacheStorage
+from scrapy.http import HtmlResponse, Request, Response
+from scrapy.settings import Settings
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+import os
+import time
+
+
+URL = "http://mfma.treasury.gov.za/Documents/"
+
+
+def cache_settings(tmp_path, **settings):
+    return Settings(dict({
+        "HTTPCACHE_DIR": str(tmp_path / "httpcache"),
+        "HTTPCACHE_EXPIRATION_SECS": 0,
+        "HTTPCACHE_GZIP": True,
+    }, **settings))
+
+
+def response(url, body=b"<html>listing</html>"):
+    return HtmlResponse(url, body=body, headers={"Etag": '"1"', "Content-Type": "text/html"})
+
+
+def test_responses_round_trip(tmp_path):
+    spider = Spider("mfma")
+    storage = SqliteCacheStorage(cache_settings(tmp_path))
+    storage.open_spider(spider)
+    assert storage.retrieve_response(spider, Request(URL)) is None
+    storage.store_response(spider, Request(URL), response(URL))
+    storage.close_spider(spider)
+    assert os.listdir(tmp_path / "httpcache") == ["mfma.sqlite"]
+
+    storage = SqliteCacheStorage(cache_settings(tmp_path))
+    storage.open_spider(spider)
+    cached = storage.retrieve_response(spider, Request(URL))
+    assert isinstance(cached, HtmlResponse)
+    assert (cached.url, cached.status, cached.body) == (URL, 200, b"<html>listing</html>")
+    assert cached.headers["Etag"] == b'"1"'
+
+
+def test_old_and_oldest_entries_are_evicted(tmp_path):
+    spider = Spider("mfma")
+    storage = SqliteCacheStorage(cache_settings(
+        tmp_path, HTTPCACHE_EXPIRATION_SECS=3600, HTTPCACHE_MAX_SIZE=3000,
+    ))
+    storage.open_spider(spider)
+    storage.put("expired", URL, URL, 200, b"", b"x", time.time() - 7200)
+    for n in range(10):
+        url = f"{URL}?p={n}"
+        storage.store_response(spider, Request(url), response(url, os.urandom(500)))
+    storage.close_spider(spider)
+
+    storage.open_spider(spider)
+    assert storage.size <= 3000 * 0.9
+    kept = [
+        n for n in range(10)
+        if storage.retrieve_response(spider, Request(f"{URL}?p={n}"))
+    ]
+    assert kept == list(range(10 - len(kept), 10))
+    assert storage.db.execute("SELECT count(*) FROM responses WHERE fingerprint = 'expired'").fetchone() == (0,)
+
+
+def test_import_filesystem_cache(tmp_path):
+    spider = Spider("mfma")
+    settings = cache_settings(tmp_path)
+    filesystem = FilesystemCacheStorage(settings)
+    for n in range(3):
+        url = f"{URL}?p={n}"
+        filesystem.store_response(spider, Request(url), response(url))
+
+    assert import_filesystem_cache(str(tmp_path / "httpcache"), settings) == 3
+    storage = SqliteCacheStorage(settings)
+    storage.open_spider(spider)
+    cached = storage.retrieve_response(spider, Request(f"{URL}?p=2"))
+    assert cached.body == b"<html>listing</html>"
+    assert cached.headers["Etag"] == b'"1"'
+
+
+def test_pages_with_validators_are_revalidated(tmp_path):
+    crawler = get_crawler(Spider, {
+        "HTTPCACHE_ENABLED": True,
+        "HTTPCACHE_DIR": str(tmp_path / "httpcache"),
+        "HTTPCACHE_POLICY": "mfma.httpcache.RevalidatingPolicy",
+        "HTTPCACHE_STORAGE": "mfma.httpcache.SqliteCacheStorage",
+        "HTTPCACHE_FRESHNESS_SECS": 3600,
+    })
+    spider = Spider("mfma")
+    middleware = RevalidatingCacheMiddleware.from_crawler(crawler)
+    middleware.spider_opened(spider)
+    stats = crawler.stats
+    other = URL + "Other.aspx"
+    for url in [URL, other]:
+        request = Request(url)
+        assert middleware.process_request(request, spider) is None
+        downloaded = response(url)
+        if url == other:
+            del downloaded.headers["Etag"]
+        middleware.process_response(request, downloaded, spider)
+    assert stats.get_value("httpcache/pages_downloaded") == 2
+
+    # A page with an etag is requested conditionally, and a 304 replays it
+    request = Request(URL)
+    assert middleware.process_request(request, spider) is None
+    assert request.headers["If-None-Match"] == b'"1"'
+    replayed = middleware.process_response(request, Response(URL, status=304), spider)
+    assert replayed.status == 200
+    assert replayed.body == b"<html>listing</html>"
+    assert stats.get_value("httpcache/pages_revalidated") == 1
+    assert stats.get_value("httpcache/revalidated_bytes_saved") == len(replayed.body)
+
+    # A changed page is downloaded and cached again
+    request = Request(URL)
+    middleware.process_request(request, spider)
+    middleware.process_response(request, response(URL, b"<html>changed</html>"), spider)
+    assert stats.get_value("httpcache/pages_downloaded") == 3
+    request = Request(URL)
+    middleware.process_request(request, spider)
+    replayed = middleware.process_response(request, Response(URL, status=304), spider)
+    assert replayed.body == b"<html>changed</html>"
+
+    # One without validators is reused while it's fresh
+    cached = middleware.process_request(Request(other), spider)
+    assert "cached" in cached.flags
+    stale = HtmlResponse(other, headers={"Date": formatdate(time.time() - 7200, usegmt=True)})
+    assert not middleware.policy.is_cached_response_fresh(stale, Request(other))
+    middleware.spider_closed(spider)
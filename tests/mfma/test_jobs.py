@@ -0,0 +1,150 @@
+from mfma import disk_cache
+from mfma.dupefilters import canonical_fingerprint
+from mfma.feeds import SyncedJsonLinesItemExporter
+from mfma.items import PageItem
+from mfma.jobs import Job, prepare
+from mfma.middlewares import ResumeMiddleware
+from mfma.pipelines import DepaginatingPipeline
+from mfma.spiders.mfma_spider import MfmaSpider
+from scrapy import signals
+from scrapy.exceptions import DropItem
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+import pytest
+
+
+BASE = "http://mfma.treasury.gov.za"
+
+
+def crawl(job_dir):
+    crawler = get_crawler(MfmaSpider, {"CRAWL_JOB_DIR": str(job_dir)})
+    spider = MfmaSpider.from_crawler(crawler)
+    return crawler, spider
+
+
+def parsed(middleware, spider, url, output, meta=None):
+    response = HtmlResponse(url, body=b"", request=Request(url, meta=meta or {}))
+    return list(middleware.process_spider_output(response, iter(output), spider))
+
+
+def listing_page(rows, more_pages):
+    item = PageItem(type="page", path="/Documents/", form_table_rows=rows)
+    if more_pages:
+        item["more_pages"] = True
+    return item
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(disk_cache, "project_data_dir", lambda: str(tmp_path))
+
+
+def test_an_interrupted_crawl_resumes_where_it_got_to(tmp_path):
+    job_dir = tmp_path / "job"
+    crawler, spider = crawl(job_dir)
+    middleware = ResumeMiddleware.from_crawler(crawler)
+    depaginate = DepaginatingPipeline.from_crawler(crawler)
+    assert not crawler.job.resuming
+
+    [start] = list(middleware.process_start_requests([Request(BASE + "/")], spider))
+    parsed(middleware, spider, start.url, [
+        Request(BASE + "/Documents/", meta={"row_path": "/Documents", "row_modified": "1"}),
+        Request(BASE + "/Circulars/"),
+    ])
+    parsed(middleware, spider, BASE + "/Documents/", [
+        Request(BASE + "/Documents/?Paged=TRUE&p_FileLeafRef=a.pdf"),
+    ])
+    with pytest.raises(DropItem):
+        depaginate.process_item(listing_page([{"path": "/Documents/a.pdf"}], True), spider)
+    spider.crawl_state.seen("/Documents", "1")
+    crawler.job.db.commit()
+    # ...and the power goes off
+
+    crawler, spider = crawl(job_dir)
+    middleware = ResumeMiddleware.from_crawler(crawler)
+    depaginate = DepaginatingPipeline.from_crawler(crawler)
+    assert crawler.job.resuming
+    spider.crawl_state.load()
+    assert spider.crawl_state.staged == {"/Documents": "1"}
+
+    pending = list(middleware.process_start_requests([Request(BASE + "/")], spider))
+    assert sorted(r.url for r in pending) == [
+        BASE + "/Circulars/",
+        BASE + "/Documents/?Paged=TRUE&p_FileLeafRef=a.pdf",
+    ]
+    assert crawler.stats.get_value("resume/requests_restored") == 2
+
+    # Pages already parsed aren't requested again, whatever the spelling
+    assert parsed(middleware, spider, BASE + "/Circulars/", [
+        Request(BASE + "/Documents/Forms/AllItems.aspx"),
+    ]) == []
+    assert crawler.stats.get_value("resume/requests_skipped_done") == 1
+
+    depaginate.open_spider(spider)
+    item = depaginate.process_item(listing_page([{"path": "/Documents/b.pdf"}], False), spider)
+    assert [row["path"] for row in item["form_table_rows"]] == [
+        "/Documents/a.pdf", "/Documents/b.pdf",
+    ]
+
+    crawler.job.close("finished")
+    crawler, spider = crawl(job_dir)
+    assert not crawler.job.resuming
+
+
+def test_a_page_is_done_once_its_items_are_through_the_pipelines(tmp_path):
+    crawler, spider = crawl(tmp_path / "job")
+    middleware = ResumeMiddleware.from_crawler(crawler)
+    url = BASE + "/Circulars/"
+    response = HtmlResponse(url, body=b"", request=Request(url))
+    items = [PageItem(type="page", path="/Circulars/"), PageItem(type="page", path="/b")]
+    assert list(middleware.process_spider_output(response, iter(items), spider)) == items
+    done = lambda: crawler.job.is_done(canonical_fingerprint(response.request))
+    assert not done()
+
+    crawler.signals.send_catch_log(
+        signals.item_scraped, item=items[0], response=response, spider=spider
+    )
+    assert not done()
+    crawler.signals.send_catch_log(
+        signals.item_dropped, item=items[1], response=response, spider=spider,
+        exception=DropItem(),
+    )
+    assert done()
+
+
+def test_the_feed_is_synced_before_the_job_commits(tmp_path):
+    crawler, spider = crawl(tmp_path / "job")
+    path = str(tmp_path / "feed.jsonlines")
+    with open(path, "wb") as f:
+        exporter = SyncedJsonLinesItemExporter.from_crawler(crawler, f)
+        exporter.start_exporting()
+        exporter.export_item({"path": "/a"})
+        crawler.job.commit()
+        with open(path, "rb") as feed:
+            assert feed.read() == b'{"path": "/a"}\n'
+        exporter.finish_exporting()
+    # A finished feed's file is closed, and no longer synced
+    crawler.job.commit()
+
+
+def test_prepare_picks_the_feed_and_trims_a_partial_line(tmp_path):
+    job_dir = str(tmp_path / "job")
+    first = str(tmp_path / "first.jsonlines")
+    assert prepare(job_dir, first) == first
+
+    job = Job(job_dir)
+    job.open()
+    with open(first, "w") as f:
+        f.write('{"type": "page"}\n{"type": "pa')
+    job.db.commit()
+    job.db.close()
+
+    assert prepare(job_dir, str(tmp_path / "second.jsonlines")) == first
+    with open(first) as f:
+        assert f.read() == '{"type": "page"}\n'
+
+    job = Job(job_dir)
+    job.open()
+    job.close("finished")
+    second = str(tmp_path / "second.jsonlines")
+    assert prepare(job_dir, second) == second
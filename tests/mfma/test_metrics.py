@@ -0,0 +1,103 @@
+from mfma import metrics
+from mfma.extensions import MetricsExporter
+from mfma.pipelines.threads import BlockingCalls
+from mfma.pipelines.timing import PipelineTimer
+from scrapy import signals
+from scrapy.exceptions import DropItem
+from scrapy.http import HtmlResponse
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+import json
+
+
+def test_prometheus_text_format():
+    registry = metrics.Registry()
+    registry.inc("disk_cache_lookups_total", cache="crawl-state", result="hit")
+    registry.inc("disk_cache_lookups_total", 2, cache="crawl-state", result="hit")
+    registry.observe("blocking_call_seconds", 0.003, pool="s3", call="put_object")
+    registry.observe("blocking_call_seconds", 120, pool="s3", call="put_object")
+    lines = registry.prometheus().splitlines()
+    assert "# TYPE mfma_disk_cache_lookups_total counter" in lines
+    assert 'mfma_disk_cache_lookups_total{cache="crawl-state",result="hit"} 3' in lines
+    assert "# TYPE mfma_blocking_call_seconds histogram" in lines
+    assert 'mfma_blocking_call_seconds_bucket{call="put_object",pool="s3",le="0.001"} 0' in lines
+    assert 'mfma_blocking_call_seconds_bucket{call="put_object",pool="s3",le="0.005"} 1' in lines
+    assert 'mfma_blocking_call_seconds_bucket{call="put_object",pool="s3",le="300"} 2' in lines
+    assert 'mfma_blocking_call_seconds_bucket{call="put_object",pool="s3",le="+Inf"} 2' in lines
+    assert 'mfma_blocking_call_seconds_count{call="put_object",pool="s3"} 2' in lines
+
+    [summary] = registry.summary()["histograms"]["blocking_call_seconds"]
+    assert summary["count"] == 2 and summary["buckets"]["0.005"] == 1
+
+
+class ListingSpider(Spider):
+    name = "listing"
+
+    def parse(self, response):
+        yield {"type": "page"}
+        yield from self.page_item(response)
+
+    def page_item(self, response):
+        yield {"type": "page"}
+
+
+def test_exporter_writes_callback_and_pipeline_timings(tmp_path):
+    crawler = get_crawler(ListingSpider, {
+        "METRICS_ENABLED": True, "METRICS_DIR": str(tmp_path), "METRICS_INTERVAL": 0,
+    })
+    exporter = MetricsExporter.from_crawler(crawler)
+    timer = PipelineTimer.from_crawler(crawler)
+    spider = ListingSpider()
+    exporter.spider_opened(spider)
+
+    response = HtmlResponse("http://mfma.treasury.gov.za/", body=b"<html></html>")
+    items = [timer.process_item(item, spider) for item in spider.parse(response)]
+    crawler.signals.send_catch_log(
+        signals.item_scraped, item=items[0], response=response, spider=spider
+    )
+    crawler.signals.send_catch_log(
+        signals.item_dropped, item=items[1], response=response, spider=spider,
+        exception=DropItem(),
+    )
+    # Not timed in, as when the archive pipeline resumes a file
+    crawler.signals.send_catch_log(
+        signals.item_scraped, item={}, response=None, spider=spider
+    )
+    crawler.stats.inc_value("file_archive/s3-file-archive/uploaded_bytes", 1024)
+    exporter.spider_closed(spider, "finished")
+
+    summary = json.loads((tmp_path / "listing.metrics.json").read_text())
+    assert summary["finish_reason"] == "finished"
+    calls = {c["callback"]: c["value"] for c in summary["counters"]["callback_calls_total"]}
+    assert calls == {"parse": 1, "page_item": 1}
+    clocks = {
+        (c["callback"], c["clock"]) for c in summary["counters"]["callback_seconds_total"]
+    }
+    assert ("parse", "cpu") in clocks and ("page_item", "wall") in clocks
+    pipelines = summary["histograms"]["item_pipelines_seconds"]
+    assert sorted((p["outcome"], p["count"]) for p in pipelines) == [
+        ("dropped", 1), ("scraped", 1)
+    ]
+    assert timer.started == {}
+    assert summary["crawl_stats"]["file_archive/s3-file-archive/uploaded_bytes"] == 1024
+
+    prom = (tmp_path / "listing.metrics.prom").read_text()
+    assert 'mfma_crawl_stat{stat="file_archive/s3-file-archive/uploaded_bytes"} 1024' in prom
+    assert 'mfma_callback_calls_total{callback="parse"} 1' in prom
+
+
+def test_metrics_go_next_to_the_feed(tmp_path):
+    feed = tmp_path / "mfma.jsonlines-2021-06-01"
+    crawler = get_crawler(ListingSpider, {
+        "METRICS_ENABLED": True, "FEEDS": {str(feed): {"format": "jsonlines"}},
+    })
+    exporter = MetricsExporter.from_crawler(crawler)
+    assert exporter.metrics_path_prefix(ListingSpider()) == str(feed)
+
+
+def test_blocking_calls_are_timed():
+    metrics.REGISTRY.clear()
+    calls = BlockingCalls("test-pool", 1)
+    calls.timed(len, [])
+    [summary] = metrics.REGISTRY.summary()["histograms"]["blocking_call_seconds"]
+    assert (summary["pool"], summary["call"], summary["count"]) == ("test-pool", "len", 1)
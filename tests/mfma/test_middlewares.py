@@ -0,0 +1,73 @@
+from mfma.extensions import SlotAutoThrottle
+from mfma.middlewares import DownloadSlotsMiddleware, slot_name
+from scrapy.http import Request, Response
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+from types import SimpleNamespace
+
+
+SLOTS = {
+    "pages": {"concurrency": 2, "delay": 2},
+    "revalidations": {"concurrency": 2, "delay": 0.25},
+    "files": {"concurrency": 3, "delay": 2, "discovery_concurrency": 1},
+}
+URL = "http://mfma.treasury.gov.za/Documents/a.pdf"
+
+
+class Scheduler(object):
+    pending = True
+
+    def has_pending_requests(self):
+        return self.pending
+
+
+def crawler_with_engine(**settings):
+    crawler = get_crawler(Spider, dict({"DOWNLOAD_SLOTS": SLOTS}, **settings))
+    crawler.engine = SimpleNamespace(
+        downloader=SimpleNamespace(slots={}, randomize_delay=False),
+        slot=SimpleNamespace(scheduler=Scheduler()),
+    )
+    return crawler
+
+
+def test_requests_are_put_in_their_slots():
+    assert slot_name(Request("http://mfma.treasury.gov.za/")) == "pages"
+    assert slot_name(Request(URL, meta={"file_archive": True})) == "files"
+    revalidation = Request(URL, headers={"If-None-Match": '"1"'}, meta={"file_archive": True})
+    assert slot_name(revalidation) == "revalidations"
+
+    crawler = crawler_with_engine()
+    spider = Spider("mfma")
+    middleware = DownloadSlotsMiddleware.from_crawler(crawler)
+    middleware.process_request(revalidation, spider)
+    assert revalidation.meta["download_slot"] == "revalidations"
+    slot = crawler.engine.downloader.slots["revalidations"]
+    assert (slot.concurrency, slot.delay, slot.mindelay) == (2, 0.25, 0.25)
+
+
+def test_file_downloads_make_way_for_pages():
+    crawler = crawler_with_engine()
+    spider = Spider("mfma")
+    middleware = DownloadSlotsMiddleware.from_crawler(crawler)
+    middleware.process_request(Request(URL, meta={"file_archive": True}), spider)
+    assert crawler.engine.downloader.slots["files"].concurrency == 1
+
+    crawler.engine.slot.scheduler.pending = False
+    middleware.process_request(Request(URL, meta={"file_archive": True}), spider)
+    assert crawler.engine.downloader.slots["files"].concurrency == 3
+
+
+def test_autothrottle_keeps_each_slots_own_minimum():
+    crawler = crawler_with_engine(AUTOTHROTTLE_ENABLED=True, DOWNLOAD_DELAY=2)
+    spider = Spider("mfma")
+    middleware = DownloadSlotsMiddleware.from_crawler(crawler)
+    revalidations = middleware.slot("revalidations", spider)
+    pages = middleware.slot("pages", spider)
+    throttle = SlotAutoThrottle.from_crawler(crawler)
+    throttle._spider_opened(spider)
+
+    for i in range(10):
+        throttle._adjust_delay(revalidations, 0.01, Response(URL, status=200))
+        throttle._adjust_delay(pages, 0.01, Response(URL, status=200))
+    assert 0.25 <= revalidations.delay < 0.3
+    assert pages.delay == 2
@@ -0,0 +1,46 @@
+import os
+from bs4 import BeautifulSoup
+from parsel import Selector
+from mfma.transform import HtmlTransform
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "spiders", "test_mfma_spider")
+
+
+def beautifulsoup_round_trip(selector):
+    return str(BeautifulSoup(selector.extract(), "html.parser"))
+
+
+def test_matches_beautifulsoup_on_fixtures():
+    for filename in sorted(os.listdir(FIXTURES)):
+        if not filename.endswith("_page_source.html"):
+            continue
+        with open(os.path.join(FIXTURES, filename)) as f:
+            selector = Selector(text=f.read())
+        for element in selector.css("table, span, div"):
+            assert beautifulsoup_round_trip(element) == HtmlTransform().transform(
+                element.root
+            )
+
+
+def test_matches_beautifulsoup_quirks():
+    selector = Selector(
+        text=(
+            '<div><pre>\n  <b>x</b>   \n</pre>   \n<!--   --><p>&nbsp;</p>'
+            '<script>if (a<b && c>d) {}</script>'
+            '<a href=" /a b/\xe9?x=1&amp;y=&quot;2&quot;" name="x y">t &amp; &lt;</a>'
+            '<td nowrap="nowrap" class=" a  b" headers="h1  h2">x</td>'
+            "<p title='it&#39;s \"quoted\"'>p</p><spacer>x</spacer></div>"
+        )
+    )
+    element = selector.css("div")[0]
+    assert beautifulsoup_round_trip(element) == HtmlTransform().transform(element.root)
+
+
+def test_whitelist_links_and_br():
+    selector = Selector(
+        text='<div class="c"><a href="/a" class="x">a</a><br> <br><br>b<br></div>'
+    )
+    transform = HtmlTransform(whitelist={"href"}, collapse_br=True)
+    html = transform.transform(selector.css("div")[0].root, lambda href: href + "/")
+    assert '<div><a href="/a/">a</a><br/><br/>b<br/></div>' == html